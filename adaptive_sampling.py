@@ -0,0 +1,281 @@
+import math
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from statistics import NormalDist
+from typing import Callable, Optional, Union
+
+from .prompt_wrapper import *
+from .prompt_factory import PromptFilter
+from .prompt_space import PromptSpace
+from .budget import BudgetExceededError
+
+
+class SequentialStoppingRule:
+    """
+    Decides when the decision distribution of a cell is settled.
+    Every cell gets at least `min_per_cell` and at most `max_per_cell` responses, after the first `min_per_cell`
+    responses the cell is checked again every `check_every` responses.
+
+    A cell is settled once the Wilson confidence interval of the most frequent decision is separated from the one of the
+    second most frequent decision, or (if `max_ci_half_width` is set) once the intervals of all decisions are at most that wide.
+    As the counts are checked repeatedly, the confidence level is Bonferroni corrected for the maximum number of checks.
+    """
+
+    def __init__(
+        self,
+        min_per_cell: int = 20,
+        max_per_cell: int = 200,
+        check_every: int = 10,
+        confidence: float = 0.95,
+        max_ci_half_width: Optional[float] = None,
+    ):
+        if not 0 < min_per_cell <= max_per_cell:
+            raise ValueError("min_per_cell has to be positive and not larger than max_per_cell")
+        if check_every <= 0:
+            raise ValueError("check_every has to be positive")
+        self.min_per_cell = min_per_cell
+        self.max_per_cell = max_per_cell
+        self.check_every = check_every
+        self.confidence = confidence
+        self.max_ci_half_width = max_ci_half_width
+
+        max_checks = 1 + math.ceil((max_per_cell - min_per_cell) / check_every)
+        self.z = NormalDist().inv_cdf(1 - (1 - confidence) / (2 * max_checks))
+
+    def get_wilson_interval(self, count: int, n: int) -> tuple[float, float]:
+        if n == 0:
+            return 0.0, 1.0
+        proportion = count / n
+        denominator = 1 + self.z ** 2 / n
+        center = (proportion + self.z ** 2 / (2 * n)) / denominator
+        half_width = self.z * math.sqrt(proportion * (1 - proportion) / n + self.z ** 2 / (4 * n ** 2)) / denominator
+        return max(0.0, center - half_width), min(1.0, center + half_width)
+
+    def is_settled(self, counts: dict[DecisionOption, int]) -> bool:
+        n = sum(counts.values())
+        if n < self.min_per_cell:
+            return False
+        intervals = sorted(
+            (self.get_wilson_interval(counts.get(option, 0), n) for option in DecisionOption),
+            key=lambda interval: interval[0] + interval[1],
+            reverse=True,
+        )
+        # The leading decision is clearly more frequent than the runner-up
+        if intervals[0][0] > intervals[1][1]:
+            return True
+        if self.max_ci_half_width is not None:
+            return all((high - low) / 2 <= self.max_ci_half_width for low, high in intervals)
+        return False
+
+    def to_dict(self):
+        return {
+            "min_per_cell": self.min_per_cell,
+            "max_per_cell": self.max_per_cell,
+            "check_every": self.check_every,
+            "confidence": self.confidence,
+            "max_ci_half_width": self.max_ci_half_width,
+        }
+
+
+class SamplingCell:
+    """
+    The prompts of one dilemma x ethical framework x model cell, drawn in random order.
+    `unqueried` holds the prompts that were not drawn yet, drawn prompts that were not queried can be put back.
+    """
+
+    def __init__(self, dilemma_identifier: str, ethical_framework_identifier: str, model: LlmName, prompts: list[PromptWrapper]):
+        self.dilemma_identifier = dilemma_identifier
+        self.ethical_framework_identifier = ethical_framework_identifier
+        self.model = model
+        self.prompts = prompts
+        self.unqueried: deque[PromptWrapper] = deque(prompts)
+        self.counts: dict[DecisionOption, int] = {option: 0 for option in DecisionOption}
+        self.failed = 0
+        self.api_calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.settled = False
+
+    @property
+    def responses(self) -> int:
+        return sum(self.counts.values())
+
+    @property
+    def is_done(self) -> bool:
+        return self.settled or not self.unqueried
+
+    def draw(self, n: int) -> list[PromptWrapper]:
+        return [self.unqueried.popleft() for _ in range(min(n, len(self.unqueried)))]
+
+    def put_back(self, wrapped_prompts: list[PromptWrapper]):
+        """Return drawn prompts that were not queried, they are drawn again first (in the same order)"""
+        self.unqueried.extendleft(reversed(wrapped_prompts))
+
+    @property
+    def api_calls_avoided(self) -> int:
+        """API calls (one per prompt of a conversation) the prompts that were not queried would have needed"""
+        return sum(len(wrapped_prompt.prompts) for wrapped_prompt in self.unqueried)
+
+    def to_dict(self):
+        return {
+            "dilemma_identifier": self.dilemma_identifier,
+            "ethical_framework_identifier": self.ethical_framework_identifier,
+            "model": self.model.value,
+            "counts": {option.value: count for option, count in self.counts.items()},
+            "responses": self.responses,
+            "failed": self.failed,
+            "settled": self.settled,
+            "api_calls": self.api_calls,
+            "api_calls_avoided": self.api_calls_avoided,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+        }
+
+
+class AdaptiveSamplingReport:
+    def __init__(self, stopping_rule: SequentialStoppingRule, cells: list[SamplingCell]):
+        self.stopping_rule = stopping_rule
+        self.cells = cells
+
+    @property
+    def api_calls(self) -> int:
+        return sum(cell.api_calls for cell in self.cells)
+
+    @property
+    def api_calls_avoided(self) -> int:
+        return sum(cell.api_calls_avoided for cell in self.cells)
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        """Share of the prompt tokens served from the provider's prompt cache"""
+        prompt_tokens = sum(cell.prompt_tokens for cell in self.cells)
+        return sum(cell.cached_tokens for cell in self.cells) / prompt_tokens if prompt_tokens else 0.0
+
+    @property
+    def settled_cells(self) -> int:
+        return sum(1 for cell in self.cells if cell.settled)
+
+    def to_dict(self):
+        return {
+            "stopping_rule": self.stopping_rule.to_dict(),
+            "api_calls": self.api_calls,
+            "api_calls_avoided": self.api_calls_avoided,
+            "settled_cells": self.settled_cells,
+            "cache_hit_ratio": self.cache_hit_ratio,
+            "cells": [cell.to_dict() for cell in self.cells],
+        }
+
+    def __str__(self):
+        planned = self.api_calls + self.api_calls_avoided
+        saving = self.api_calls_avoided / planned if planned else 0.0
+        return (
+            f"{self.settled_cells}/{len(self.cells)} cells settled early, "
+            f"{self.api_calls} API calls made, {self.api_calls_avoided} avoided ({saving:.1%}), "
+            f"{self.cache_hit_ratio:.1%} of the prompt tokens served from the provider's prompt cache"
+        )
+
+
+def get_sampling_cells(
+    models: list[LlmName],
+    stopping_rule: SequentialStoppingRule,
+    prompt_filter: Optional[PromptFilter] = None,
+    seed: Optional[int] = None,
+) -> list[SamplingCell]:
+    """One cell per dilemma x ethical framework x model, each with up to max_per_cell prompts in random order."""
+    space = PromptSpace(prompt_filter)
+    cells = []
+    for dilemma_identifier in space.get_factor_levels("dilemma_identifier"):
+        dilemma_space = space.restrict("dilemma_identifier", dilemma_identifier)
+        for ethical_framework_identifier in dilemma_space.get_factor_levels("ethical_framework_identifier"):
+            cell_space = dilemma_space.restrict("ethical_framework_identifier", ethical_framework_identifier)
+            if len(cell_space) == 0:
+                continue
+            for model in models:
+                rng = random.Random(f"{seed}-{dilemma_identifier}-{ethical_framework_identifier}-{model.value}")
+                indices = rng.sample(range(len(cell_space)), min(stopping_rule.max_per_cell, len(cell_space)))
+                cells.append(SamplingCell(dilemma_identifier, ethical_framework_identifier, model, [cell_space[index] for index in indices]))
+    return cells
+
+
+def run_adaptive_sampling(
+    api_key: str,
+    query_function: Callable[[str, PromptWrapper, LlmName], Response],
+    models: list[LlmName],
+    stopping_rule: Optional[SequentialStoppingRule] = None,
+    prompt_filter: Optional[PromptFilter] = None,
+    seed: Optional[int] = None,
+    max_workers: int = 1,
+    on_result: Optional[Callable[[PromptWrapper, Union[Response, Exception]], None]] = None,
+) -> tuple[list[Response], AdaptiveSamplingReport]:
+    """
+    Query prompts cell by cell (dilemma x ethical framework x model) with `query_function` (e.g. query_openai_api),
+    and stop querying a cell as soon as its decision distribution is settled (see SequentialStoppingRule).
+    Every round queries the next `check_every` prompts (`min_per_cell` in the first round) of every unsettled cell.
+    Failed prompts are not counted, the next of the cell's max_per_cell prompts is drawn instead. `on_result` is called for every
+    result, e.g. with ResultsLog.append for the successful ones.
+    With a query function wrapped by budget.budgeted_query_function, sampling stops once the budget is used up.
+    Returns the Responses and a report with the API calls that were made and avoided. Only requests that reached the provider
+    are counted as made, not the turns answered by a ResponseCache nor failed prompts.
+    """
+    stopping_rule = stopping_rule or SequentialStoppingRule()
+    cells = get_sampling_cells(models, stopping_rule, prompt_filter, seed)
+    responses: list[Response] = []
+
+    def run(job: tuple[SamplingCell, PromptWrapper]) -> Union[Response, Exception]:
+        cell, wrapped_prompt = job
+        try:
+            return query_function(api_key, wrapped_prompt, cell.model)
+        except Exception as e:
+            return e
+
+    executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+    try:
+        first_round = True
+        budget_exceeded = False
+        while not budget_exceeded:
+            jobs = []
+            for cell in cells:
+                if cell.is_done:
+                    continue
+                # Failed prompts are replaced, thus draw up to the missing number of responses
+                target = stopping_rule.min_per_cell if first_round else min(cell.responses + stopping_rule.check_every, stopping_rule.max_per_cell)
+                jobs += [(cell, wrapped_prompt) for wrapped_prompt in cell.draw(target - cell.responses)]
+            first_round = False
+            if not jobs:
+                break
+
+            results = executor.map(run, jobs) if executor else map(run, jobs)
+            rejected: dict[int, list[PromptWrapper]] = {}
+            for (cell, wrapped_prompt), result in zip(jobs, results):
+                if isinstance(result, BudgetExceededError):
+                    # Not queried, thus avoided. Stop after this round
+                    budget_exceeded = True
+                    rejected.setdefault(id(cell), []).append(wrapped_prompt)
+                    continue
+                if isinstance(result, Exception):
+                    cell.failed += 1
+                else:
+                    # Turns answered by the ResponseCache are no API calls, Responses of a custom query_function may not know
+                    cell.api_calls += result.requests if result.requests is not None else len(wrapped_prompt.prompts)
+                    cell.counts[result.decision] += 1
+                    cell.prompt_tokens += result.prompt_tokens or 0
+                    cell.cached_tokens += result.cached_tokens or 0
+                    responses.append(result)
+                if on_result is not None:
+                    on_result(wrapped_prompt, result)
+
+            for cell in cells:
+                cell.put_back(rejected.get(id(cell), []))
+                if not cell.settled and cell.responses >= stopping_rule.max_per_cell:
+                    # Not settled, but the maximum is reached
+                    cell.unqueried.clear()
+                elif not cell.settled and stopping_rule.is_settled(cell.counts):
+                    cell.settled = True
+    finally:
+        if executor:
+            executor.shutdown()
+
+    report = AdaptiveSamplingReport(stopping_rule, cells)
+    print(f"Adaptive sampling finished: {report}")
+    return responses, report
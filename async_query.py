@@ -0,0 +1,276 @@
+import asyncio
+import time
+from typing import Callable, Iterable, Optional, Union
+
+import openai
+
+from .prompt_wrapper import *
+from .llm_query import Completion, api_names, conversation_turns, create_response_from_turns, record_api_call
+from .metrics import ApiCallEvent, emit, has_metrics_hooks
+from .provider_client import ProviderClient, get_provider_client
+from .response_cache import ResponseCache
+from .budget import TokenBudget
+from .retry import RetryPolicy, call_with_retries_async
+
+
+class TokenBucket:
+    """Holds up to `capacity` tokens and refills `rate` tokens per second."""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1):
+        """
+        Take `amount` tokens, waiting until they are refilled if necessary.
+        The tokens are reserved right away (the bucket may go negative), so waiters are served in order and the lock
+        is only held to compute the wait, not while sleeping.
+        """
+        # A single request larger than the bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            self._tokens -= amount
+            wait = -self._tokens / self.rate
+        if wait <= 0:
+            return
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # Give back the reservation of a request that is not sent
+            self._tokens += amount
+            raise
+
+    def consume(self, amount: float):
+        """Take tokens without waiting. The bucket may go negative, which delays the following acquires."""
+        self._refill()
+        self._tokens -= amount
+
+
+class RateLimit:
+    """Requests per minute and tokens per minute of a provider. None disables the limit."""
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+
+# Conservative defaults (lowest paid tiers). Pass your own RateLimit for higher tiers.
+default_rate_limits = {
+    LlmProvider.OPENAI: RateLimit(requests_per_minute=500, tokens_per_minute=30_000),
+    # DeepSeek does not publish rate limits, it slows responses down instead
+    LlmProvider.DEEPSEEK: RateLimit(),
+    LlmProvider.MISTRAL: RateLimit(requests_per_minute=60, tokens_per_minute=500_000),
+}
+
+
+def estimate_tokens(messages: list[dict]) -> int:
+    """Rough token estimate (~4 characters per token) used to pace requests before the real usage is known."""
+    return sum(len(message["content"]) for message in messages) // 4 + 1
+
+
+class RateLimiter:
+    """Token-bucket limiter for the requests and tokens per minute of a single provider."""
+
+    def __init__(self, rate_limit: RateLimit):
+        self.requests = None
+        self.tokens = None
+        if rate_limit.requests_per_minute:
+            self.requests = TokenBucket(rate_limit.requests_per_minute, rate_limit.requests_per_minute / 60)
+        if rate_limit.tokens_per_minute:
+            self.tokens = TokenBucket(rate_limit.tokens_per_minute, rate_limit.tokens_per_minute / 60)
+
+    async def acquire(self, estimated_tokens: int):
+        if self.requests:
+            await self.requests.acquire(1)
+        if self.tokens:
+            await self.tokens.acquire(estimated_tokens)
+
+    def record_usage(self, estimated_tokens: int, used_tokens: int):
+        """Correct the token bucket once the real usage (including the completion) is known."""
+        if self.tokens:
+            self.tokens.consume(used_tokens - estimated_tokens)
+
+
+async def complete_turn_async(
+    client: openai.AsyncOpenAI,
+    model: LlmName,
+    messages: list[dict],
+    response_format: Optional[dict],
+    rate_limiter: Optional[RateLimiter] = None,
+    cache: Optional[ResponseCache] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> Completion:
+    """
+    Async version of llm_query.complete_turn. Cache hits do not count against the rate limits, every retry does.
+    The cache is read and written in a worker thread, so its disk I/O does not block the event loop.
+    """
+    if cache:
+        cache_key = cache.get_key(model.value, messages, response_format)
+        entry = await asyncio.to_thread(cache.get, cache_key)
+        if entry:
+            if has_metrics_hooks():
+                emit(ApiCallEvent(model=model, from_cache=True))
+            completion = Completion.from_dict(entry)
+            completion.from_cache = True
+            return completion
+
+    kwargs = {}
+    if response_format:
+        kwargs["response_format"] = response_format
+
+    estimated_tokens = estimate_tokens(messages)
+
+    async def request() -> Completion:
+        if rate_limiter:
+            await rate_limiter.acquire(estimated_tokens)
+
+        # The latency does not include waiting for the rate limiter
+        started = time.monotonic()
+        response = None
+        try:
+            response = await client.chat.completions.create(
+                model=model.value,
+                messages=messages,
+                n=1,
+                **kwargs,
+            )
+
+            if rate_limiter and response.usage:
+                rate_limiter.record_usage(estimated_tokens, response.usage.total_tokens)
+            completion = Completion.from_chat_completion(response, api_names[model.provider])
+        except Exception as e:
+            record_api_call(model, started, response, e)
+            raise e
+        record_api_call(model, started, response)
+        return completion
+
+    completion, completion.retries = await call_with_retries_async(request, model.provider, retry_policy)
+
+    if cache:
+        await asyncio.to_thread(cache.put, cache_key, completion.to_dict())
+    return completion
+
+
+async def run_conversation_async(
+    client: openai.AsyncOpenAI,
+    wrapped_prompt: PromptWrapper,
+    model: LlmName,
+    messages: list[dict],
+    rate_limiter: Optional[RateLimiter] = None,
+    cache: Optional[ResponseCache] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> list[Completion]:
+    """Async version of llm_query.run_conversation"""
+    turns = conversation_turns(wrapped_prompt, messages)
+    try:
+        response_format = next(turns)
+        while True:
+            completion = await complete_turn_async(client, model, messages, response_format, rate_limiter, cache, retry_policy)
+            response_format = turns.send(completion)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def query_api_async(
+    client: openai.AsyncOpenAI,
+    wrapped_prompt: PromptWrapper,
+    model: LlmName = LlmName.GPT4O,
+    rate_limiter: Optional[RateLimiter] = None,
+    cache: Optional[ResponseCache] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> Response:
+    """Async version of query_openai_api / query_deepseek_api / query_mistral_api for an already configured client."""
+    messages = []
+
+    try:
+        completions = await run_conversation_async(client, wrapped_prompt, model, messages, rate_limiter, cache, retry_policy)
+        return create_response_from_turns(wrapped_prompt, model, messages, completions)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        raise e
+
+
+async def query_prompts_async(
+    api_key: str,
+    wrapped_prompts: Iterable[PromptWrapper],
+    model: LlmName = LlmName.GPT4O,
+    max_concurrency: int = 8,
+    rate_limiter: Optional[RateLimiter] = None,
+    return_exceptions: bool = False,
+    provider_client: Optional[ProviderClient] = None,
+    on_result: Optional[Callable[[PromptWrapper, Union[Response, Exception]], None]] = None,
+    cache: Optional[ResponseCache] = None,
+    budget: Optional[TokenBudget] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> list[Union[Response, Exception]]:
+    """
+    Query many PromptWrappers concurrently with at most `max_concurrency` requests in flight.
+    The requests are paced by `rate_limiter` (defaults to default_rate_limits of the model's provider).
+    Responses are returned in the order of `wrapped_prompts`.
+    With return_exceptions=True a failed prompt yields its exception instead of aborting the whole batch.
+    `provider_client` overrides the provider settings (e.g. the base URL), by default the shared client of `api_key` is used.
+    `on_result` is called with every PromptWrapper and its Response (or exception) as soon as it is finished.
+    An optional ResponseCache answers previously seen requests without calling the API.
+    With a TokenBudget, prompts that do not fit into the remaining budget fail with BudgetExceededError.
+    Transient errors are retried according to `retry_policy` (default: retry.default_retry_policy).
+    """
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(default_rate_limits[model.provider])
+    if provider_client is None:
+        provider_client = get_provider_client(model.provider, api_key)
+
+    client = provider_client.create_async_client(max_connections=max_concurrency)
+
+    results = {}
+    # Workers pull from a shared iterator, so `wrapped_prompts` can be a lazy generator
+    indexed_prompts = enumerate(wrapped_prompts)
+
+    async def worker():
+        for index, wrapped_prompt in indexed_prompts:
+            try:
+                if budget:
+                    reservation = budget.reserve(wrapped_prompt, model)
+                    response = None
+                    try:
+                        response = await query_api_async(client, wrapped_prompt, model, rate_limiter, cache, retry_policy)
+                    finally:
+                        budget.settle(reservation, model, response)
+                    results[index] = response
+                else:
+                    results[index] = await query_api_async(client, wrapped_prompt, model, rate_limiter, cache, retry_policy)
+            except Exception as e:
+                if on_result:
+                    on_result(wrapped_prompt, e)
+                if not return_exceptions:
+                    raise e
+                results[index] = e
+                continue
+            if on_result:
+                on_result(wrapped_prompt, results[index])
+
+    workers = [asyncio.create_task(worker()) for _ in range(max_concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    except Exception as e:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise e
+    finally:
+        await client.close()
+
+    return [results[index] for index in range(len(results))]
+
+
+def query_prompts(api_key: str, wrapped_prompts: Iterable[PromptWrapper], model: LlmName = LlmName.GPT4O, **kwargs) -> list[Union[Response, Exception]]:
+    """Blocking wrapper around query_prompts_async. Inside a running event loop (e.g. jupyter) await query_prompts_async instead."""
+    return asyncio.run(query_prompts_async(api_key, wrapped_prompts, model, **kwargs))
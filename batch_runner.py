@@ -0,0 +1,244 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Literal, Union
+
+from .prompt_wrapper import *
+from .async_query import query_prompts_async
+from .budget import BudgetExceededError
+from .decoding import get_json_loads
+from .prompt_factory import sort_by_shared_prefix
+from .prompts_json import iter_records, iter_responses, read_text_table
+
+
+FsyncPolicy = Literal["always", "interval", "never"]
+
+
+class ResultsLog:
+    """
+    Append-only JSONL log with one Response per line.
+    Every append is flushed to the OS immediately. When the data is fsynced to disk depends on the fsync_policy:
+    - "always": after every Response (safest, slowest)
+    - "interval": at most every `fsync_interval` seconds
+    - "never": left to the OS
+    With compact=True every distinct prompt text is written once (see prompt_wrapper.TextTable).
+    """
+
+    def __init__(self, path: str, fsync_policy: FsyncPolicy = "interval", fsync_interval: float = 5.0, compact: bool = False):
+        if fsync_policy not in ["always", "interval", "never"]:
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.compact = compact
+        self._lock = threading.Lock()
+        self._last_fsync = time.monotonic()
+        self._drop_incomplete_line()
+        self._text_table = read_text_table(path) if compact else None
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _drop_incomplete_line(self):
+        """A crash during a write can leave a partial last line. Cut it off so the next append starts on a new line."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            # Search backwards for the last complete line
+            position = size
+            while position > 0:
+                step = min(position, 65536)
+                position -= step
+                f.seek(position)
+                chunk = f.read(step)
+                newline_index = chunk.rfind(b"\n")
+                if newline_index != -1:
+                    f.truncate(position + newline_index + 1)
+                    return
+            f.truncate(0)
+
+    def read_dicts(self) -> Iterator[dict]:
+        loads = get_json_loads()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield loads(line)
+
+    def read_responses(self) -> Iterator[Response]:
+        return iter_responses(self.path)
+
+    def get_completed_ids(self) -> set[str]:
+        return {item["wrapped_prompt"]["_id"] for item in self.read_dicts() if "wrapped_prompt" in item}
+
+    def append(self, response: Response):
+        with self._lock:
+            # Text records and the Response are written at once, so they are only lost together
+            self._file.write("".join(json.dumps(record) + "\n" for record in iter_records([response], self._text_table)))
+            self._file.flush()
+            if self.fsync_policy == "always" or (
+                self.fsync_policy == "interval" and time.monotonic() - self._last_fsync >= self.fsync_interval
+            ):
+                os.fsync(self._file.fileno())
+                self._last_fsync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            if self.fsync_policy != "never":
+                os.fsync(self._file.fileno())
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BatchRunReport:
+    def __init__(self):
+        self.skipped = 0
+        self.completed = 0
+        self.failed_ids: list[str] = []
+        # Not queried as the TokenBudget was used up
+        self.over_budget = 0
+        self.prompt_tokens = 0
+        # Prompt tokens served from the provider's prompt prefix cache
+        self.cached_tokens = 0
+        # Requests of completed prompts that were sent again after a transient error
+        self.retries = 0
+
+    @property
+    def failed(self) -> int:
+        return len(self.failed_ids)
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def to_dict(self):
+        return {
+            "skipped": self.skipped,
+            "completed": self.completed,
+            "failed": self.failed,
+            "failed_ids": self.failed_ids,
+            "over_budget": self.over_budget,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_hit_ratio": self.cache_hit_ratio,
+            "retries": self.retries,
+        }
+
+    def __str__(self):
+        return (
+            f"{self.completed} completed, {self.skipped} skipped (already in the log), {self.failed} failed, "
+            f"{self.over_budget} not queried (budget reached), {self.retries} retries, "
+            f"{self.cache_hit_ratio:.1%} of the prompt tokens served from the provider's prompt cache"
+        )
+
+
+def _get_pending_prompts(wrapped_prompts: Iterable[PromptWrapper], completed_ids: set[str], report: BatchRunReport) -> Iterator[PromptWrapper]:
+    for wrapped_prompt in wrapped_prompts:
+        if wrapped_prompt._id is None:
+            raise Exception("PromptWrapper ID is None")
+        if wrapped_prompt._id in completed_ids:
+            report.skipped += 1
+            continue
+        yield wrapped_prompt
+
+
+def _record_result(log: ResultsLog, report: BatchRunReport, wrapped_prompt: PromptWrapper, result: Union[Response, Exception]):
+    if isinstance(result, BudgetExceededError):
+        report.over_budget += 1
+    elif isinstance(result, Exception):
+        report.failed_ids.append(wrapped_prompt._id)
+    else:
+        log.append(result)
+        report.completed += 1
+        report.prompt_tokens += result.prompt_tokens or 0
+        report.cached_tokens += result.cached_tokens or 0
+        report.retries += result.retries or 0
+
+
+def run_batch(
+    api_key: str,
+    wrapped_prompts: Iterable[PromptWrapper],
+    query_function: Callable[[str, PromptWrapper, LlmName], Response],
+    log_path: str,
+    model: LlmName,
+    max_workers: int = 1,
+    fsync_policy: FsyncPolicy = "interval",
+    compact: bool = False,
+    group_by_prefix: bool = False,
+) -> BatchRunReport:
+    """
+    Query every PromptWrapper with `query_function` (e.g. query_openai_api) and append each Response to the log at `log_path`.
+    PromptWrappers whose _id is already in the log are skipped, so an interrupted run can simply be started again.
+    Failed prompts are reported and not logged, thus they are retried by the next run.
+    Prompts rejected by a budget (see budget.budgeted_query_function) are reported as over budget.
+    The prompts are streamed in their given order. With group_by_prefix the pending prompts are sent in the order of
+    sort_by_shared_prefix to benefit from prompt caching, which renders and holds all of them in memory before the first request.
+    """
+    report = BatchRunReport()
+    with ResultsLog(log_path, fsync_policy, compact=compact) as log:
+        pending_prompts = _get_pending_prompts(wrapped_prompts, log.get_completed_ids(), report)
+        if group_by_prefix:
+            pending_prompts = sort_by_shared_prefix(pending_prompts)
+        record_lock = threading.Lock()
+
+        def run(wrapped_prompt: PromptWrapper):
+            try:
+                result = query_function(api_key, wrapped_prompt, model)
+            except Exception as e:
+                result = e
+            with record_lock:
+                _record_result(log, report, wrapped_prompt, result)
+
+        if max_workers == 1:
+            for wrapped_prompt in pending_prompts:
+                run(wrapped_prompt)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for _ in executor.map(run, pending_prompts):
+                    pass
+
+    print(f"Batch run finished: {report}")
+    return report
+
+
+async def run_batch_async(
+    api_key: str,
+    wrapped_prompts: Iterable[PromptWrapper],
+    log_path: str,
+    model: LlmName,
+    fsync_policy: FsyncPolicy = "interval",
+    compact: bool = False,
+    group_by_prefix: bool = False,
+    **kwargs,
+) -> BatchRunReport:
+    """Same as run_batch, but queries concurrently through query_prompts_async (kwargs are passed on)."""
+    report = BatchRunReport()
+    with ResultsLog(log_path, fsync_policy, compact=compact) as log:
+        pending_prompts = _get_pending_prompts(wrapped_prompts, log.get_completed_ids(), report)
+        if group_by_prefix:
+            pending_prompts = sort_by_shared_prefix(pending_prompts)
+        await query_prompts_async(
+            api_key,
+            pending_prompts,
+            model,
+            return_exceptions=True,
+            on_result=lambda wrapped_prompt, result: _record_result(log, report, wrapped_prompt, result),
+            **kwargs,
+        )
+
+    print(f"Batch run finished: {report}")
+    return report
@@ -0,0 +1,302 @@
+import hashlib
+import os
+import tempfile
+import threading
+from typing import Callable, Iterable, Optional
+
+from .prompt_wrapper import *
+
+
+class ModelPrice:
+    """USD per million tokens"""
+
+    def __init__(self, prompt: float, cached_prompt: float, completion: float):
+        self.prompt = prompt
+        self.cached_prompt = cached_prompt
+        self.completion = completion
+
+    def get_cost(self, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> float:
+        return (
+            (prompt_tokens - cached_tokens) * self.prompt
+            + cached_tokens * self.cached_prompt
+            + completion_tokens * self.completion
+        ) / 1_000_000
+
+
+# List prices at the time of writing, pass your own if they changed
+model_prices = {
+    LlmName.GPT4O: ModelPrice(prompt=2.50, cached_prompt=1.25, completion=10.00),
+    LlmName.DEEPSEEK: ModelPrice(prompt=0.27, cached_prompt=0.07, completion=1.10),
+    LlmName.MISTRAL_SMALL: ModelPrice(prompt=0.20, cached_prompt=0.20, completion=0.60),
+}
+
+# Tokens the chat format adds per message
+MESSAGE_OVERHEAD_TOKENS = 4
+DEFAULT_CHARACTERS_PER_TOKEN = 4.0
+DEFAULT_COMPLETION_TOKENS = 300
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+def _is_encoding_available(encoding_name: str) -> bool:
+    """True if tiktoken can load the encoding without a download: it is already loaded or its file is in the tiktoken cache"""
+    import tiktoken.registry
+    if encoding_name in tiktoken.registry.ENCODINGS:
+        return True
+    # Same cache location and key as tiktoken.load.read_file_cached
+    cache_dir = os.environ.get("TIKTOKEN_CACHE_DIR") or os.environ.get("DATA_GYM_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    blobpath = f"https://openaipublic.blob.core.windows.net/encodings/{encoding_name}.tiktoken"
+    return os.path.exists(os.path.join(cache_dir, hashlib.sha1(blobpath.encode()).hexdigest()))
+
+
+def _get_tokenizer(model: LlmName) -> Optional[Callable[[str], int]]:
+    """Token counter of tiktoken if it is installed and has the encoding available locally, else None (estimation never downloads)"""
+    try:
+        import tiktoken
+        encoding_name = tiktoken.encoding_name_for_model(model.value)
+        if not _is_encoding_available(encoding_name):
+            return None
+        encoding = tiktoken.get_encoding(encoding_name)
+    except Exception:
+        return None
+    return lambda text: len(encoding.encode(text))
+
+
+class TokenEstimator:
+    """
+    Estimates the prompt and completion tokens of a PromptWrapper before it is sent, without any API call.
+
+    Prompt tokens are counted with tiktoken if available (OpenAI models only), otherwise from the number of characters.
+    The characters per token ratio and the completion tokens are calibrated with previous Responses:
+    completion tokens are averaged per model and output structure, falling back to the model and then to a default.
+    """
+
+    def __init__(self, responses: Iterable[Response] = (), use_tokenizer: bool = True, default_completion_tokens: int = DEFAULT_COMPLETION_TOKENS):
+        self.use_tokenizer = use_tokenizer
+        self.default_completion_tokens = default_completion_tokens
+        self._tokenizers: dict[LlmName, Optional[Callable[[str], int]]] = {}
+        # model -> [prompt tokens, prompt characters]
+        self._prompt_calibration: dict[LlmName, list[int]] = {}
+        # key -> [completion tokens, count], the key is (model, output_structure) or model
+        self._completion_history: dict[object, list[int]] = {}
+        for response in responses:
+            self.add_response(response)
+
+    def add_response(self, response: Response):
+        model = response.llm_identifier
+        if response.prompt_tokens and response.shared_first_turn is None:
+            # Every turn sends all previous messages again
+            characters = 0
+            sent_characters = 0
+            for message in response.unparsed_messages:
+                characters += len(message.content)
+                if message.role == LlmMessageRole.SYSTEM:
+                    sent_characters += characters
+            calibration = self._prompt_calibration.setdefault(model, [0, 0])
+            calibration[0] += response.prompt_tokens
+            calibration[1] += sent_characters
+        if response.completion_tokens is not None and response.shared_first_turn is None:
+            for key in [(model, response.wrapped_prompt.output_structure), model]:
+                history = self._completion_history.setdefault(key, [0, 0])
+                history[0] += response.completion_tokens
+                history[1] += 1
+
+    def get_characters_per_token(self, model: LlmName) -> float:
+        calibration = self._prompt_calibration.get(model)
+        if not calibration or not calibration[0]:
+            return DEFAULT_CHARACTERS_PER_TOKEN
+        return calibration[1] / calibration[0]
+
+    def count_tokens(self, text: str, model: LlmName) -> int:
+        if self.use_tokenizer:
+            if model not in self._tokenizers:
+                self._tokenizers[model] = _get_tokenizer(model)
+            tokenizer = self._tokenizers[model]
+            if tokenizer:
+                return tokenizer(text)
+        return int(len(text) / self.get_characters_per_token(model)) + 1
+
+    def estimate_completion_tokens(self, wrapped_prompt: PromptWrapper, model: LlmName) -> int:
+        for key in [(model, wrapped_prompt.output_structure), model]:
+            history = self._completion_history.get(key)
+            if history and history[1]:
+                return round(history[0] / history[1])
+        return self.default_completion_tokens
+
+    def estimate(self, wrapped_prompt: PromptWrapper, model: LlmName) -> tuple[int, int]:
+        """(prompt_tokens, completion_tokens) of the whole conversation"""
+        completion_tokens = self.estimate_completion_tokens(wrapped_prompt, model)
+        prompts = wrapped_prompt.prompts
+        # The completion tokens are assumed to be split evenly between the turns
+        completion_tokens_per_turn = completion_tokens / len(prompts)
+        prompt_tokens = 0
+        history_tokens = 0
+        for prompt in prompts:
+            history_tokens += self.count_tokens(prompt, model) + MESSAGE_OVERHEAD_TOKENS
+            prompt_tokens += history_tokens
+            history_tokens += completion_tokens_per_turn + MESSAGE_OVERHEAD_TOKENS
+        return round(prompt_tokens), completion_tokens
+
+
+class RunEstimate:
+    def __init__(self, model: LlmName, requests: int, prompts: int, prompt_tokens: int, completion_tokens: int, cost: float, duration_seconds: float):
+        self.model = model
+        self.requests = requests
+        self.prompts = prompts
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cost = cost
+        self.duration_seconds = duration_seconds
+
+    def to_dict(self):
+        return {
+            "model": self.model.value,
+            "requests": self.requests,
+            "prompts": self.prompts,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": self.cost,
+            "duration_seconds": self.duration_seconds,
+        }
+
+    def __str__(self):
+        return (
+            f"{self.prompts} prompts ({self.requests} requests) with {self.model.value}: "
+            f"~{self.prompt_tokens} prompt + {self.completion_tokens} completion tokens, "
+            f"~${self.cost:.2f}, ~{self.duration_seconds / 60:.1f} min"
+        )
+
+
+def estimate_run(
+    wrapped_prompts: Iterable[PromptWrapper],
+    model: LlmName,
+    estimator: Optional[TokenEstimator] = None,
+    rate_limit=None,
+    max_concurrency: int = 8,
+    latency_seconds: float = 10.0,
+    prices: Optional[dict[LlmName, ModelPrice]] = None,
+) -> RunEstimate:
+    """
+    Project tokens, cost (without prompt caching) and wall-clock time of querying `wrapped_prompts` before the run.
+    The duration is the slower of the rate limits (RateLimit, default: default_rate_limits of the provider)
+    and `max_concurrency` parallel requests taking `latency_seconds` each.
+    """
+    # Imported here as async_query depends on this module
+    from .async_query import default_rate_limits
+
+    estimator = estimator or TokenEstimator()
+    rate_limit = rate_limit or default_rate_limits[model.provider]
+    price = (prices or model_prices)[model]
+
+    prompts = 0
+    requests = 0
+    prompt_tokens = 0
+    completion_tokens = 0
+    for wrapped_prompt in wrapped_prompts:
+        estimated_prompt_tokens, estimated_completion_tokens = estimator.estimate(wrapped_prompt, model)
+        prompts += 1
+        requests += len(wrapped_prompt.prompts)
+        prompt_tokens += estimated_prompt_tokens
+        completion_tokens += estimated_completion_tokens
+
+    duration_seconds = requests * latency_seconds / max_concurrency
+    if rate_limit.requests_per_minute:
+        duration_seconds = max(duration_seconds, requests / rate_limit.requests_per_minute * 60)
+    if rate_limit.tokens_per_minute:
+        duration_seconds = max(duration_seconds, (prompt_tokens + completion_tokens) / rate_limit.tokens_per_minute * 60)
+
+    return RunEstimate(
+        model=model,
+        requests=requests,
+        prompts=prompts,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cost=price.get_cost(prompt_tokens, completion_tokens),
+        duration_seconds=duration_seconds,
+    )
+
+
+class TokenBudget:
+    """
+    Hard limits on the tokens and/or the cost (USD) of a run, shared by all concurrent queries.
+    Before a PromptWrapper is queried, its estimated usage is reserved, once the Response arrives the reservation is
+    replaced by the real usage. A query whose reservation does not fit into the remaining budget raises BudgetExceededError,
+    so the run stops before the budget is exceeded (up to the estimation error).
+    """
+
+    def __init__(
+        self,
+        max_tokens: Optional[int] = None,
+        max_cost: Optional[float] = None,
+        estimator: Optional[TokenEstimator] = None,
+        prices: Optional[dict[LlmName, ModelPrice]] = None,
+    ):
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.estimator = estimator or TokenEstimator()
+        self.prices = prices or model_prices
+        self.used_tokens = 0
+        self.used_cost = 0.0
+        self._reserved_tokens = 0
+        self._reserved_cost = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, wrapped_prompt: PromptWrapper, model: LlmName) -> tuple[int, float]:
+        prompt_tokens, completion_tokens = self.estimator.estimate(wrapped_prompt, model)
+        tokens = prompt_tokens + completion_tokens
+        cost = self.prices[model].get_cost(prompt_tokens, completion_tokens)
+        with self._lock:
+            if self.max_tokens is not None and self.used_tokens + self._reserved_tokens + tokens > self.max_tokens:
+                raise BudgetExceededError(f"Token budget of {self.max_tokens} reached ({self.used_tokens} used)")
+            if self.max_cost is not None and self.used_cost + self._reserved_cost + cost > self.max_cost:
+                raise BudgetExceededError(f"Cost budget of ${self.max_cost:.2f} reached (${self.used_cost:.2f} used)")
+            self._reserved_tokens += tokens
+            self._reserved_cost += cost
+        return tokens, cost
+
+    def settle(self, reservation: tuple[int, float], model: LlmName, response: Optional[Response]):
+        """
+        Replace a reservation by the usage of the Response. Without a Response (failed query) the estimate is kept as used.
+        Only the requests sent to the provider are charged (Response.request_usage), turns answered by the ResponseCache are free.
+        """
+        tokens, cost = reservation
+        if response is not None and response.request_usage is not None:
+            prompt_tokens, completion_tokens, cached_tokens = response.request_usage
+            tokens = prompt_tokens + completion_tokens
+            cost = self.prices[model].get_cost(prompt_tokens, completion_tokens, cached_tokens or 0)
+        elif response is not None and response.prompt_tokens is not None and response.completion_tokens is not None:
+            tokens = response.prompt_tokens + response.completion_tokens
+            cost = self.prices[model].get_cost(response.prompt_tokens, response.completion_tokens, response.cached_tokens or 0)
+        with self._lock:
+            self._reserved_tokens -= reservation[0]
+            self._reserved_cost -= reservation[1]
+            self.used_tokens += tokens
+            self.used_cost += cost
+
+    def to_dict(self):
+        return {
+            "max_tokens": self.max_tokens,
+            "max_cost": self.max_cost,
+            "used_tokens": self.used_tokens,
+            "used_cost": self.used_cost,
+        }
+
+
+def budgeted_query_function(
+    query_function: Callable[[str, PromptWrapper, LlmName], Response],
+    budget: TokenBudget,
+) -> Callable[[str, PromptWrapper, LlmName], Response]:
+    """Wrap a query function (e.g. query_openai_api) to respect `budget`, e.g. for run_batch or run_adaptive_sampling."""
+
+    def query(api_key: str, wrapped_prompt: PromptWrapper, model: LlmName) -> Response:
+        reservation = budget.reserve(wrapped_prompt, model)
+        response = None
+        try:
+            response = query_function(api_key, wrapped_prompt, model)
+            return response
+        finally:
+            budget.settle(reservation, model, response)
+
+    return query
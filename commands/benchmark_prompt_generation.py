@@ -0,0 +1,53 @@
+import hashlib
+import time
+
+from library import prompt_factory
+from library.dilemma_wrapper import dilemmas
+from library.prompt_factory import get_all_possible_prompts, get_possible_prompt_count
+
+
+def render_all_prompts() -> str:
+    """Generate and render the full prompt space, returns a hash of all prompt texts."""
+    prompt_hash = hashlib.sha1()
+    for wrapped_prompt in get_all_possible_prompts():
+        for prompt in wrapped_prompt.prompts:
+            prompt_hash.update(prompt.encode("utf-8"))
+    return prompt_hash.hexdigest()
+
+
+def time_render_all_prompts(repeat: int) -> tuple[float, str]:
+    """Best time out of `repeat` runs, every run starts with empty caches."""
+    best = float("inf")
+    for _ in range(repeat):
+        prompt_factory.get_rendered_prompts.cache_clear()
+        if hasattr(prompt_factory.get_structure_prompt, "cache_clear"):
+            prompt_factory.get_structure_prompt.cache_clear()
+        start = time.perf_counter()
+        prompt_hash = render_all_prompts()
+        best = min(best, time.perf_counter() - start)
+    return best, prompt_hash
+
+
+def benchmark_prompt_generation(repeat: int = 3):
+    print(f"{len(dilemmas)} dilemmas, {get_possible_prompt_count()} prompts")
+
+    # Baseline: the structure prompt is built again for every prompt
+    memoized_get_structure_prompt = prompt_factory.get_structure_prompt
+    prompt_factory.get_structure_prompt = prompt_factory.create_structure_prompt
+    try:
+        baseline_time, baseline_hash = time_render_all_prompts(repeat)
+    finally:
+        prompt_factory.get_structure_prompt = memoized_get_structure_prompt
+
+    memoized_time, memoized_hash = time_render_all_prompts(repeat)
+
+    if baseline_hash != memoized_hash:
+        raise Exception("The memoized structure prompts differ from the rendered ones")
+
+    print(f"Without structure prompt table: {baseline_time:.2f}s")
+    print(f"With structure prompt table:    {memoized_time:.2f}s ({prompt_factory.get_structure_prompt.cache_info().currsize} structure prompts)")
+    print(f"Speed-up: {baseline_time / memoized_time:.2f}x")
+
+
+if __name__ == '__main__':
+    benchmark_prompt_generation()
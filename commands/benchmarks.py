@@ -0,0 +1,268 @@
+"""
+Benchmark suite for prompt generation, serialization, loading and analysis.
+
+    python -m library.commands.benchmarks --output baseline.json
+    python -m library.commands.benchmarks --compare baseline.json
+
+Every benchmark is timed (best of --repeat runs) and, unless --no-memory is given, run once more under tracemalloc
+for its peak memory. The response benchmarks use synthetic datasets of --sizes responses, written compact
+(every distinct prompt text is stored once), as the full texts of 1M responses would take several GB.
+Loading a file with the full texts embedded in every response is measured for the sizes up to MAX_FULL_TEXT_SIZE.
+With --compare the results are compared to a saved baseline and the exit code is 1 if any benchmark regressed.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+from library import prompt_factory
+from library.commands.benchmark_prompt_generation import render_all_prompts
+from library.dilemma_wrapper import dilemmas
+from library.prompt_factory import base_prompts, construct_prompts, ethical_frameworks, get_all_possible_prompts
+from library.prompt_wrapper import *
+from library.prompts_json import generate_prompt_json, generate_response_json, generate_response_jsonl, load_prompts_from_json, load_responses_from_json
+from library.version import VERSION
+
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+# Relative slowdown (or memory growth) that counts as a regression
+DEFAULT_THRESHOLD = 0.2
+# Smaller slowdowns are timer noise
+MIN_REGRESSION_SECONDS = 0.01
+# Largest dataset that is also written with the full prompt texts of every response
+MAX_FULL_TEXT_SIZE = 100_000
+
+
+class BenchmarkResult:
+    def __init__(self, name: str, size: int, seconds: float, peak_memory_bytes: Optional[int] = None):
+        self.name = name
+        self.size = size
+        self.seconds = seconds
+        self.peak_memory_bytes = peak_memory_bytes
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "size": self.size,
+            "seconds": self.seconds,
+            "peak_memory_bytes": self.peak_memory_bytes,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            name=data["name"],
+            size=data["size"],
+            seconds=data["seconds"],
+            peak_memory_bytes=data.get("peak_memory_bytes"),
+        )
+
+    def __str__(self):
+        memory = f"{self.peak_memory_bytes / 1024 ** 2:10.1f} MB" if self.peak_memory_bytes is not None else ""
+        return f"{self.name:45} {self.size:>9} {self.seconds:9.3f}s {self.seconds / self.size * 1e6:9.2f}us/item {memory}"
+
+
+def measure(
+    name: str,
+    size: int,
+    run: Callable[[], object],
+    setup: Optional[Callable[[], None]] = None,
+    repeat: int = 3,
+    memory: bool = True,
+) -> BenchmarkResult:
+    """Best time of `repeat` calls of `run` (after `setup`, which is not timed), then the peak memory of one more call."""
+    best = float("inf")
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        res = run()
+        best = min(best, time.perf_counter() - start)
+        del res
+
+    peak_memory_bytes = None
+    if memory:
+        if setup:
+            setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            res = run()
+            peak_memory_bytes = tracemalloc.get_traced_memory()[1]
+            del res
+        finally:
+            tracemalloc.stop()
+
+    result = BenchmarkResult(name, size, best, peak_memory_bytes)
+    print(result)
+    return result
+
+
+def clear_prompt_caches():
+    prompt_factory.get_rendered_prompts.cache_clear()
+    prompt_factory.get_structure_prompt.cache_clear()
+
+
+def construct_all_prompts() -> list[PromptWrapper]:
+    res = []
+    for base_prompt_identifier in base_prompts.keys():
+        for dilemma in dilemmas:
+            for ethical_framework_identifier in ethical_frameworks.keys():
+                res += construct_prompts(dilemma.identifier, ethical_framework_identifier, base_prompt_identifier)
+    return res
+
+
+def create_synthetic_responses(prompts: list[PromptWrapper], size: int, seed: int = 0) -> list[Response]:
+    """`size` responses to the prompts (in turn) with random decisions, models and token counts"""
+    rng = random.Random(seed)
+    decisions = list(DecisionOption)
+    models = list(LlmName)
+    responses = []
+    for i in range(size):
+        wrapped_prompt = prompts[i % len(prompts)]
+        decision = rng.choice(decisions)
+        parsed_response = {"decision": decision.value, "decision_reason": "The consequences outweigh the duties."}
+        assistant_messages = ["Free text answer of the first turn."] * (len(wrapped_prompt.prompts) - 1) + [json.dumps(parsed_response)]
+        responses.append(Response(
+            wrapped_prompt=wrapped_prompt,
+            decision=decision,
+            llm_identifier=rng.choice(models),
+            unparsed_messages=None,
+            parsed_response=parsed_response,
+            prompt_tokens=rng.randint(300, 1500),
+            completion_tokens=rng.randint(10, 400),
+            assistant_messages=assistant_messages,
+        ))
+    return responses
+
+
+def run_benchmarks(sizes: tuple[int, ...] = DEFAULT_SIZES, repeat: int = 3, memory: bool = True, directory: Optional[str] = None) -> list[BenchmarkResult]:
+    results = []
+    with tempfile.TemporaryDirectory(dir=directory) as temporary_directory:
+        prompts = get_all_possible_prompts()
+        prompt_count = len(prompts)
+
+        results.append(measure("get_all_possible_prompts", prompt_count, get_all_possible_prompts, repeat=repeat, memory=memory))
+        results.append(measure("construct_prompts", prompt_count, construct_all_prompts, repeat=repeat, memory=memory))
+        results.append(measure("render_prompts", prompt_count, render_all_prompts, clear_prompt_caches, repeat=repeat, memory=memory))
+
+        prompts_path = os.path.join(temporary_directory, "prompts.json")
+        results.append(measure(
+            "generate_prompt_json", prompt_count,
+            lambda: generate_prompt_json(prompts, prompts_path, logging=False),
+            repeat=repeat, memory=memory,
+        ))
+        results.append(measure("load_prompts_from_json", prompt_count, lambda: load_prompts_from_json(prompts_path), repeat=repeat, memory=memory))
+        os.remove(prompts_path)
+
+        for size in sizes:
+            responses_path = os.path.join(temporary_directory, f"responses_{size}.json")
+            normalized_path = os.path.join(temporary_directory, f"responses_{size}_normalized.jsonl")
+            full_text_path = os.path.join(temporary_directory, f"responses_{size}_full_text.json")
+            responses = create_synthetic_responses(prompts, size)
+            if size <= MAX_FULL_TEXT_SIZE:
+                generate_response_json(responses, full_text_path, logging=False)
+            results.append(measure(
+                "generate_response_json", size,
+                lambda: generate_response_json(responses, responses_path, logging=False, compact=True),
+                repeat=repeat, memory=memory,
+            ))
+            results.append(measure(
+                "generate_response_jsonl_normalized", size,
+                lambda: generate_response_jsonl(responses, normalized_path, logging=False, normalized=True),
+                repeat=repeat, memory=memory,
+            ))
+            del responses
+            gc.collect()
+
+            results.append(measure("load_responses_normalized", size, lambda: load_responses_from_json(normalized_path), repeat=repeat, memory=memory))
+            os.remove(normalized_path)
+
+            if size <= MAX_FULL_TEXT_SIZE:
+                results.append(measure("load_responses_full_text", size, lambda: load_responses_from_json(full_text_path), repeat=repeat, memory=memory))
+                os.remove(full_text_path)
+
+            results.append(measure("load_responses_from_json", size, lambda: load_responses_from_json(responses_path), repeat=repeat, memory=memory))
+            responses = load_responses_from_json(responses_path)
+            os.remove(responses_path)
+            results.append(measure("to_analysis_dict", size, lambda: [response.to_analysis_dict() for response in responses], repeat=repeat, memory=memory))
+            results.append(measure("normalized_decision", size, lambda: [response.normalized_decision for response in responses], repeat=repeat, memory=memory))
+            del responses
+            gc.collect()
+    return results
+
+
+def get_environment() -> dict:
+    return {
+        "version": VERSION,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def save_results(results: list[BenchmarkResult], path: str):
+    with open(path, "w") as f:
+        json.dump({"environment": get_environment(), "results": [result.to_dict() for result in results]}, f, indent=4)
+    print(f"Benchmark results written to {path}")
+
+
+def load_results(path: str) -> list[BenchmarkResult]:
+    with open(path) as f:
+        return [BenchmarkResult.from_dict(item) for item in json.load(f)["results"]]
+
+
+def compare_results(results: list[BenchmarkResult], baseline: list[BenchmarkResult], threshold: float = DEFAULT_THRESHOLD) -> list[str]:
+    """Print the changes against `baseline` and return the names of the regressed benchmarks"""
+    baseline_results = {(result.name, result.size): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_results.get((result.name, result.size))
+        if base is None:
+            print(f"{result.name:45} {result.size:>9} (no baseline)")
+            continue
+        time_ratio = result.seconds / base.seconds if base.seconds else 1.0
+        flags = []
+        if time_ratio > 1 + threshold and result.seconds - base.seconds > MIN_REGRESSION_SECONDS:
+            flags.append("SLOWER")
+        memory_change = ""
+        if result.peak_memory_bytes is not None and base.peak_memory_bytes:
+            memory_ratio = result.peak_memory_bytes / base.peak_memory_bytes
+            memory_change = f" memory {memory_ratio - 1:+7.1%}"
+            if memory_ratio > 1 + threshold:
+                flags.append("MORE MEMORY")
+        if flags:
+            regressions.append(f"{result.name} ({result.size})")
+        print(f"{result.name:45} {result.size:>9} time {time_ratio - 1:+7.1%}{memory_change} {' '.join(flags)}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark prompt generation, serialization, loading and analysis")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="Sizes of the synthetic response datasets")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc runs")
+    parser.add_argument("--output", help="Save the results (e.g. as new baseline)")
+    parser.add_argument("--compare", help="Baseline to compare with, exits with 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Relative change that counts as regression")
+    parser.add_argument("--directory", help="Directory for the temporary files")
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmarks(tuple(args.sizes), args.repeat, not args.no_memory, args.directory)
+    if args.output:
+        save_results(benchmark_results, args.output)
+    if args.compare:
+        regressed = compare_results(benchmark_results, load_results(args.compare), args.threshold)
+        if regressed:
+            print(f"Regressions: {', '.join(regressed)}")
+            sys.exit(1)
+        print("No regressions")
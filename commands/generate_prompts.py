@@ -1,7 +1,6 @@
 import os
 
-from library.prompt_factory import get_all_possible_prompts, base_prompts
-from library.prompt_wrapper import OutputComponentType, PromptWrapper
+from library.prompt_factory import PromptFilter, get_filtered_prompts, get_possible_prompt_count, base_prompts
 from library.prompts_json import generate_prompt_json
 from library.version import VERSION
 
@@ -11,29 +10,26 @@ prompts_folder_path = os.path.join(os.path.dirname(__file__), "../data/prompts")
 
 def generate_promopts_v1_6():
     # Generate wrapped prompts for - v1.6
-    prompts = get_all_possible_prompts()
-    print(f"There are a total of {len(prompts)} prompts before filtering")
+    print(f"There are a total of {get_possible_prompt_count()} prompts before filtering")
     print(f"Performing filtering...")
 
-    # Selected dilemmas
-    prompts: list[PromptWrapper] = [x for x in prompts if x.dilemma.context_identifier in [
-        "child_abuse_prevention",
-        "public_health",
-        "trolley_problem",
-        "surveillance",
-    ]]
-
-    # We found the base_prompt not to have a significant impact, so we will only use base_prompt_1
-    selected_base_prompt = next(iter(base_prompts))
-    prompts: list[PromptWrapper] = [x for x in prompts if x.base_prompt_identifier == selected_base_prompt]
-
-    # Our current dilemmas do not include the LLM as a subject, thus the egoism theory might not applicable
-    # prompts: list[PromptWrapper] = [x for x in prompts if not x.normative_ethical_theory == "ethical_egoism"]
-
-    # This is a newly added variable we do not yet want to test
-    # Previously the prompt always containted the output structure json and description
-    prompts: list[PromptWrapper] = [x for x in prompts if x.prompt_has_output_structure_description is True]
-    prompts: list[PromptWrapper] = [x for x in prompts if x.prompt_has_output_structure_json_schema is True]
+    prompts = get_filtered_prompts(PromptFilter(
+        # Selected dilemmas
+        context_identifiers=[
+            "child_abuse_prevention",
+            "public_health",
+            "trolley_problem",
+            "surveillance",
+        ],
+        # We found the base_prompt not to have a significant impact, so we will only use base_prompt_1
+        base_prompt_identifiers=[next(iter(base_prompts))],
+        # Our current dilemmas do not include the LLM as a subject, thus the egoism theory might not applicable
+        # ethical_framework_identifiers=[x for x in ethical_frameworks.keys() if not x == "ethical_egoism"],
+        # This is a newly added variable we do not yet want to test
+        # Previously the prompt always containted the output structure json and description
+        prompt_has_output_structure_description=True,
+        prompt_has_output_structure_json_schema=True,
+    ))
 
     prompts_file_path = os.path.join(prompts_folder_path, f"wrapped_prompts_v{VERSION}.json")
     generate_prompt_json(prompts, prompts_file_path)
@@ -42,17 +38,16 @@ def generate_promopts_v1_6():
 
 def generate_promopts_v1_7():
     # Generate wrapped prompts for - v1.6
-    prompts = get_all_possible_prompts()
-    print(f"There are a total of {len(prompts)} prompts before filtering")
+    print(f"There are a total of {get_possible_prompt_count()} prompts before filtering")
     print(f"Performing filtering...")
 
     # Selected dilemmas
-    prompts: list[PromptWrapper] = [x for x in prompts if x.dilemma.context_identifier in [
+    selected_context_identifiers = [
         "child_abuse_prevention",
         "public_health",
         "trolley_problem",
         "surveillance",
-    ]]
+    ]
 
     # prompts: list[PromptWrapper] = [x for x in prompts if x.dilemma.identifier in [
     #     # "public_health_1",
@@ -63,18 +58,31 @@ def generate_promopts_v1_7():
     #     # "child_abuse_prevention_4",
     # ]]
     # We found the base_prompt not to have a significant impact, so we will only use base_prompt_1
+    # (except for public_health_1 and public_health_2, which use all base prompts)
     selected_base_prompt = next(iter(base_prompts))
-    prompts: list[PromptWrapper] = [x for x in prompts if x.dilemma.identifier in ["public_health_1", "public_health_2"] or x.base_prompt_identifier == selected_base_prompt]
+    prompt_filters = [
+        PromptFilter(
+            context_identifiers=selected_context_identifiers,
+            base_prompt_identifiers=[selected_base_prompt],
+            # This is a newly added variable we do not yet want to test
+            # Previously the prompt always containted the output structure json and description
+            prompt_has_output_structure_description=True,
+            prompt_has_output_structure_json_schema=True,
+        ),
+        PromptFilter(
+            context_identifiers=selected_context_identifiers,
+            dilemma_identifiers=["public_health_1", "public_health_2"],
+            prompt_has_output_structure_description=True,
+            prompt_has_output_structure_json_schema=True,
+        ),
+    ]
 
     # Our current dilemmas do not include the LLM as a subject, thus the egoism theory might not applicable
-    # prompts: list[PromptWrapper] = [x for x in prompts if not x.normative_ethical_theory == "ethical_egoism"]
+    # Add ethical_framework_identifiers=[x for x in ethical_frameworks.keys() if not x == "ethical_egoism"] to the filters
 
-    # This is a newly added variable we do not yet want to test
-    # Previously the prompt always containted the output structure json and description
-    prompts: list[PromptWrapper] = [x for x in prompts if x.prompt_has_output_structure_description is True]
-    prompts: list[PromptWrapper] = [x for x in prompts if x.prompt_has_output_structure_json_schema is True]
+    # Add has_normative_ethical_theory_explanation=False to the filters to drop the NORMATIVE_ETHICAL_THEORY_EXPLANATION component
 
-    # prompts: list[PromptWrapper] = [x for x in prompts if not x.output_structure.get_has_output_component(OutputComponentType.NORMATIVE_ETHICAL_THEORY_EXPLANATION) is True]
+    prompts = get_filtered_prompts(*prompt_filters)
 
     prompts_file_path = os.path.join(prompts_folder_path, f"wrapped_prompts_v{VERSION}.json")
     generate_prompt_json(prompts, prompts_file_path)
@@ -0,0 +1,45 @@
+"""
+End to end check of run_adaptive_sampling with a ResponseCache against the MockProviderServer.
+
+    python -m library.commands.test_adaptive_sampling
+
+Runs the same adaptive sampling twice, the second run is answered by the ResponseCache and must not report API calls.
+The exit code is 1 if a check fails.
+"""
+import tempfile
+
+from library.adaptive_sampling import SequentialStoppingRule, run_adaptive_sampling
+from library.commands.testing import run_tests
+from library.llm_query import query_api
+from library.mock_server import MockProviderServer, MockServerConfig
+from library.prompt_factory import PromptFilter
+from library.prompt_wrapper import *
+from library.provider_client import ProviderClient
+from library.response_cache import ResponseCache
+
+
+def test_cache_hits_are_no_api_calls():
+    stopping_rule = SequentialStoppingRule(min_per_cell=2, check_every=2, max_per_cell=4)
+    prompt_filter = PromptFilter(context_identifiers=["trolley_problem"])
+    with tempfile.TemporaryDirectory() as directory, MockProviderServer(MockServerConfig(seed=0)) as server:
+        client = ProviderClient(LlmProvider.OPENAI, "mock", base_url=server.base_url)
+        cache = ResponseCache(directory)
+
+        def query(api_key: str, wrapped_prompt: PromptWrapper, model: LlmName) -> Response:
+            return query_api(client, wrapped_prompt, model, cache)
+
+        responses, report = run_adaptive_sampling("mock", query, [LlmName.GPT4O], stopping_rule, prompt_filter, seed=0)
+        # Prompts sharing their first turn get it from the cache already in the first run
+        assert report.api_calls == server.get_stats()["completions"]
+
+        resumed_responses, resumed_report = run_adaptive_sampling("mock", query, [LlmName.GPT4O], stopping_rule, prompt_filter, seed=0)
+        assert len(resumed_responses) == len(responses)
+        assert resumed_report.api_calls == 0
+        assert resumed_report.api_calls_avoided == report.api_calls_avoided
+
+
+tests = [test_cache_hits_are_no_api_calls]
+
+
+if __name__ == "__main__":
+    run_tests(tests)
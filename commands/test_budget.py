@@ -0,0 +1,45 @@
+"""
+End to end check of the TokenBudget with a ResponseCache against the MockProviderServer.
+
+    python -m library.commands.test_budget
+
+Queries the same prompts twice through budgeted_query_function, the second run is answered by the ResponseCache
+and must not be charged. The exit code is 1 if a check fails.
+"""
+import tempfile
+
+from library.budget import TokenBudget, TokenEstimator, budgeted_query_function
+from library.commands.testing import run_tests
+from library.llm_query import query_api
+from library.mock_server import MockProviderServer, MockServerConfig
+from library.prompt_space import PromptSpace
+from library.prompt_wrapper import *
+from library.provider_client import ProviderClient
+from library.response_cache import ResponseCache
+
+
+def test_cache_hits_are_not_charged():
+    wrapped_prompts = PromptSpace().sample(5, seed=0)
+    budget = TokenBudget(max_tokens=10 ** 7, estimator=TokenEstimator(use_tokenizer=False))
+    with tempfile.TemporaryDirectory() as directory, MockProviderServer(MockServerConfig(seed=0)) as server:
+        client = ProviderClient(LlmProvider.OPENAI, "mock", base_url=server.base_url)
+        cache = ResponseCache(directory)
+        query = budgeted_query_function(lambda api_key, wrapped_prompt, model: query_api(client, wrapped_prompt, model, cache), budget)
+
+        responses = [query("mock", wrapped_prompt, LlmName.GPT4O) for wrapped_prompt in wrapped_prompts]
+        used_tokens = budget.used_tokens
+        assert used_tokens == sum(response.prompt_tokens + response.completion_tokens for response in responses)
+        assert all(response.requests == len(response.wrapped_prompt.prompts) for response in responses)
+
+        cached_responses = [query("mock", wrapped_prompt, LlmName.GPT4O) for wrapped_prompt in wrapped_prompts]
+        assert all(response.requests == 0 for response in cached_responses)
+        # The token counts of the cached turns are kept, but not charged again
+        assert [response.prompt_tokens for response in cached_responses] == [response.prompt_tokens for response in responses]
+        assert budget.used_tokens == used_tokens
+
+
+tests = [test_cache_hits_are_not_charged]
+
+
+if __name__ == "__main__":
+    run_tests(tests)
@@ -0,0 +1,65 @@
+"""
+Checks of the lazily loaded DilemmaRegistry.
+
+    python -m library.commands.test_dilemma_registry
+"""
+import json
+import os
+import tempfile
+
+from library.commands.testing import run_tests
+from library.dilemma_wrapper import DilemmaRegistry, DilemmaWrapper, dilemmas, get_dilemma
+
+
+def write_dilemma_file(directory: str, name: str, identifiers: list[str]) -> str:
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        json.dump([DilemmaWrapper(identifier, "description", "context", "type").to_dict() for identifier in identifiers], f)
+    return path
+
+
+def test_duplicate_keeps_file_pending():
+    with tempfile.TemporaryDirectory() as directory:
+        registry = DilemmaRegistry([DilemmaWrapper("b", "description", "context", "type")])
+        path = write_dilemma_file(directory, "dilemmas.json", ["a", "b", "c"])
+        registry.add_data_file(path)
+        try:
+            registry.get("c")
+            raise AssertionError("The duplicate was not reported")
+        except ValueError as e:
+            assert "Duplicate" in str(e)
+        # Nothing of the file is registered, after fixing it all of its dilemmas are available
+        assert "a" not in registry._by_identifier
+        write_dilemma_file(directory, "dilemmas.json", ["a", "c"])
+        assert registry.get("a").identifier == "a" and registry.get("c").identifier == "c"
+
+
+def test_contains_raises_load_errors():
+    with tempfile.TemporaryDirectory() as directory:
+        registry = DilemmaRegistry()
+        path = os.path.join(directory, "dilemmas.json")
+        with open(path, "w") as f:
+            f.write("[{")
+        registry.add_data_file(path)
+        try:
+            "a" in registry
+            raise AssertionError("The malformed file was not reported")
+        except json.JSONDecodeError:
+            pass
+        write_dilemma_file(directory, "dilemmas.json", ["a"])
+        assert "a" in registry and "b" not in registry
+
+
+def test_appended_dilemmas_are_found():
+    dilemmas.append(DilemmaWrapper("appended_dilemma", "description", "context", "type"))
+    try:
+        assert get_dilemma("appended_dilemma").description == "description"
+    finally:
+        dilemmas.pop()
+
+
+tests = [test_duplicate_keeps_file_pending, test_contains_raises_load_errors, test_appended_dilemmas_are_found]
+
+
+if __name__ == "__main__":
+    run_tests(tests)
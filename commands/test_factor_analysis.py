@@ -0,0 +1,41 @@
+"""
+Checks of factor_analysis on synthetic responses.
+
+    python -m library.commands.test_factor_analysis
+"""
+import random
+
+from library.commands.testing import run_tests
+from library.factor_analysis import get_factors
+from library.prompt_space import PromptSpace
+from library.prompt_wrapper import *
+from library.response_table import ResponseTable
+
+
+def create_responses(seed: int = 0) -> list[Response]:
+    """Responses with random decisions, token counts and retries"""
+    rng = random.Random(seed)
+    return [
+        Response(
+            wrapped_prompt, rng.choice(list(DecisionOption)), LlmName.GPT4O, None, {},
+            prompt_tokens=rng.randint(300, 1500), completion_tokens=rng.randint(10, 400), cached_tokens=rng.choice([0, 1024]),
+            assistant_messages=[], retries=rng.randint(0, 3),
+        )
+        for wrapped_prompt in PromptSpace().sample(200, seed=seed)
+    ]
+
+
+def test_get_factors_excludes_usage_columns():
+    table = ResponseTable.from_responses(create_responses())
+    factors = get_factors(table)
+    assert "wrapped_prompt.dilemma_identifier" in factors
+    for name in ["retries", "prompt_tokens", "completion_tokens", "cached_tokens"]:
+        assert name in table.columns
+        assert name not in factors, name
+
+
+tests = [test_get_factors_excludes_usage_columns]
+
+
+if __name__ == "__main__":
+    run_tests(tests)
@@ -0,0 +1,55 @@
+"""
+End to end check of openai_batch against the Batch API endpoints of the MockProviderServer.
+
+    python -m library.commands.test_openai_batch
+
+Runs a chained batch over one and two turn prompts (first_unstructured_output) and a batch that expires
+with part of its requests unanswered. The exit code is 1 if a check fails.
+"""
+from library.commands.testing import run_tests
+from library.mock_server import MockProviderServer, MockServerConfig
+from library.openai_batch import query_prompts_batch
+from library.prompt_space import PromptSpace
+from library.prompt_wrapper import *
+from library.provider_client import ProviderClient
+
+
+def get_test_prompts() -> list[PromptWrapper]:
+    """Two prompts with one turn and two with two turns"""
+    return PromptSpace().stratified_sample(2, ["first_unstructured_output"], seed=0)
+
+
+def test_two_turn_chained_batch():
+    wrapped_prompts = get_test_prompts()
+    with MockProviderServer(MockServerConfig(seed=0)) as server:
+        client = ProviderClient(LlmProvider.OPENAI, "mock", base_url=server.base_url)
+        responses = query_prompts_batch("mock", wrapped_prompts, client=client, poll_interval=0)
+        stats = server.get_stats()
+
+    assert len(responses) == len(wrapped_prompts)
+    for wrapped_prompt, response in zip(wrapped_prompts, responses):
+        assert not isinstance(response, Exception), response
+        assert response.wrapped_prompt is wrapped_prompt
+        assert [message.role for message in response.unparsed_messages].count(LlmMessageRole.ASSISSANT) == len(wrapped_prompt.prompts)
+        assert response.decision in DecisionOption
+    # One batch per turn, the second one only holds the two turn prompts
+    assert stats["completions"] == sum(len(wrapped_prompt.prompts) for wrapped_prompt in wrapped_prompts)
+
+
+def test_expired_batch_keeps_partial_results():
+    wrapped_prompts = PromptSpace().restrict("first_unstructured_output", False).sample(20, seed=0)
+    with MockProviderServer(MockServerConfig(batch_expired_rate=0.5, seed=0)) as server:
+        client = ProviderClient(LlmProvider.OPENAI, "mock", base_url=server.base_url)
+        responses = query_prompts_batch("mock", wrapped_prompts, client=client, poll_interval=0)
+
+    assert len(responses) == len(wrapped_prompts)
+    failed = [response for response in responses if isinstance(response, Exception)]
+    assert 0 < len(failed) < len(responses), "Expected both answered and expired requests"
+    assert all("batch_expired" in str(response) for response in failed)
+
+
+tests = [test_two_turn_chained_batch, test_expired_batch_keeps_partial_results]
+
+
+if __name__ == "__main__":
+    run_tests(tests)
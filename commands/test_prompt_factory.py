@@ -0,0 +1,31 @@
+"""
+Checks of the filtered prompt generation.
+
+    python -m library.commands.test_prompt_factory
+"""
+from library.commands.testing import run_tests
+from library.dilemma_wrapper import dilemmas
+from library.prompt_factory import PromptFilter, get_all_possible_prompts, get_filtered_prompts
+
+
+def test_no_filters_return_all_prompts():
+    all_prompts = get_all_possible_prompts()
+    prompts = get_filtered_prompts()
+    assert len(prompts) == len(all_prompts)
+    assert [prompt._id for prompt in prompts[::1000]] == [prompt._id for prompt in all_prompts[::1000]]
+
+
+def test_filter_matches_filtered_enumeration():
+    prompt_filter = PromptFilter(dilemma_identifiers=[dilemmas[0].identifier], first_unstructured_output=True)
+    expected = [
+        prompt._id for prompt in get_all_possible_prompts()
+        if prompt.dilemma_identifier == dilemmas[0].identifier and prompt.output_structure.first_unstructured_output
+    ]
+    assert [prompt._id for prompt in get_filtered_prompts(prompt_filter)] == expected
+
+
+tests = [test_no_filters_return_all_prompts, test_filter_matches_filtered_enumeration]
+
+
+if __name__ == "__main__":
+    run_tests(tests)
@@ -0,0 +1,18 @@
+"""Runner for the end to end checks in commands/test_*.py, which can also be collected by pytest."""
+import sys
+import traceback
+from typing import Callable
+
+
+def run_tests(tests: list[Callable[[], None]]):
+    """Run every test, print its outcome and exit with 1 if any of them failed."""
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"{test.__name__}: ok")
+        except Exception:
+            failures += 1
+            print(f"{test.__name__}: FAILED")
+            traceback.print_exc()
+    sys.exit(1 if failures else 0)
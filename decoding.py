@@ -0,0 +1,173 @@
+"""
+Fast decoding of prompt and response files into PromptWrapper and Response objects.
+
+The generic from_dict methods look up every enum member through Enum.__call__ and resolve the legacy keys of older
+files (framework_identifier, id) with dict.get fallbacks for every record. The decoders here map enum values through
+precomputed tables, reuse the interned OutputStructure of every distinct structure and detect the legacy keys from the
+first record of a file (a FileSchema), so the records after it are decoded with plain lookups.
+Records that do not match the detected schema fall back to the generic from_dict.
+
+JSON is parsed with orjson if it is installed (`pip install orjson`), otherwise with the json module of the standard library.
+"""
+import gc
+import json
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+from .prompt_wrapper import *
+
+
+def _import_orjson():
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+def get_json_loads() -> Callable[[bytes], object]:
+    """orjson.loads if orjson is installed, else json.loads, both accept bytes"""
+    orjson = _import_orjson()
+    return orjson.loads if orjson is not None else json.loads
+
+
+def get_json_dumps() -> Callable[[object], str]:
+    """Compact json.dumps, through orjson if it is installed"""
+    orjson = _import_orjson()
+    if orjson is None:
+        return json.dumps
+    return lambda data: orjson.dumps(data).decode()
+
+
+@contextmanager
+def paused_gc() -> Iterator[None]:
+    """
+    Disable the cyclic garbage collector while many objects are created and kept (e.g. loading a whole file).
+    Otherwise every few hundred allocations trigger a collection that traverses the already loaded objects again.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+decision_options = {option.value: option for option in DecisionOption}
+output_component_types = {component.value: component for component in OutputComponentType}
+llm_names = {llm_name.value: llm_name for llm_name in LlmName}
+llm_message_roles = {role.value: role for role in LlmMessageRole}
+
+
+class FileSchema:
+    """The keys a file uses for the fields that were renamed or added since version 1.5."""
+
+    def __init__(self, id_key: str = "_id", ethical_framework_key: str = "ethical_framework_identifier", has_output_structure_flags: bool = True):
+        self.id_key = id_key
+        self.ethical_framework_key = ethical_framework_key
+        # Files before the flags were introduced always described the output structure and its JSON schema
+        self.has_output_structure_flags = has_output_structure_flags
+
+    @classmethod
+    def detect(cls, prompt_data: dict) -> "FileSchema":
+        """The schema of a file from one of its PromptWrapper dictionaries"""
+        return cls(
+            id_key="_id" if prompt_data.get("_id") else "id",
+            ethical_framework_key="ethical_framework_identifier" if "ethical_framework_identifier" in prompt_data else "framework_identifier",
+            has_output_structure_flags="prompt_has_output_structure_description" in prompt_data,
+        )
+
+
+class PromptDecoder:
+    """
+    Decodes the PromptWrapper dictionaries of one file, the FileSchema is detected from the first one.
+    Same results as PromptWrapper.from_dict.
+    """
+
+    def __init__(self, schema: Optional[FileSchema] = None):
+        self.schema = schema
+        # Texts referenced by the compact dictionaries of the file
+        self.text_table = TextTable()
+        self._output_structures: dict[tuple, OutputStructure] = {}
+
+    def decode_output_structure(self, data: dict) -> OutputStructure:
+        sorted_output_components = data["sorted_output_components"]
+        sorted_decision_options = data["sorted_decision_options"]
+        key = (tuple(sorted_output_components), tuple(sorted_decision_options), data["first_unstructured_output"])
+        output_structure = self._output_structures.get(key)
+        if output_structure is None:
+            output_structure = self._output_structures[key] = OutputStructure(
+                [output_component_types[component] for component in sorted_output_components],
+                [decision_options[option] for option in sorted_decision_options],
+                key[2],
+            )
+        return output_structure
+
+    def decode(self, data: dict) -> PromptWrapper:
+        schema = self.schema
+        if schema is None:
+            schema = self.schema = FileSchema.detect(data)
+        try:
+            if schema.has_output_structure_flags:
+                has_description = data["prompt_has_output_structure_description"]
+                has_json_schema = data["prompt_has_output_structure_json_schema"]
+            else:
+                has_description = has_json_schema = True
+            prompts = data.get("prompts")
+            if prompts is None and "prompt_text_ids" in data:
+                prompts = [self.text_table.get_text(text_id) for text_id in data["prompt_text_ids"]]
+            res = PromptWrapper(
+                prompts,
+                data["dilemma_identifier"],
+                data[schema.ethical_framework_key],
+                data["base_prompt_identifier"],
+                has_description,
+                has_json_schema,
+                self.decode_output_structure(data["output_structure"]),
+                data["version"],
+            )
+            _id = data[schema.id_key]
+        except KeyError:
+            # The record does not match the schema of the file
+            return PromptWrapper.from_dict(data, self.text_table)
+        if not _id:
+            return PromptWrapper.from_dict(data, self.text_table)
+        res._id = _id
+        return res
+
+
+class ResponseDecoder:
+    """
+    Decodes the Response dictionaries of one file (embedded and normalized records, see prompts_json).
+    Same results as Response.from_dict and Response.from_normalized_dict.
+    """
+
+    def __init__(self, prompt_decoder: Optional[PromptDecoder] = None):
+        self.prompt_decoder = prompt_decoder or PromptDecoder()
+
+    def decode(self, data: dict) -> Response:
+        return self.decode_normalized(data, self.prompt_decoder.decode(data["wrapped_prompt"]))
+
+    def decode_normalized(self, data: dict, wrapped_prompt: PromptWrapper) -> Response:
+        unparsed_messages = data.get("unparsed_messages")
+        shared_first_turn = data.get("shared_first_turn")
+        try:
+            return Response(
+                wrapped_prompt,
+                decision_options[data["decision"]],
+                llm_names[data["llm_identifier"]],
+                None if unparsed_messages is None else [
+                    LlmMessage(llm_message_roles[message["role"]], message["content"]) for message in unparsed_messages
+                ],
+                data.get("parsed_response"),
+                data.get("prompt_tokens"),
+                data.get("completion_tokens"),
+                data.get("cached_tokens"),
+                data.get("assistant_messages"),
+                SharedFirstTurn.from_dict(shared_first_turn) if shared_first_turn else None,
+                data.get("retries"),
+            )
+        except KeyError:
+            # Raises the same errors as the generic path
+            return Response.from_normalized_dict(data, wrapped_prompt)
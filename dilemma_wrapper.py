@@ -1,3 +1,7 @@
+import json
+from typing import Iterable, Iterator
+
+
 class DilemmaWrapper():
     def __init__(self, identifier: str, description: str, context_identifier: str, type_identifier: str):
         self.identifier = identifier
@@ -13,6 +17,15 @@ class DilemmaWrapper():
             "type_identifier": self.type_identifier,
         }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            identifier=data["identifier"],
+            description=data["description"],
+            context_identifier=data["context_identifier"],
+            type_identifier=data["type_identifier"],
+        )
+
 
 class InvertableDilemmaWrapper(DilemmaWrapper):
     def __init__(self, identifier: str, description: str, context_identifier: str, type_identifier: str, action_is_inverted: bool):
@@ -27,6 +40,22 @@ class InvertableDilemmaWrapper(DilemmaWrapper):
             "action_is_inverted": self.action_is_inverted,
         }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            identifier=data["identifier"],
+            description=data["description"],
+            context_identifier=data["context_identifier"],
+            type_identifier=data["type_identifier"],
+            action_is_inverted=data["action_is_inverted"],
+        )
+
+
+def dilemma_from_dict(data: dict) -> DilemmaWrapper:
+    if "action_is_inverted" in data:
+        return InvertableDilemmaWrapper.from_dict(data)
+    return DilemmaWrapper.from_dict(data)
+
 
 dilemmas = [
     InvertableDilemmaWrapper('trolley_problem_1',
@@ -160,8 +189,100 @@ Should the group choose to spare the child, even if it endangers their secrecy a
 ]
 
 
+class DilemmaRegistry:
+    """
+    Dilemmas indexed by identifier, context_identifier and type_identifier.
+    Additional dilemma sets can be registered as JSON files (a list of DilemmaWrapper.to_dict() items),
+    they are only read once a lookup needs them. Lists added with add_list are followed, dilemmas appended to them
+    later are registered on the next lookup.
+    """
+
+    def __init__(self, dilemmas: Iterable[DilemmaWrapper] = ()):
+        self._by_identifier: dict[str, DilemmaWrapper] = {}
+        self._by_context_identifier: dict[str, list[DilemmaWrapper]] = {}
+        self._by_type_identifier: dict[str, list[DilemmaWrapper]] = {}
+        self._pending_paths: list[str] = []
+        # (list, number of its dilemmas that are registered already)
+        self._lists: list[tuple[list[DilemmaWrapper], int]] = []
+        for dilemma in dilemmas:
+            self.register(dilemma)
+
+    def register(self, dilemma: DilemmaWrapper):
+        if dilemma.identifier in self._by_identifier:
+            raise ValueError(f"Duplicate dilemma identifier: {dilemma.identifier}")
+        self._by_identifier[dilemma.identifier] = dilemma
+        self._by_context_identifier.setdefault(dilemma.context_identifier, []).append(dilemma)
+        self._by_type_identifier.setdefault(dilemma.type_identifier, []).append(dilemma)
+
+    def add_data_file(self, path: str):
+        """Register a JSON file of dilemmas. It is loaded lazily."""
+        self._pending_paths.append(path)
+
+    def add_list(self, dilemmas: list[DilemmaWrapper]):
+        """Register the dilemmas of a list and the ones appended to it later (lazily)."""
+        self._lists.append((dilemmas, 0))
+
+    def _has_pending(self) -> bool:
+        return bool(self._pending_paths) or any(len(dilemmas) > registered for dilemmas, registered in self._lists)
+
+    def _load_pending(self):
+        for index, (dilemmas, registered) in enumerate(self._lists):
+            while registered < len(dilemmas):
+                self.register(dilemmas[registered])
+                registered += 1
+                self._lists[index] = (dilemmas, registered)
+        while self._pending_paths:
+            # A file that cannot be read or registered completely stays pending, so the next lookup raises again
+            path = self._pending_paths[0]
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            loaded_dilemmas = [dilemma_from_dict(item) for item in data]
+            identifiers = set()
+            for dilemma in loaded_dilemmas:
+                if dilemma.identifier in self._by_identifier or dilemma.identifier in identifiers:
+                    raise ValueError(f"Duplicate dilemma identifier in {path}: {dilemma.identifier}")
+                identifiers.add(dilemma.identifier)
+            self._pending_paths.pop(0)
+            for dilemma in loaded_dilemmas:
+                self.register(dilemma)
+
+    def get(self, identifier: str) -> DilemmaWrapper:
+        res = self._by_identifier.get(identifier)
+        if res is None and self._has_pending():
+            self._load_pending()
+            res = self._by_identifier.get(identifier)
+        if not res:
+            raise ValueError(f"Unknown dilemma identifier: {identifier}")
+        return res
+
+    def get_by_context_identifier(self, context_identifier: str) -> list[DilemmaWrapper]:
+        self._load_pending()
+        return list(self._by_context_identifier.get(context_identifier, []))
+
+    def get_by_type_identifier(self, type_identifier: str) -> list[DilemmaWrapper]:
+        self._load_pending()
+        return list(self._by_type_identifier.get(type_identifier, []))
+
+    def __contains__(self, identifier: str) -> bool:
+        # Errors of loading the pending dilemmas are raised, not taken as a missing identifier
+        if identifier not in self._by_identifier and self._has_pending():
+            self._load_pending()
+        return identifier in self._by_identifier
+
+    def __iter__(self) -> Iterator[DilemmaWrapper]:
+        self._load_pending()
+        return iter(list(self._by_identifier.values()))
+
+    def __len__(self):
+        self._load_pending()
+        return len(self._by_identifier)
+
+
+# Prompt generation only uses the `dilemmas` above, dilemmas loaded into the registry later are available for lookups.
+# Dilemmas appended to `dilemmas` at runtime are registered on the next lookup.
+dilemma_registry = DilemmaRegistry()
+dilemma_registry.add_list(dilemmas)
+
+
 def get_dilemma(identifier: str) -> DilemmaWrapper:
-    res = next((dilemma for dilemma in dilemmas if dilemma.identifier == identifier), None)
-    if not res:
-        raise ValueError(f"Unknown dilemma identifier: {identifier}")
-    return res
+    return dilemma_registry.get(identifier)
@@ -0,0 +1,436 @@
+import sqlite3
+from contextlib import contextmanager
+from enum import Enum
+from typing import Iterable, Iterator, Optional, Union
+
+from .prompt_wrapper import *
+from .decoding import PromptDecoder, ResponseDecoder, get_json_dumps, get_json_loads
+from .dilemma_wrapper import DilemmaWrapper
+from .prompts_json import iter_prompts, iter_responses
+
+
+# Responses and prompts inserted per executemany call
+INGEST_BATCH_SIZE = 10_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS texts (
+    id INTEGER PRIMARY KEY,
+    -- Unique through ExperimentStore._get_text_id, an index on the texts would double their size
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS prompts (
+    id TEXT PRIMARY KEY,
+    dilemma_identifier TEXT NOT NULL,
+    context_identifier TEXT,
+    type_identifier TEXT,
+    ethical_framework_identifier TEXT NOT NULL,
+    base_prompt_identifier TEXT NOT NULL,
+    version TEXT NOT NULL,
+    prompt_has_output_structure_description INTEGER NOT NULL,
+    prompt_has_output_structure_json_schema INTEGER NOT NULL,
+    sorted_output_components TEXT NOT NULL,
+    sorted_decision_options TEXT NOT NULL,
+    first_unstructured_output INTEGER NOT NULL,
+    has_normative_ethical_theory_explanation INTEGER NOT NULL,
+    has_decision_reason INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS responses (
+    id INTEGER PRIMARY KEY,
+    prompt_id TEXT NOT NULL REFERENCES prompts(id),
+    llm_identifier TEXT NOT NULL,
+    decision TEXT NOT NULL,
+    normalized_decision TEXT,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    cached_tokens INTEGER,
+    retries INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prompts_dilemma ON prompts(dilemma_identifier);
+CREATE INDEX IF NOT EXISTS prompts_context ON prompts(context_identifier);
+CREATE INDEX IF NOT EXISTS prompts_framework ON prompts(ethical_framework_identifier);
+CREATE INDEX IF NOT EXISTS prompts_version ON prompts(version);
+CREATE INDEX IF NOT EXISTS prompts_output_structure ON prompts(sorted_output_components, sorted_decision_options, first_unstructured_output);
+CREATE INDEX IF NOT EXISTS responses_prompt ON responses(prompt_id);
+CREATE INDEX IF NOT EXISTS responses_model ON responses(llm_identifier, prompt_id);
+"""
+
+# Columns of query_response_columns, booleans are returned as bool
+response_columns = [
+    "prompt_id",
+    "dilemma_identifier",
+    "context_identifier",
+    "type_identifier",
+    "ethical_framework_identifier",
+    "base_prompt_identifier",
+    "version",
+    "prompt_has_output_structure_description",
+    "prompt_has_output_structure_json_schema",
+    "sorted_output_components",
+    "sorted_decision_options",
+    "first_unstructured_output",
+    "has_normative_ethical_theory_explanation",
+    "has_decision_reason",
+    "llm_identifier",
+    "decision",
+    "normalized_decision",
+    "prompt_tokens",
+    "completion_tokens",
+    "cached_tokens",
+    "retries",
+]
+boolean_columns = {
+    "prompt_has_output_structure_description",
+    "prompt_has_output_structure_json_schema",
+    "first_unstructured_output",
+    "has_normative_ethical_theory_explanation",
+    "has_decision_reason",
+}
+_response_table_columns = {
+    "prompt_id", "llm_identifier", "decision", "normalized_decision", "prompt_tokens", "completion_tokens", "cached_tokens", "retries",
+}
+
+
+def _get_dilemma_or_none(wrapped_prompt: PromptWrapper) -> Optional[DilemmaWrapper]:
+    try:
+        return wrapped_prompt.dilemma
+    except ValueError:
+        # Not registered, see dilemma_wrapper.dilemma_registry
+        return None
+
+
+FilterValues = Optional[Iterable[Union[str, Enum]]]
+
+
+class ExperimentQuery:
+    """
+    Criteria on the stored Responses (the names follow prompt_factory.PromptFilter), None means not restricted.
+    Identifiers can be enum members or strings, strings with * or ? are glob patterns, e.g. "public_health_*".
+    Criteria on the prompt only (everything except llm_identifiers and the decisions) also apply to query_prompts.
+    """
+
+    def __init__(
+        self,
+        dilemma_identifiers: FilterValues = None,
+        context_identifiers: FilterValues = None,
+        type_identifiers: FilterValues = None,
+        ethical_framework_identifiers: FilterValues = None,
+        base_prompt_identifiers: FilterValues = None,
+        versions: FilterValues = None,
+        llm_identifiers: FilterValues = None,
+        decisions: FilterValues = None,
+        normalized_decisions: FilterValues = None,
+        has_normative_ethical_theory_explanation: Optional[bool] = None,
+        has_decision_reason: Optional[bool] = None,
+        first_unstructured_output: Optional[bool] = None,
+        prompt_has_output_structure_description: Optional[bool] = None,
+        prompt_has_output_structure_json_schema: Optional[bool] = None,
+        output_structure: Optional[OutputStructure] = None,
+    ):
+        self.values = {
+            "dilemma_identifier": dilemma_identifiers,
+            "context_identifier": context_identifiers,
+            "type_identifier": type_identifiers,
+            "ethical_framework_identifier": ethical_framework_identifiers,
+            "base_prompt_identifier": base_prompt_identifiers,
+            "version": versions,
+            "llm_identifier": llm_identifiers,
+            "decision": decisions,
+            "normalized_decision": normalized_decisions,
+        }
+        self.flags = {
+            "has_normative_ethical_theory_explanation": has_normative_ethical_theory_explanation,
+            "has_decision_reason": has_decision_reason,
+            "first_unstructured_output": first_unstructured_output,
+            "prompt_has_output_structure_description": prompt_has_output_structure_description,
+            "prompt_has_output_structure_json_schema": prompt_has_output_structure_json_schema,
+        }
+        self.output_structure = output_structure
+
+    def get_where_clause(self, prompts_only: bool = False) -> tuple[str, list]:
+        """SQL condition on the columns of the prompts (p) and responses (r) tables and its parameters"""
+        conditions = []
+        parameters = []
+        for column, values in self.values.items():
+            if values is None:
+                continue
+            if column in _response_table_columns:
+                if prompts_only:
+                    raise ValueError(f"{column} is not a criterion on prompts")
+                column = f"r.{column}"
+            else:
+                column = f"p.{column}"
+            if isinstance(values, (str, Enum)):
+                values = [values]
+            values = [value.value if isinstance(value, Enum) else value for value in values]
+            patterns = [value for value in values if "*" in value or "?" in value or "[" in value]
+            exact_values = [value for value in values if value not in patterns]
+            alternatives = [f"{column} GLOB ?" for _ in patterns]
+            if exact_values:
+                alternatives.append(f"{column} IN ({', '.join('?' * len(exact_values))})")
+            conditions.append(f"({' OR '.join(alternatives)})" if alternatives else "0")
+            parameters += patterns + exact_values
+        for column, flag in self.flags.items():
+            if flag is not None:
+                conditions.append(f"p.{column} = ?")
+                parameters.append(int(flag))
+        if self.output_structure is not None:
+            conditions.append("p.sorted_output_components = ? AND p.sorted_decision_options = ? AND p.first_unstructured_output = ?")
+            parameters += _get_output_structure_values(self.output_structure)[:3]
+        return " AND ".join(conditions) or "1", parameters
+
+
+_output_structure_values: dict[OutputStructure, tuple] = {}
+
+
+def _get_output_structure_values(output_structure: OutputStructure) -> tuple:
+    """The values of the output structure columns, computed once per (interned) OutputStructure"""
+    values = _output_structure_values.get(output_structure)
+    if values is None:
+        values = _output_structure_values[output_structure] = (
+            ",".join(component.value for component in output_structure.sorted_output_components),
+            ",".join(option.value for option in output_structure.sorted_decision_options),
+            int(output_structure.first_unstructured_output),
+            int(output_structure.get_has_output_component(OutputComponentType.NORMATIVE_ETHICAL_THEORY_EXPLANATION)),
+            int(output_structure.get_has_output_component(OutputComponentType.DECISION_REASON)),
+        )
+    return values
+
+
+class ExperimentStore:
+    """
+    SQLite database of PromptWrappers and Responses, e.g. to combine the prompt and response files of several versions
+    and query them without loading everything:
+
+        with ExperimentStore("experiments.sqlite") as store:
+            store.add_responses_from_json("responses.json")
+            responses = store.query_responses(
+                llm_identifiers=[LlmName.DEEPSEEK],
+                dilemma_identifiers=["public_health_*"],
+                ethical_framework_identifiers=["deontology"],
+            )
+
+    The factors of the prompts and the decisions and token counts of the responses are indexed columns,
+    the rest is stored as JSON (PromptWrapper.to_dict() and Response.to_normalized_dict()).
+    The prompt texts are stored once in the texts table and referenced by id ("prompt_text_ids"), so the stored
+    prompts never depend on the templates of the current library version.
+    Prompts are stored once per _id, Responses are appended (ingesting the same file twice stores its Responses twice).
+    Every add_* call is one transaction.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+        self._dumps = get_json_dumps()
+        self._loads = get_json_loads()
+        # Caches of the texts table, loaded on first use
+        self._text_ids: Optional[dict[str, int]] = None
+        self._texts: dict[int, str] = {}
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        try:
+            with self.connection:
+                yield
+        except BaseException:
+            # The texts inserted by the transaction are rolled back
+            self._text_ids = None
+            self._texts = {}
+            raise
+
+    def _get_text_id(self, text: str) -> int:
+        if self._text_ids is None:
+            self._text_ids = {text: text_id for text_id, text in self.connection.execute("SELECT id, text FROM texts")}
+        text_id = self._text_ids.get(text)
+        if text_id is None:
+            text_id = self._text_ids[text] = self.connection.execute("INSERT INTO texts (text) VALUES (?)", (text,)).lastrowid
+        return text_id
+
+    def _get_text(self, text_id: int) -> str:
+        text = self._texts.get(text_id)
+        if text is None:
+            text = self._texts[text_id] = self.connection.execute("SELECT text FROM texts WHERE id = ?", (text_id,)).fetchone()[0]
+        return text
+
+    def _dump_prompt(self, wrapped_prompt: PromptWrapper) -> str:
+        data = wrapped_prompt.to_dict()
+        data["prompt_text_ids"] = [self._get_text_id(text) for text in data.pop("prompts")]
+        return self._dumps(data)
+
+    def _load_prompt(self, data: str, decoder: PromptDecoder) -> PromptWrapper:
+        prompt_data = self._loads(data)
+        if "prompt_text_ids" in prompt_data:
+            prompt_data["prompts"] = [self._get_text(text_id) for text_id in prompt_data.pop("prompt_text_ids")]
+        return decoder.decode(prompt_data)
+
+    def _get_prompt_row(self, wrapped_prompt: PromptWrapper) -> tuple:
+        if wrapped_prompt._id is None:
+            raise Exception("PromptWrapper ID is None")
+        dilemma = _get_dilemma_or_none(wrapped_prompt)
+        return (
+            wrapped_prompt._id,
+            wrapped_prompt.dilemma_identifier,
+            dilemma.context_identifier if dilemma else None,
+            dilemma.type_identifier if dilemma else None,
+            wrapped_prompt.ethical_framework_identifier,
+            wrapped_prompt.base_prompt_identifier,
+            wrapped_prompt.version,
+            int(wrapped_prompt.prompt_has_output_structure_description),
+            int(wrapped_prompt.prompt_has_output_structure_json_schema),
+            *_get_output_structure_values(wrapped_prompt.output_structure),
+            self._dump_prompt(wrapped_prompt),
+        )
+
+    def _get_response_row(self, response: Response) -> tuple:
+        normalized_decision = response.normalized_decision if _get_dilemma_or_none(response.wrapped_prompt) else None
+        data = response.to_normalized_dict()
+        del data["prompt_id"]
+        return (
+            response.wrapped_prompt._id,
+            response.llm_identifier.value,
+            response.decision.value,
+            normalized_decision.value if normalized_decision else None,
+            response.prompt_tokens,
+            response.completion_tokens,
+            response.cached_tokens,
+            response.retries,
+            self._dumps(data),
+        )
+
+    def _insert_prompts(self, prompt_rows: list[tuple]):
+        self.connection.executemany(f"INSERT OR IGNORE INTO prompts VALUES ({', '.join('?' * 15)})", prompt_rows)
+
+    def add_prompts(self, wrapped_prompts: Iterable[PromptWrapper]) -> int:
+        """Store the PromptWrappers (in batches, one transaction), PromptWrappers whose _id is already stored are skipped."""
+        count = 0
+        with self._transaction():
+            batch = []
+            for wrapped_prompt in wrapped_prompts:
+                batch.append(self._get_prompt_row(wrapped_prompt))
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    self._insert_prompts(batch)
+                    count += len(batch)
+                    batch = []
+            self._insert_prompts(batch)
+            count += len(batch)
+        return count
+
+    def add_responses(self, responses: Iterable[Response]) -> int:
+        """Store the Responses and their PromptWrappers (in batches, one transaction), returns the number of Responses."""
+        count = 0
+        with self._transaction():
+            stored_prompt_ids: set[str] = set()
+            prompt_rows = []
+            response_rows = []
+            for response in responses:
+                wrapped_prompt = response.wrapped_prompt
+                if wrapped_prompt._id not in stored_prompt_ids:
+                    prompt_rows.append(self._get_prompt_row(wrapped_prompt))
+                    stored_prompt_ids.add(wrapped_prompt._id)
+                response_rows.append(self._get_response_row(response))
+                if len(response_rows) >= INGEST_BATCH_SIZE:
+                    count += self._insert_responses(prompt_rows, response_rows)
+                    prompt_rows, response_rows = [], []
+            count += self._insert_responses(prompt_rows, response_rows)
+        return count
+
+    def _insert_responses(self, prompt_rows: list[tuple], response_rows: list[tuple]) -> int:
+        self._insert_prompts(prompt_rows)
+        self.connection.executemany(
+            "INSERT INTO responses "
+            "(prompt_id, llm_identifier, decision, normalized_decision, prompt_tokens, completion_tokens, cached_tokens, retries, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            response_rows,
+        )
+        return len(response_rows)
+
+    def add_prompts_from_json(self, path: str) -> int:
+        """Store the prompts of a prompt file (see prompts_json), e.g. wrapped_prompts_v1.7.json"""
+        return self.add_prompts(iter_prompts(path))
+
+    def add_responses_from_json(self, path: str) -> int:
+        """Store the responses of a response file (see prompts_json), embedded or normalized"""
+        return self.add_responses(iter_responses(path))
+
+    def _get_query(self, query: Optional[ExperimentQuery], kwargs: dict) -> ExperimentQuery:
+        if query is not None and kwargs:
+            raise ValueError("Either pass an ExperimentQuery or its keyword arguments")
+        return query or ExperimentQuery(**kwargs)
+
+    def query_prompts(self, query: Optional[ExperimentQuery] = None, **kwargs) -> Iterator[PromptWrapper]:
+        """The stored PromptWrappers matching the query (an ExperimentQuery or its keyword arguments), ordered by _id"""
+        where, parameters = self._get_query(query, kwargs).get_where_clause(prompts_only=True)
+        decoder = PromptDecoder()
+        for (data,) in self.connection.execute(f"SELECT p.data FROM prompts p WHERE {where} ORDER BY p.id", parameters):
+            yield self._load_prompt(data, decoder)
+
+    def query_responses(self, query: Optional[ExperimentQuery] = None, **kwargs) -> Iterator[Response]:
+        """
+        The stored Responses matching the query (an ExperimentQuery or its keyword arguments) in the order they were added.
+        Responses to the same prompt share their PromptWrapper.
+        """
+        where, parameters = self._get_query(query, kwargs).get_where_clause()
+        decoder = ResponseDecoder()
+        prompts_by_id: dict[str, PromptWrapper] = {}
+        cursor = self.connection.execute(
+            f"SELECT r.data, p.id, p.data FROM responses r JOIN prompts p ON p.id = r.prompt_id WHERE {where} ORDER BY r.id",
+            parameters,
+        )
+        for data, prompt_id, prompt_data in cursor:
+            wrapped_prompt = prompts_by_id.get(prompt_id)
+            if wrapped_prompt is None:
+                wrapped_prompt = prompts_by_id[prompt_id] = self._load_prompt(prompt_data, decoder.prompt_decoder)
+            yield decoder.decode_normalized(self._loads(data), wrapped_prompt)
+
+    def query_response_columns(
+        self,
+        query: Optional[ExperimentQuery] = None,
+        columns: Optional[list[str]] = None,
+        batch_size: int = 100_000,
+        **kwargs,
+    ) -> Iterator[dict[str, list]]:
+        """
+        The indexed fields (see response_columns) of the matching Responses as batches of up to `batch_size` rows,
+        each batch maps the column names to lists of values. The texts are left out, no Response objects are created.
+        """
+        columns = response_columns if columns is None else columns
+        unknown_columns = set(columns) - set(response_columns)
+        if unknown_columns:
+            raise ValueError(f"Unknown columns: {', '.join(sorted(unknown_columns))}")
+        where, parameters = self._get_query(query, kwargs).get_where_clause()
+        selected = ", ".join(f"r.{column}" if column in _response_table_columns else f"p.{column}" for column in columns)
+        cursor = self.connection.execute(
+            f"SELECT {selected} FROM responses r JOIN prompts p ON p.id = r.prompt_id WHERE {where} ORDER BY r.id",
+            parameters,
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield {
+                column: list(map(bool, values)) if column in boolean_columns else list(values)
+                for column, values in zip(columns, zip(*rows))
+            }
+
+    def count_responses(self, query: Optional[ExperimentQuery] = None, **kwargs) -> int:
+        where, parameters = self._get_query(query, kwargs).get_where_clause()
+        return self.connection.execute(
+            f"SELECT COUNT(*) FROM responses r JOIN prompts p ON p.id = r.prompt_id WHERE {where}", parameters,
+        ).fetchone()[0]
+
+    def count_prompts(self, query: Optional[ExperimentQuery] = None, **kwargs) -> int:
+        where, parameters = self._get_query(query, kwargs).get_where_clause(prompts_only=True)
+        return self.connection.execute(f"SELECT COUNT(*) FROM prompts p WHERE {where}", parameters).fetchone()[0]
@@ -0,0 +1,369 @@
+import math
+from typing import Optional
+
+from .response_table import ResponseTable, decision_values, _import_numpy
+
+
+# Columns that are not factors of the prompt (or only duplicate another column)
+non_factor_columns = [
+    "wrapped_prompt._id",
+    "decision",
+    "normalized_decision",
+    "prompt_tokens",
+    "completion_tokens",
+    "cached_tokens",
+    "retries",
+    "shared_first_turn.key",
+    "wrapped_prompt.dilemma.identifier",
+    "wrapped_prompt.dilemma.description",
+]
+
+# By default flips are counted between responses of the same dilemma, ethical framework and LLM
+default_matched_by = [
+    "llm_identifier",
+    "wrapped_prompt.dilemma_identifier",
+    "wrapped_prompt.ethical_framework_identifier",
+]
+
+
+def chi2_sf(x: float, dof: int) -> float:
+    """Survival function (p-value) of the chi-square distribution, i.e. the regularized upper incomplete gamma function Q(dof/2, x/2)."""
+    if dof <= 0:
+        return 1.0
+    if x <= 0:
+        return 1.0
+    a = dof / 2
+    x = x / 2
+    log_prefactor = -x + a * math.log(x) - math.lgamma(a)
+    if x < a + 1:
+        # Series of the lower incomplete gamma function
+        term = 1 / a
+        total = term
+        n = a
+        for _ in range(10000):
+            n += 1
+            term *= x / n
+            total += term
+            if abs(term) < abs(total) * 1e-15:
+                break
+        return min(1.0, max(0.0, 1 - total * math.exp(log_prefactor)))
+
+    # Continued fraction of the upper incomplete gamma function (modified Lentz's method)
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for i in range(1, 10000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return min(1.0, max(0.0, math.exp(log_prefactor) * h))
+
+
+class FactorTestResult:
+    """
+    Decision distribution per level of a factor and the tests of independence between the factor and the decision.
+
+    - `counts[i][j]`: number of responses with level i and decision j
+    - `proportions`, `ci_low`, `ci_high`: share of decision j within level i and its bootstrap confidence interval
+    - `flip_rate`: share of pairs of responses with different levels (but the same matched_by values) that have different decisions
+    - `within_level_flip_rate`: the same for pairs with the same level, i.e. the rate of flips without changing the factor
+    """
+
+    def __init__(
+        self,
+        factor: str,
+        levels: list,
+        decisions: list[str],
+        counts: list[list[int]],
+        chi2: float,
+        g: float,
+        dof: int,
+        p_value_chi2: float,
+        p_value_g: float,
+        cramers_v: float,
+        proportions: list[list[float]],
+        ci_low: list[list[float]],
+        ci_high: list[list[float]],
+        flip_rate: Optional[float],
+        within_level_flip_rate: Optional[float],
+    ):
+        self.factor = factor
+        self.levels = levels
+        self.decisions = decisions
+        self.counts = counts
+        self.chi2 = chi2
+        self.g = g
+        self.dof = dof
+        self.p_value_chi2 = p_value_chi2
+        self.p_value_g = p_value_g
+        self.cramers_v = cramers_v
+        self.proportions = proportions
+        self.ci_low = ci_low
+        self.ci_high = ci_high
+        self.flip_rate = flip_rate
+        self.within_level_flip_rate = within_level_flip_rate
+        # Set by analyze_factors, corrected for testing all factors at once
+        self.p_value_holm: Optional[float] = None
+
+    def is_significant(self, alpha: float = 0.05) -> bool:
+        p_value = self.p_value_holm if self.p_value_holm is not None else self.p_value_g
+        return p_value < alpha
+
+    def to_dict(self):
+        return {
+            "factor": self.factor,
+            "levels": self.levels,
+            "decisions": self.decisions,
+            "counts": self.counts,
+            "chi2": self.chi2,
+            "g": self.g,
+            "dof": self.dof,
+            "p_value_chi2": self.p_value_chi2,
+            "p_value_g": self.p_value_g,
+            "p_value_holm": self.p_value_holm,
+            "cramers_v": self.cramers_v,
+            "proportions": self.proportions,
+            "ci_low": self.ci_low,
+            "ci_high": self.ci_high,
+            "flip_rate": self.flip_rate,
+            "within_level_flip_rate": self.within_level_flip_rate,
+        }
+
+    def __str__(self):
+        flip_rate = "-" if self.flip_rate is None else f"{self.flip_rate:.3f}"
+        within_level_flip_rate = "-" if self.within_level_flip_rate is None else f"{self.within_level_flip_rate:.3f}"
+        p_value_holm = self.p_value_holm if self.p_value_holm is not None else float("nan")
+        return (
+            f"{self.factor}: G={self.g:.2f} (dof {self.dof}, p={self.p_value_g:.3g}, holm p={p_value_holm:.3g}), "
+            f"V={self.cramers_v:.3f}, flip rate {flip_rate} (within level {within_level_flip_rate})"
+        )
+
+
+def get_factor_codes(table: ResponseTable, name: str):
+    """(codes, levels) of a column, None is a level of its own."""
+    numpy = _import_numpy()
+    values = table.columns[name]
+    mask = table.null_masks.get(name)
+    if name in table.categories:
+        level_values = list(table.categories[name])
+        codes = values.astype(numpy.int64)
+        if mask is not None or (len(codes) and codes.min() < 0):
+            codes = numpy.where(codes < 0, len(level_values), codes)
+            level_values.append(None)
+    else:
+        unique_values, codes = numpy.unique(values, return_inverse=True)
+        level_values = unique_values.tolist()
+        if mask is not None:
+            codes = numpy.where(mask, len(level_values), codes)
+            level_values.append(None)
+    # Drop levels that do not occur
+    counts = numpy.bincount(codes, minlength=len(level_values))
+    present = numpy.flatnonzero(counts)
+    remap = numpy.full(len(level_values), -1, dtype=numpy.int64)
+    remap[present] = numpy.arange(len(present))
+    return remap[codes], [level_values[i] for i in present]
+
+
+def get_group_codes(table: ResponseTable, names: list[str]):
+    """One code per distinct combination of the values of the columns"""
+    numpy = _import_numpy()
+    group_codes = numpy.zeros(len(table), dtype=numpy.int64)
+    for name in names:
+        codes, levels = get_factor_codes(table, name)
+        group_codes = group_codes * len(levels) + codes
+        # Keep the codes small
+        _, group_codes = numpy.unique(group_codes, return_inverse=True)
+    return group_codes
+
+
+def get_independence_statistics(counts):
+    """Returns (chi2, g, dof, cramers_v) of a contingency table, levels and decisions that never occur are left out."""
+    numpy = _import_numpy()
+    counts = numpy.asarray(counts, dtype=float)
+    counts = counts[counts.sum(axis=1) > 0][:, counts.sum(axis=0) > 0]
+    n = counts.sum()
+    rows, columns = counts.shape if counts.ndim == 2 else (0, 0)
+    dof = max(rows - 1, 0) * max(columns - 1, 0)
+    if dof == 0 or n == 0:
+        return 0.0, 0.0, 0, 0.0
+
+    expected = counts.sum(axis=1, keepdims=True) * counts.sum(axis=0, keepdims=True) / n
+    chi2 = float(((counts - expected) ** 2 / expected).sum())
+    observed = counts > 0
+    g = float(2 * (counts[observed] * numpy.log(counts[observed] / expected[observed])).sum())
+    cramers_v = math.sqrt(chi2 / (n * min(rows - 1, columns - 1)))
+    return chi2, g, dof, cramers_v
+
+
+def bootstrap_proportions(counts, n_bootstrap: int = 10000, confidence: float = 0.95, seed: Optional[int] = None):
+    """
+    Percentile bootstrap confidence intervals of the decision proportions per level.
+    Resampling the responses of a level with replacement is the same as drawing multinomial counts with the observed
+    proportions, so all resamples of all levels are drawn at once. Returns (proportions, ci_low, ci_high).
+    """
+    numpy = _import_numpy()
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    totals = counts.sum(axis=1)
+    proportions = counts / numpy.maximum(totals, 1)[:, None]
+    rng = numpy.random.default_rng(seed)
+    # Shape: (n_bootstrap, levels, decisions)
+    samples = rng.multinomial(totals, proportions, size=(n_bootstrap, len(totals)))
+    sample_proportions = samples / numpy.maximum(totals, 1)[None, :, None]
+    alpha = (1 - confidence) / 2
+    ci_low, ci_high = numpy.quantile(sample_proportions, [alpha, 1 - alpha], axis=0)
+    return proportions, ci_low, ci_high
+
+
+def get_flip_rates(level_codes, decision_codes, group_codes, n_levels: int, n_decisions: int):
+    """
+    (flip_rate, within_level_flip_rate): the share of disagreeing pairs of responses from the same group
+    with different levels and with the same level. None if there is no such pair.
+    """
+    numpy = _import_numpy()
+    n_groups = int(group_codes.max()) + 1 if len(group_codes) else 0
+    # counts[group, level, decision]
+    counts = numpy.bincount(
+        (group_codes * n_levels + level_codes) * n_decisions + decision_codes,
+        minlength=n_groups * n_levels * n_decisions,
+    ).reshape(n_groups, n_levels, n_decisions).astype(float)
+
+    level_totals = counts.sum(axis=2)
+    group_totals = level_totals.sum(axis=1)
+    decision_totals = counts.sum(axis=1)
+
+    # Pairs of two different responses within a group, split into same level and different levels
+    all_pairs = (group_totals * (group_totals - 1) / 2).sum()
+    same_level_pairs = (level_totals * (level_totals - 1) / 2).sum()
+    different_level_pairs = all_pairs - same_level_pairs
+
+    all_agreeing_pairs = (decision_totals * (decision_totals - 1) / 2).sum()
+    same_level_agreeing_pairs = (counts * (counts - 1) / 2).sum()
+    different_level_agreeing_pairs = all_agreeing_pairs - same_level_agreeing_pairs
+
+    flip_rate = 1 - different_level_agreeing_pairs / different_level_pairs if different_level_pairs else None
+    within_level_flip_rate = 1 - same_level_agreeing_pairs / same_level_pairs if same_level_pairs else None
+    return flip_rate, within_level_flip_rate
+
+
+def analyze_factor(
+    table: ResponseTable,
+    factor: str,
+    decision_column: str = "normalized_decision",
+    matched_by: Optional[list[str]] = None,
+    n_bootstrap: int = 10000,
+    confidence: float = 0.95,
+    seed: Optional[int] = None,
+    group_codes=None,
+) -> FactorTestResult:
+    numpy = _import_numpy()
+    if matched_by is None:
+        matched_by = [name for name in default_matched_by if name != factor]
+    if group_codes is None:
+        group_codes = get_group_codes(table, matched_by)
+
+    level_codes, levels = get_factor_codes(table, factor)
+    decision_codes = table.columns[decision_column].astype(numpy.int64)
+    n_decisions = len(decision_values)
+    counts = numpy.bincount(level_codes * n_decisions + decision_codes, minlength=len(levels) * n_decisions).reshape(len(levels), n_decisions)
+
+    chi2, g, dof, cramers_v = get_independence_statistics(counts)
+    proportions, ci_low, ci_high = bootstrap_proportions(counts, n_bootstrap, confidence, seed)
+    flip_rate, within_level_flip_rate = get_flip_rates(level_codes, decision_codes, group_codes, len(levels), n_decisions)
+
+    return FactorTestResult(
+        factor=factor,
+        levels=levels,
+        decisions=list(decision_values),
+        counts=counts.tolist(),
+        chi2=chi2,
+        g=g,
+        dof=dof,
+        p_value_chi2=chi2_sf(chi2, dof),
+        p_value_g=chi2_sf(g, dof),
+        cramers_v=cramers_v,
+        proportions=proportions.tolist(),
+        ci_low=ci_low.tolist(),
+        ci_high=ci_high.tolist(),
+        flip_rate=flip_rate,
+        within_level_flip_rate=within_level_flip_rate,
+    )
+
+
+def get_factors(table: ResponseTable) -> list[str]:
+    """All columns of the table that are factors (with more than one level)"""
+    numpy = _import_numpy()
+    factors = []
+    for name, values in table.columns.items():
+        if name in non_factor_columns or values.dtype == object:
+            continue
+        if len(values) and (name in table.null_masks or numpy.any(values != values[0])):
+            factors.append(name)
+    return factors
+
+
+def holm_correction(p_values: list[float]) -> list[float]:
+    """Holm-Bonferroni adjusted p-values"""
+    order = sorted(range(len(p_values)), key=lambda i: p_values[i])
+    adjusted = [0.0] * len(p_values)
+    running_max = 0.0
+    for rank, i in enumerate(order):
+        running_max = max(running_max, min(1.0, (len(p_values) - rank) * p_values[i]))
+        adjusted[i] = running_max
+    return adjusted
+
+
+def analyze_factors(
+    table: ResponseTable,
+    factors: Optional[list[str]] = None,
+    decision_column: str = "normalized_decision",
+    matched_by: Optional[list[str]] = None,
+    n_bootstrap: int = 10000,
+    confidence: float = 0.95,
+    seed: Optional[int] = None,
+) -> list[FactorTestResult]:
+    """
+    Test every factor (by default all columns of the ResponseTable that vary, see get_factors) for an effect on the decision.
+    The G-test p-values are Holm corrected for the number of tested factors (p_value_holm).
+    Flip rates compare responses with the same `matched_by` values (default: LLM, dilemma and ethical framework,
+    leaving out the tested factor itself).
+    """
+    if factors is None:
+        factors = get_factors(table)
+
+    group_codes = None
+    if matched_by is not None:
+        group_codes = get_group_codes(table, matched_by)
+    default_group_codes = {}
+
+    results = []
+    for i, factor in enumerate(factors):
+        factor_group_codes = group_codes
+        if factor_group_codes is None:
+            # The default grouping only depends on whether the factor is one of the default_matched_by columns
+            factor_matched_by = tuple(name for name in default_matched_by if name != factor)
+            if factor_matched_by not in default_group_codes:
+                default_group_codes[factor_matched_by] = get_group_codes(table, list(factor_matched_by))
+            factor_group_codes = default_group_codes[factor_matched_by]
+        results.append(analyze_factor(
+            table,
+            factor,
+            decision_column,
+            n_bootstrap=n_bootstrap,
+            confidence=confidence,
+            seed=None if seed is None else seed + i,
+            group_codes=factor_group_codes,
+        ))
+
+    for result, p_value_holm in zip(results, holm_correction([result.p_value_g for result in results])):
+        result.p_value_holm = p_value_holm
+    return results
@@ -0,0 +1,306 @@
+import json
+import time
+from typing import Generator, Optional
+
+from .prompt_wrapper import *
+from .metrics import ApiCallEvent, ErrorCategory, ResponseError, emit, has_metrics_hooks
+from .provider_client import ProviderClient
+from .response_cache import ResponseCache
+from .retry import RetryPolicy, call_with_retries
+
+
+MAX_PROMPTS = 5  # We never have more than 5 prompts
+
+api_names = {
+    LlmProvider.OPENAI: "OpenAI API",
+    LlmProvider.DEEPSEEK: "DeepSeek API",
+    LlmProvider.MISTRAL: "Mistral API",
+}
+
+
+def get_response_format(wrapped_prompt: PromptWrapper, count: int) -> Optional[dict]:
+    """
+    Get the response_format for the count-th (1-based) prompt of a PromptWrapper.
+    We add the response_format either directly or in the second prompt where it's asked to parse its output.
+    """
+    if wrapped_prompt.output_structure.first_unstructured_output and count != 2:
+        return None
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "response",
+            "strict": True,
+            "schema": wrapped_prompt.output_structure.get_json_schema(),
+        },
+    }
+
+
+def check_completion(response, api_name: str):
+    """Raise if a chat completion is not a single, complete assistant message."""
+    if len(response.choices) == 0:
+        raise ResponseError(f"No response from {api_name}", ErrorCategory.EMPTY_RESPONSE)
+    if len(response.choices) > 1:
+        raise ResponseError(f"More than one response from {api_name}", ErrorCategory.INVALID_RESPONSE)
+    if response.choices[0].message.role != "assistant":
+        raise ResponseError(f"Response from {api_name} is not from the assistant", ErrorCategory.INVALID_RESPONSE)
+    if response.choices[0].message.content == "":
+        raise ResponseError(f"Response from {api_name} is empty", ErrorCategory.EMPTY_RESPONSE)
+    if response.choices[0].finish_reason != "stop":
+        raise ResponseError(f"Response finish_reason is not 'stop' but '{response.choices[0].finish_reason}'", ErrorCategory.FINISH_REASON)
+
+
+def get_cached_tokens(usage) -> Optional[int]:
+    """
+    Prompt tokens served from the provider's prompt (prefix) cache, None if the provider does not report them.
+    OpenAI and Mistral report them in usage.prompt_tokens_details.cached_tokens, DeepSeek in usage.prompt_cache_hit_tokens.
+    """
+    if usage is None:
+        return None
+    prompt_tokens_details = getattr(usage, "prompt_tokens_details", None)
+    if prompt_tokens_details is not None and getattr(prompt_tokens_details, "cached_tokens", None) is not None:
+        return prompt_tokens_details.cached_tokens
+    # Fields that are not part of the OpenAI usage model end up in model_extra
+    prompt_cache_hit_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+    if prompt_cache_hit_tokens is None and getattr(usage, "model_extra", None):
+        prompt_cache_hit_tokens = usage.model_extra.get("prompt_cache_hit_tokens")
+    return prompt_cache_hit_tokens
+
+
+def record_api_call(model: LlmName, started: float, response=None, error: Optional[Exception] = None):
+    """Pass a chat completion request (started at time.monotonic() `started`) to the metrics hooks."""
+    if not has_metrics_hooks():
+        return
+    usage = getattr(response, "usage", None)
+    emit(ApiCallEvent(
+        model=model,
+        latency_seconds=time.monotonic() - started,
+        prompt_tokens=usage.prompt_tokens if usage else None,
+        completion_tokens=usage.completion_tokens if usage else None,
+        cached_tokens=get_cached_tokens(usage),
+        finish_reason=response.choices[0].finish_reason if response is not None and response.choices else None,
+        error=error,
+    ))
+
+
+def add_tokens(total: Optional[int], tokens: Optional[int]) -> Optional[int]:
+    """Sum up token counts that are not reported by every provider, stays None if none was reported."""
+    if tokens is None:
+        return total
+    return (total or 0) + tokens
+
+
+class Completion:
+    """The parts of a chat completion the library keeps: the assistant message and the token usage."""
+
+    def __init__(self, content: str, prompt_tokens: int, completion_tokens: int, cached_tokens: Optional[int] = None):
+        self.content = content
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_tokens = cached_tokens
+        # Failed attempts before this completion, not cached
+        self.retries = 0
+        # Answered by the ResponseCache instead of the provider
+        self.from_cache = False
+
+    @classmethod
+    def from_chat_completion(cls, response, api_name: str):
+        check_completion(response, api_name)
+        return cls(
+            content=response.choices[0].message.content,
+            prompt_tokens=response.usage.prompt_tokens,
+            completion_tokens=response.usage.completion_tokens,
+            cached_tokens=get_cached_tokens(response.usage),
+        )
+
+    def to_dict(self):
+        return {
+            "content": self.content,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            content=data["content"],
+            prompt_tokens=data["prompt_tokens"],
+            completion_tokens=data["completion_tokens"],
+            cached_tokens=data.get("cached_tokens"),
+        )
+
+
+def create_response(
+    wrapped_prompt: PromptWrapper,
+    model: LlmName,
+    messages: list[dict],
+    prompt_tokens: int,
+    completion_tokens: int,
+    cached_tokens: Optional[int] = None,
+    shared_first_turn: Optional[SharedFirstTurn] = None,
+    retries: Optional[int] = None,
+) -> Response:
+    """Parse the last assistant message of a finished conversation into a Response."""
+    try:
+        parsed_response = json.loads(messages[-1]["content"])
+        if not parsed_response.get("decision"):
+            raise ResponseError("No decision in response", ErrorCategory.NO_DECISION)
+        if parsed_response["decision"] not in [option.value for option in DecisionOption]:
+            raise ResponseError(f"Invalid decision {parsed_response['decision']} in response", ErrorCategory.NO_DECISION)
+    except Exception as e:
+        if has_metrics_hooks():
+            emit(ApiCallEvent(model=model, error=e))
+        raise e
+
+    decision = DecisionOption(parsed_response["decision"])
+
+    return Response(
+        wrapped_prompt=wrapped_prompt,
+        decision=decision,
+        llm_identifier=model,
+        unparsed_messages=[LlmMessage.from_dict(item) for item in messages],
+        parsed_response=parsed_response,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cached_tokens=cached_tokens,
+        shared_first_turn=shared_first_turn,
+        retries=retries,
+    )
+
+
+def get_usage(completions: list[Completion]) -> tuple[int, int, Optional[int]]:
+    """(prompt_tokens, completion_tokens, cached_tokens) of the Completions of several turns"""
+    cached_tokens = None
+    for completion in completions:
+        cached_tokens = add_tokens(cached_tokens, completion.cached_tokens)
+    return sum(completion.prompt_tokens for completion in completions), sum(completion.completion_tokens for completion in completions), cached_tokens
+
+
+def create_response_from_turns(
+    wrapped_prompt: PromptWrapper,
+    model: LlmName,
+    messages: list[dict],
+    completions: list[Completion],
+    shared_first_turn: Optional[SharedFirstTurn] = None,
+) -> Response:
+    """create_response with the usage of the Completions of the turns, also sets Response.requests and Response.request_usage."""
+    prompt_tokens, completion_tokens, cached_tokens = get_usage(completions)
+    retries = sum(completion.retries for completion in completions)
+    response = create_response(wrapped_prompt, model, messages, prompt_tokens, completion_tokens, cached_tokens, shared_first_turn, retries)
+    sent_completions = [completion for completion in completions if not completion.from_cache]
+    response.requests = len(sent_completions)
+    response.request_usage = get_usage(sent_completions)
+    return response
+
+
+def complete_turn(
+    client: ProviderClient,
+    model: LlmName,
+    messages: list[dict],
+    response_format: Optional[dict],
+    cache: Optional[ResponseCache] = None,
+    sample: int = 0,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> Completion:
+    """
+    Get the next assistant message for `messages`, from the cache if possible.
+    Different `sample` numbers are cached separately, to draw several independent completions of the same messages.
+    Transient errors are retried according to `retry_policy` (default: retry.default_retry_policy).
+    """
+    if cache:
+        cache_key = cache.get_key(model.value, messages, response_format, sample)
+        entry = cache.get(cache_key)
+        if entry:
+            if has_metrics_hooks():
+                emit(ApiCallEvent(model=model, from_cache=True))
+            completion = Completion.from_dict(entry)
+            completion.from_cache = True
+            return completion
+
+    kwargs = {}
+    if response_format:
+        kwargs["response_format"] = response_format
+
+    def request() -> Completion:
+        started = time.monotonic()
+        response = None
+        try:
+            response = client.client.chat.completions.create(
+                model=model.value,
+                messages=messages,
+                n=1,
+                **kwargs,
+            )
+            completion = Completion.from_chat_completion(response, api_names[client.provider])
+        except Exception as e:
+            record_api_call(model, started, response, e)
+            raise e
+        record_api_call(model, started, response)
+        return completion
+
+    completion, completion.retries = call_with_retries(request, client.provider, retry_policy)
+
+    if cache:
+        cache.put(cache_key, completion.to_dict())
+    return completion
+
+
+def conversation_turns(wrapped_prompt: PromptWrapper, messages: list[dict]) -> Generator[Optional[dict], Completion, list[Completion]]:
+    """
+    The turn loop shared by run_conversation and async_query.run_conversation_async.
+    Appends every prompt of a PromptWrapper that is not yet part of `messages` (extended in place), yields the response_format
+    of the turn and expects its Completion to be sent back. Returns the Completions of these turns.
+    """
+    completions = []
+    for count, prompt in enumerate(wrapped_prompt.prompts, start=1):
+        if count > MAX_PROMPTS:
+            raise Exception("Too many prompts")
+        if count <= len(messages) // 2:
+            # Turn already done
+            continue
+
+        messages.append({"role": "system", "content": prompt})
+        completion = yield get_response_format(wrapped_prompt, count)
+
+        messages.append({"role": "assistant", "content": completion.content})
+        completions.append(completion)
+    return completions
+
+
+def run_conversation(
+    client: ProviderClient,
+    wrapped_prompt: PromptWrapper,
+    model: LlmName,
+    messages: list[dict],
+    cache: Optional[ResponseCache] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> list[Completion]:
+    """
+    Send the prompts of a PromptWrapper that are not yet part of `messages` (extended in place)
+    and return the Completions of these turns.
+    """
+    turns = conversation_turns(wrapped_prompt, messages)
+    try:
+        response_format = next(turns)
+        while True:
+            response_format = turns.send(complete_turn(client, model, messages, response_format, cache, retry_policy=retry_policy))
+    except StopIteration as stop:
+        return stop.value
+
+
+def query_api(
+    client: ProviderClient,
+    wrapped_prompt: PromptWrapper,
+    model: LlmName,
+    cache: Optional[ResponseCache] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> Response:
+    """Run the conversation of a PromptWrapper against the provider of `client` and parse the final answer."""
+    messages = []
+
+    try:
+        completions = run_conversation(client, wrapped_prompt, model, messages, cache, retry_policy)
+        return create_response_from_turns(wrapped_prompt, model, messages, completions)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        raise e
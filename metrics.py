@@ -0,0 +1,318 @@
+import json
+import threading
+import time
+from enum import Enum
+from typing import Callable, Optional
+
+import openai
+
+from .prompt_wrapper import *
+
+
+class ErrorCategory(Enum):
+    RATE_LIMIT = "rate_limit"
+    TIMEOUT = "timeout"
+    CONNECTION = "connection"
+    AUTHENTICATION = "authentication"
+    BAD_REQUEST = "bad_request"
+    SERVER_ERROR = "server_error"
+    API_ERROR = "api_error"
+    EMPTY_RESPONSE = "empty_response"
+    INVALID_RESPONSE = "invalid_response"
+    # finish_reason is not "stop", e.g. "length" or "content_filter"
+    FINISH_REASON = "finish_reason"
+    INVALID_JSON = "invalid_json"
+    NO_DECISION = "no_decision"
+    OTHER = "other"
+
+
+class ResponseError(Exception):
+    """A response that arrived but cannot be used."""
+
+    def __init__(self, message: str, category: ErrorCategory):
+        super().__init__(message)
+        self.category = category
+
+
+def get_error_category(error: Exception) -> ErrorCategory:
+    if isinstance(error, ResponseError):
+        return error.category
+    if isinstance(error, json.JSONDecodeError):
+        return ErrorCategory.INVALID_JSON
+    if isinstance(error, openai.RateLimitError):
+        return ErrorCategory.RATE_LIMIT
+    # APITimeoutError is a subclass of APIConnectionError
+    if isinstance(error, openai.APITimeoutError):
+        return ErrorCategory.TIMEOUT
+    if isinstance(error, openai.APIConnectionError):
+        return ErrorCategory.CONNECTION
+    if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+        return ErrorCategory.AUTHENTICATION
+    if isinstance(error, (openai.BadRequestError, openai.UnprocessableEntityError)):
+        return ErrorCategory.BAD_REQUEST
+    if isinstance(error, openai.InternalServerError):
+        return ErrorCategory.SERVER_ERROR
+    if isinstance(error, openai.APIError):
+        return ErrorCategory.API_ERROR
+    return ErrorCategory.OTHER
+
+
+class ApiCallEvent:
+    """
+    One chat completion turn, passed to the metrics hooks.
+    `latency_seconds` is None if no request was sent (ResponseCache hit, or parsing the final answer of a conversation failed).
+    """
+
+    def __init__(
+        self,
+        model: LlmName,
+        latency_seconds: Optional[float] = None,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        cached_tokens: Optional[int] = None,
+        finish_reason: Optional[str] = None,
+        error: Optional[Exception] = None,
+        from_cache: bool = False,
+    ):
+        self.model = model
+        self.latency_seconds = latency_seconds
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_tokens = cached_tokens
+        self.finish_reason = finish_reason
+        self.error = error
+        self.error_category = get_error_category(error) if error is not None else None
+        self.from_cache = from_cache
+
+
+_hooks: list[Callable[[ApiCallEvent], None]] = []
+
+
+def add_metrics_hook(hook: Callable[[ApiCallEvent], None]):
+    """
+    Call `hook` with an ApiCallEvent for every chat completion turn of the sync and async query paths (all providers).
+    Hooks are called from the querying threads, so they have to be thread-safe. ApiMetrics.record is such a hook.
+    """
+    _hooks.append(hook)
+
+
+def remove_metrics_hook(hook: Callable[[ApiCallEvent], None]):
+    _hooks.remove(hook)
+
+
+def has_metrics_hooks() -> bool:
+    return bool(_hooks)
+
+
+def emit(event: ApiCallEvent):
+    for hook in list(_hooks):
+        hook(event)
+
+
+def format_number(value: float) -> str:
+    """Exact text form of a sample value or bucket bound (Prometheus exposition format), integers without a decimal point"""
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+# Upper bounds in seconds, chat completions take from below a second to minutes
+DEFAULT_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300)
+
+
+class LatencyHistogram:
+    """Cumulative histogram with fixed buckets (as in Prometheus), quantiles are interpolated within the buckets."""
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def observe(self, value: float):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def get_quantile(self, quantile: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = quantile * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                # The observed extremes are tighter bounds than the bucket edges
+                lower = max(self.buckets[index - 1] if index > 0 else 0.0, self.min)
+                upper = min(self.buckets[index] if index < len(self.buckets) else self.max, self.max)
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+    def get_cumulative_counts(self) -> list[tuple[str, int]]:
+        """(le label, count) pairs including +Inf"""
+        res = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + [None], self.counts):
+            cumulative += count
+            res.append(("+Inf" if bound is None else format_number(bound), cumulative))
+        return res
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.get_quantile(0.5),
+            "p95": self.get_quantile(0.95),
+            "p99": self.get_quantile(0.99),
+            "buckets": dict(self.get_cumulative_counts()),
+        }
+
+
+class ModelMetrics:
+    def __init__(self, model: LlmName, buckets: tuple[float, ...]):
+        self.model = model
+        self.latency = LatencyHistogram(buckets)
+        self.requests = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.finish_reasons: dict[str, int] = {}
+        self.errors: dict[ErrorCategory, int] = {}
+
+    def record(self, event: ApiCallEvent):
+        if event.from_cache:
+            self.cache_hits += 1
+        if event.latency_seconds is not None:
+            self.requests += 1
+            self.latency.observe(event.latency_seconds)
+        self.prompt_tokens += event.prompt_tokens or 0
+        self.completion_tokens += event.completion_tokens or 0
+        self.cached_tokens += event.cached_tokens or 0
+        if event.finish_reason is not None:
+            self.finish_reasons[event.finish_reason] = self.finish_reasons.get(event.finish_reason, 0) + 1
+        if event.error_category is not None:
+            self.errors[event.error_category] = self.errors.get(event.error_category, 0) + 1
+
+    @property
+    def completion_tokens_per_second(self) -> float:
+        """Generation speed of a single request: completion tokens per second of latency"""
+        return self.completion_tokens / self.latency.sum if self.latency.sum else 0.0
+
+    def to_dict(self, elapsed_seconds: float):
+        return {
+            "provider": self.model.provider.value,
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "errors": {category.value: count for category, count in self.errors.items()},
+            "error_rate": sum(self.errors.values()) / self.requests if self.requests else 0.0,
+            "finish_reasons": self.finish_reasons,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "requests_per_second": self.requests / elapsed_seconds if elapsed_seconds else 0.0,
+            "tokens_per_second": (self.prompt_tokens + self.completion_tokens) / elapsed_seconds if elapsed_seconds else 0.0,
+            "completion_tokens_per_second": self.completion_tokens_per_second,
+            "latency_seconds": self.latency.to_dict(),
+        }
+
+
+class ApiMetrics:
+    """
+    Aggregates ApiCallEvents per model: latency histogram (p50/p95/p99), request and token throughput,
+    finish reasons and errors by ErrorCategory. Export with to_dict (JSON snapshot) or to_prometheus (text exposition format).
+
+        metrics = ApiMetrics()
+        add_metrics_hook(metrics.record)
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.models: dict[LlmName, ModelMetrics] = {}
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, event: ApiCallEvent):
+        with self._lock:
+            if event.model not in self.models:
+                self.models[event.model] = ModelMetrics(event.model, self.buckets)
+            self.models[event.model].record(event)
+
+    def reset(self):
+        with self._lock:
+            self.models = {}
+            self.started = time.monotonic()
+
+    def to_dict(self):
+        with self._lock:
+            elapsed_seconds = time.monotonic() - self.started
+            return {
+                "elapsed_seconds": elapsed_seconds,
+                "models": {model.value: metrics.to_dict(elapsed_seconds) for model, metrics in self.models.items()},
+            }
+
+    def write_json(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def to_prometheus(self, prefix: str = "llm_ethics") -> str:
+        lines = []
+
+        def add_metric(name: str, metric_type: str, description: str, samples: list[tuple[str, float]]):
+            lines.append(f"# HELP {prefix}_{name} {description}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for suffix_and_labels, value in samples:
+                lines.append(f"{prefix}_{name}{suffix_and_labels} {format_number(value)}")
+
+        with self._lock:
+            models = list(self.models.values())
+
+            def labels(metrics: ModelMetrics, **extra: str) -> str:
+                values = {"provider": metrics.model.provider.value, "model": metrics.model.value, **extra}
+                return "{" + ",".join(f'{key}="{value}"' for key, value in values.items()) + "}"
+
+            add_metric("requests_total", "counter", "Chat completion requests sent", [(labels(m), m.requests) for m in models])
+            add_metric("cache_hits_total", "counter", "Turns answered by the ResponseCache", [(labels(m), m.cache_hits) for m in models])
+            add_metric(
+                "tokens_total", "counter", "Tokens used by type",
+                [
+                    (labels(m, type=token_type), value)
+                    for m in models
+                    for token_type, value in [("prompt", m.prompt_tokens), ("completion", m.completion_tokens), ("cached", m.cached_tokens)]
+                ],
+            )
+            add_metric(
+                "finish_reasons_total", "counter", "Completions by finish_reason",
+                [(labels(m, finish_reason=reason), count) for m in models for reason, count in m.finish_reasons.items()],
+            )
+            add_metric(
+                "errors_total", "counter", "Failed turns by category",
+                [(labels(m, category=category.value), count) for m in models for category, count in m.errors.items()],
+            )
+            add_metric(
+                "request_latency_seconds", "histogram", "Latency of chat completion requests",
+                [
+                    sample
+                    for m in models
+                    for sample in (
+                        [("_bucket" + labels(m, le=bound), count) for bound, count in m.latency.get_cumulative_counts()]
+                        + [("_sum" + labels(m), m.latency.sum), ("_count" + labels(m), m.latency.count)]
+                    )
+                ],
+            )
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,537 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import multiprocessing
+import random
+import threading
+import time
+import urllib.request
+from typing import Callable, Optional
+
+from .prompt_wrapper import *
+
+
+# Latency distributions are classes instead of lambdas, so a MockServerConfig can be sent to another process
+class FixedLatency:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def __call__(self, rng: random.Random) -> float:
+        return self.seconds
+
+
+class UniformLatency:
+    def __init__(self, low: float, high: float):
+        self.low = low
+        self.high = high
+
+    def __call__(self, rng: random.Random) -> float:
+        return rng.uniform(self.low, self.high)
+
+
+class LognormalLatency:
+    """Long-tailed like real completion latencies, `median` in seconds"""
+
+    def __init__(self, median: float, sigma: float = 0.5):
+        self.median = median
+        self.sigma = sigma
+
+    def __call__(self, rng: random.Random) -> float:
+        return rng.lognormvariate(math.log(self.median), self.sigma)
+
+
+# Filler for generated strings and unstructured answers, repeated so that any text is a slice of it
+WORDS = "the decision depends on the consequences duties and virtues involved in this dilemma".split()
+FILLER_TEXT = " ".join(random.Random(0).choice(WORDS) for _ in range(10_000))
+CHARACTERS_PER_TOKEN = 4
+# OpenAI caches prompt prefixes in steps of 128 tokens, starting at 1024
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP_TOKENS = 128
+
+
+class MockServerConfig:
+    """
+    Behaviour of a MockProviderServer. The rates are probabilities per request,
+    `finish_reasons` maps finish reasons other than "stop" (e.g. "length", "content_filter") to their probability.
+    Rate limited responses carry a retry-after-ms header of `retry_after_ms`.
+    Requests of a batch (see openai_batch) are left unanswered with `batch_expired_rate`, their batch finishes as "expired" then.
+    """
+
+    def __init__(
+        self,
+        latency: Callable[[random.Random], float] = FixedLatency(0.0),
+        rate_limit_rate: float = 0.0,
+        server_error_rate: float = 0.0,
+        finish_reasons: Optional[dict[str, float]] = None,
+        empty_response_rate: float = 0.0,
+        retry_after_ms: Optional[int] = 100,
+        words_per_string: int = 30,
+        prompt_cache: bool = True,
+        decision_weights: Optional[dict[str, float]] = None,
+        batch_expired_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.finish_reasons = finish_reasons or {}
+        self.empty_response_rate = empty_response_rate
+        self.retry_after_ms = retry_after_ms
+        self.words_per_string = words_per_string
+        self.prompt_cache = prompt_cache
+        self.decision_weights = decision_weights
+        self.batch_expired_rate = batch_expired_rate
+        self.seed = seed
+
+
+class MockServerStats:
+    def __init__(self):
+        self.requests = 0
+        self.completions = 0
+        self.status_codes: dict[int, int] = {}
+        self.finish_reasons: dict[str, int] = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.max_concurrency = 0
+        self._in_flight = 0
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "completions": self.completions,
+            # String keys as in the JSON of get_stats
+            "status_codes": {str(status): count for status, count in self.status_codes.items()},
+            "finish_reasons": self.finish_reasons,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "max_concurrency": self.max_concurrency,
+        }
+
+
+class MockProviderServer:
+    """
+    Local OpenAI compatible chat completions endpoint for load tests and benchmarks without network or API costs.
+    It runs an asyncio HTTP/1.1 server (with keep-alive) in a background thread, thus it handles thousands of concurrent requests.
+    With `separate_process=True` it runs in its own process instead, so it does not compete with the measured client for the GIL.
+
+    Structured requests are answered with a random JSON object that is valid for the requested json_schema,
+    other requests with free text. Latency, rate limits (429), server errors (5xx), finish reasons and empty answers
+    are drawn according to the MockServerConfig. Token usage is estimated from the characters, repeated prompt prefixes
+    are reported as cached tokens like OpenAI's prompt caching does.
+    The /files and /batches endpoints of the Batch API are supported as well, a batch is answered as soon as it is created.
+
+        with MockProviderServer(MockServerConfig(latency=LognormalLatency(0.5))) as server:
+            client = ProviderClient(LlmProvider.OPENAI, "mock", base_url=server.base_url)
+            response = query_openai_api("mock", wrapped_prompt, client=client)
+    """
+
+    def __init__(
+        self,
+        config: Optional[MockServerConfig] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        separate_process: bool = False,
+    ):
+        self.config = config or MockServerConfig()
+        self.host = host
+        self.port = port
+        self.separate_process = separate_process
+        self.stats = MockServerStats()
+        self._random = random.Random(self.config.seed)
+        self._cached_prefixes: set[bytes] = set()
+        self._files: dict[str, bytes] = {}
+        self._batches: dict[str, dict] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._process: Optional[multiprocessing.Process] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def get_stats(self) -> dict:
+        """MockServerStats.to_dict, fetched from the server process with separate_process"""
+        if self._process is None:
+            return self.stats.to_dict()
+        with urllib.request.urlopen(f"{self.base_url}/mock/stats") as response:
+            return json.loads(response.read())
+
+    def start(self):
+        if self.separate_process:
+            port_queue = multiprocessing.Queue()
+            self._process = multiprocessing.Process(target=_run_server_process, args=(self.config, self.host, self.port, port_queue), daemon=True)
+            self._process.start()
+            self.port = port_queue.get()
+            return
+
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._start_server())
+            started.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+
+    async def _start_server(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port, backlog=4096)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+            return
+        if self._loop is None:
+            return
+
+        async def shutdown():
+            # Also ends the open keep-alive connections
+            self._server.close()
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = request_line.split(" ", 2)
+                headers = {}
+                for line in header_lines:
+                    if line:
+                        name, _, value = line.partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, response_headers, response_body = await self._handle_request(method, path, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                response_headers = {
+                    "Content-Type": "application/json",
+                    "Content-Length": str(len(response_body)),
+                    "Connection": "keep-alive" if keep_alive else "close",
+                    **response_headers,
+                }
+                writer.write(
+                    f"HTTP/1.1 {status} {status_reasons.get(status, '')}\r\n".encode("latin-1")
+                    + "".join(f"{name}: {value}\r\n" for name, value in response_headers.items()).encode("latin-1")
+                    + b"\r\n"
+                    + response_body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, method: str, path: str, headers: dict, body: bytes) -> tuple[int, dict, bytes]:
+        stats = self.stats
+        if method == "GET" and path.rstrip("/").endswith("/mock/stats"):
+            return 200, {}, json.dumps(stats.to_dict()).encode("utf-8")
+        stats.requests += 1
+        # e.g. ["files", "file-mock-1", "content"] for /v1/files/file-mock-1/content
+        parts = path.partition("?")[0].strip("/").split("/")
+        if parts[0] == "v1":
+            parts = parts[1:]
+        if parts[:1] == ["files"] or parts[:1] == ["batches"]:
+            return self._handle_batch_api(method, parts, headers, body)
+        if method != "POST" or parts != ["chat", "completions"]:
+            return self._error(404, f"Unknown endpoint {method} {path}", "invalid_request_error")
+
+        stats._in_flight += 1
+        stats.max_concurrency = max(stats.max_concurrency, stats._in_flight)
+        try:
+            await asyncio.sleep(max(0.0, self.config.latency(self._random)))
+            return self._complete(json.loads(body))
+        finally:
+            stats._in_flight -= 1
+
+    def _handle_batch_api(self, method: str, parts: list[str], headers: dict, body: bytes) -> tuple[int, dict, bytes]:
+        if method == "POST" and parts == ["files"]:
+            content = _get_multipart_file(headers.get("content-type", ""), body)
+            if content is None:
+                return self._error(400, "Missing file", "invalid_request_error")
+            return 200, {}, json.dumps(self._add_file(content, "batch")).encode("utf-8")
+        if method == "GET" and len(parts) == 3 and parts[0] == "files" and parts[2] == "content":
+            if parts[1] not in self._files:
+                return self._error(404, f"No such file: {parts[1]}", "invalid_request_error")
+            return 200, {"Content-Type": "application/octet-stream"}, self._files[parts[1]]
+        if method == "POST" and parts == ["batches"]:
+            request = json.loads(body)
+            if request.get("input_file_id") not in self._files:
+                return self._error(400, f"No such file: {request.get('input_file_id')}", "invalid_request_error")
+            batch = self._run_batch(request)
+            # The client sees the batch in progress first, like a real batch
+            return 200, {}, json.dumps({**batch, "status": "in_progress", "output_file_id": None, "error_file_id": None}).encode("utf-8")
+        if method == "GET" and len(parts) == 2 and parts[0] == "batches":
+            if parts[1] not in self._batches:
+                return self._error(404, f"No such batch: {parts[1]}", "invalid_request_error")
+            return 200, {}, json.dumps(self._batches[parts[1]]).encode("utf-8")
+        return self._error(404, f"Unknown endpoint {method} /{'/'.join(parts)}", "invalid_request_error")
+
+    def _add_file(self, content: bytes, purpose: str) -> dict:
+        file_id = f"file-mock-{len(self._files) + 1}"
+        self._files[file_id] = content
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": f"{file_id}.jsonl",
+            "purpose": purpose,
+            "status": "processed",
+        }
+
+    def _run_batch(self, request: dict) -> dict:
+        """Answer every request of the input file, successful ones go to the output file and failed or expired ones to the error file"""
+        batch_id = f"batch_mock_{len(self._batches) + 1}"
+        output_lines = []
+        error_lines = []
+        expired = False
+        for line in self._files[request["input_file_id"]].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            batch_request = json.loads(line)
+            line_id = f"batch_req_mock_{len(output_lines) + len(error_lines) + 1}"
+            if self._random.random() < self.config.batch_expired_rate:
+                expired = True
+                error_lines.append({
+                    "id": line_id,
+                    "custom_id": batch_request["custom_id"],
+                    "response": None,
+                    "error": {"code": "batch_expired", "message": "This request could not be executed before the completion window expired."},
+                })
+                continue
+            status, _, response_body = self._complete(batch_request["body"])
+            (output_lines if status == 200 else error_lines).append({
+                "id": line_id,
+                "custom_id": batch_request["custom_id"],
+                "response": {"status_code": status, "request_id": line_id, "body": json.loads(response_body)},
+                "error": None,
+            })
+
+        def add_lines(lines: list[dict]) -> Optional[str]:
+            if not lines:
+                return None
+            return self._add_file("".join(json.dumps(line) + "\n" for line in lines).encode("utf-8"), "batch_output")["id"]
+
+        batch = self._batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": request.get("endpoint"),
+            "input_file_id": request["input_file_id"],
+            "completion_window": request.get("completion_window", "24h"),
+            "created_at": int(time.time()),
+            "status": "expired" if expired else "completed",
+            "output_file_id": add_lines(output_lines),
+            "error_file_id": add_lines(error_lines),
+            "request_counts": {"total": len(output_lines) + len(error_lines), "completed": len(output_lines), "failed": len(error_lines)},
+        }
+        return batch
+
+    def _error(self, status: int, message: str, error_type: str, headers: Optional[dict] = None) -> tuple[int, dict, bytes]:
+        self.stats.status_codes[status] = self.stats.status_codes.get(status, 0) + 1
+        body = {"error": {"message": message, "type": error_type, "param": None, "code": None}}
+        return status, headers or {}, json.dumps(body).encode("utf-8")
+
+    def _complete(self, request: dict) -> tuple[int, dict, bytes]:
+        config = self.config
+        rng = self._random
+        draw = rng.random()
+        if draw < config.rate_limit_rate:
+            headers = {"retry-after-ms": str(config.retry_after_ms)} if config.retry_after_ms is not None else {}
+            return self._error(429, "Rate limit reached (mock)", "rate_limit_exceeded", headers)
+        if draw < config.rate_limit_rate + config.server_error_rate:
+            return self._error(rng.choice([500, 502, 503]), "Server error (mock)", "server_error")
+
+        messages = request.get("messages", [])
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            content = json.dumps(self.get_schema_instance(response_format["json_schema"]["schema"]))
+        else:
+            content = self.get_text(config.words_per_string * 3)
+
+        finish_reason = "stop"
+        draw = rng.random()
+        for reason, rate in config.finish_reasons.items():
+            if draw < rate:
+                finish_reason = reason
+                break
+            draw -= rate
+        if finish_reason == "length":
+            content = content[:len(content) // 2]
+        elif finish_reason == "content_filter":
+            content = ""
+        if rng.random() < config.empty_response_rate:
+            content = ""
+
+        prompt_tokens = sum(len(message.get("content") or "") for message in messages) // CHARACTERS_PER_TOKEN + 4 * len(messages)
+        completion_tokens = len(content) // CHARACTERS_PER_TOKEN + 1
+        cached_tokens = self._get_cached_tokens(messages) if config.prompt_cache else 0
+
+        stats = self.stats
+        stats.status_codes[200] = stats.status_codes.get(200, 0) + 1
+        stats.completions += 1
+        stats.finish_reasons[finish_reason] = stats.finish_reasons.get(finish_reason, 0) + 1
+        stats.prompt_tokens += prompt_tokens
+        stats.completion_tokens += completion_tokens
+        stats.cached_tokens += cached_tokens
+
+        body = {
+            "id": f"chatcmpl-mock-{stats.completions}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "logprobs": None,
+                "finish_reason": finish_reason,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }
+        return 200, {}, json.dumps(body).encode("utf-8")
+
+    def _get_cached_tokens(self, messages: list[dict]) -> int:
+        """Tokens of the longest message prefix that was sent before, in cache steps"""
+        prefix_hash = hashlib.sha1()
+        cached_characters = 0
+        characters = 0
+        for message in messages:
+            prefix_hash.update(json.dumps(message, sort_keys=True).encode("utf-8"))
+            characters += len(message.get("content") or "")
+            digest = prefix_hash.digest()
+            if digest in self._cached_prefixes:
+                cached_characters = characters
+            else:
+                self._cached_prefixes.add(digest)
+        cached_tokens = cached_characters // CHARACTERS_PER_TOKEN
+        if cached_tokens < PROMPT_CACHE_MIN_TOKENS:
+            return 0
+        return cached_tokens - cached_tokens % PROMPT_CACHE_STEP_TOKENS
+
+    def get_text(self, words: int) -> str:
+        # About 6 characters per word, drawn as a slice of the filler text
+        length = min(words * 6, len(FILLER_TEXT) // 2)
+        start = self._random.randrange(len(FILLER_TEXT) - length)
+        return FILLER_TEXT[start:start + length].strip()
+
+    def get_schema_instance(self, schema: dict):
+        """A random value that is valid for the (structured outputs subset of) JSON schema"""
+        if "enum" in schema:
+            if self.config.decision_weights and set(schema["enum"]) <= set(self.config.decision_weights):
+                return self._random.choices(schema["enum"], [self.config.decision_weights[value] for value in schema["enum"]])[0]
+            return self._random.choice(schema["enum"])
+        schema_type = schema.get("type")
+        if schema_type == "object":
+            return {name: self.get_schema_instance(property_schema) for name, property_schema in schema.get("properties", {}).items()}
+        if schema_type == "array":
+            return [self.get_schema_instance(schema.get("items", {})) for _ in range(self._random.randint(1, 3))]
+        if schema_type == "boolean":
+            return self._random.random() < 0.5
+        if schema_type == "integer":
+            return self._random.randint(0, 100)
+        if schema_type == "number":
+            return self._random.random() * 100
+        if schema_type == "null":
+            return None
+        return self.get_text(self.config.words_per_string)
+
+
+def _get_multipart_file(content_type: str, body: bytes) -> Optional[bytes]:
+    """Content of the "file" field of a multipart/form-data body"""
+    _, _, boundary = content_type.partition("boundary=")
+    if not boundary:
+        return None
+    for part in body.split(b"--" + boundary.strip('"').encode("latin-1")):
+        head, separator, content = part.partition(b"\r\n\r\n")
+        if separator and b'name="file"' in head:
+            return content[:-2] if content.endswith(b"\r\n") else content
+    return None
+
+
+def _run_server_process(config: MockServerConfig, host: str, port: int, port_queue):
+    server = MockProviderServer(config, host, port)
+
+    async def serve():
+        await server._start_server()
+        port_queue.put(server.port)
+        await server._server.serve_forever()
+
+    asyncio.run(serve())
+
+
+status_reasons = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a mock OpenAI compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.5, help="Median latency in seconds (lognormal)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", type=float, default=0.0)
+    parser.add_argument("--length-rate", type=float, default=0.0, help="Rate of finish_reason 'length'")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    mock_server = MockProviderServer(
+        MockServerConfig(
+            latency=LognormalLatency(args.latency) if args.latency > 0 else FixedLatency(0.0),
+            rate_limit_rate=args.rate_limit_rate,
+            server_error_rate=args.server_error_rate,
+            finish_reasons={"length": args.length_rate},
+            seed=args.seed,
+        ),
+        host=args.host,
+        port=args.port,
+    )
+    mock_server.start()
+    print(f"Mock server listening on {mock_server.base_url}")
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(mock_server.get_stats()))
+    except KeyboardInterrupt:
+        mock_server.stop()
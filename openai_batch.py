@@ -0,0 +1,217 @@
+import json
+import time
+from typing import Optional, Union
+
+from openai.types.chat import ChatCompletion
+
+from .prompt_wrapper import *
+from .llm_query import MAX_PROMPTS, Completion, add_tokens, api_names, create_response, get_response_format
+from .provider_client import ProviderClient, get_provider_client
+from .retry import call_with_retries
+from .prompt_factory import sort_by_shared_prefix
+
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Limits of the OpenAI Batch API per batch
+MAX_REQUESTS_PER_BATCH = 50_000
+MAX_BATCH_FILE_BYTES = 200 * 1024 ** 2
+
+batch_terminal_statuses = ["completed", "failed", "expired", "cancelled"]
+
+
+def create_batch_request(custom_id: str, model: LlmName, messages: list[dict], response_format: Optional[dict]) -> dict:
+    body = {
+        "model": model.value,
+        "messages": messages,
+        "n": 1,
+    }
+    if response_format:
+        body["response_format"] = response_format
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": body,
+    }
+
+
+def _split_batch_lines(lines: list[str], max_requests: int) -> list[list[str]]:
+    chunks = [[]]
+    chunk_bytes = 0
+    for line in lines:
+        line_bytes = len(line.encode("utf-8")) + 1
+        if len(chunks[-1]) >= max_requests or chunk_bytes + line_bytes > MAX_BATCH_FILE_BYTES:
+            chunks.append([])
+            chunk_bytes = 0
+        chunks[-1].append(line)
+        chunk_bytes += line_bytes
+    return [chunk for chunk in chunks if chunk]
+
+
+def _get_batch_error_item(custom_id: str, code: str, message: str) -> dict:
+    """Output line (in the format of the error file) of a request that was not answered"""
+    return {"custom_id": custom_id, "response": None, "error": {"code": code, "message": message}}
+
+
+def run_batch_requests(
+    client: ProviderClient,
+    requests: list[dict],
+    poll_interval: float = 30,
+    completion_window: str = "24h",
+    max_requests_per_batch: int = MAX_REQUESTS_PER_BATCH,
+) -> dict[str, dict]:
+    """
+    Submit batch requests (see create_batch_request), wait until all batches are finished and return the output lines by custom_id.
+    Requests are split into several batches if they exceed the per batch limits.
+    The output of batches that failed, expired or were cancelled is kept, their unanswered requests
+    (and the ones of batches that could not be submitted) get an error line, see parse_batch_result.
+    """
+    lines = [json.dumps(request) for request in requests]
+    results = {}
+    batch_ids = {}
+    offset = 0
+    for chunk in _split_batch_lines(lines, max_requests_per_batch):
+        custom_ids = [request["custom_id"] for request in requests[offset:offset + len(chunk)]]
+        offset += len(chunk)
+        try:
+            input_file, _ = call_with_retries(lambda: client.client.files.create(
+                file=("batch_input.jsonl", ("\n".join(chunk) + "\n").encode("utf-8")),
+                purpose="batch",
+            ), client.provider)
+            batch, _ = call_with_retries(lambda: client.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window=completion_window,
+            ), client.provider)
+        except Exception as e:
+            print(f"Submitting a batch of {len(chunk)} requests failed: {e}")
+            for custom_id in custom_ids:
+                results[custom_id] = _get_batch_error_item(custom_id, "submission_failed", f"The batch could not be submitted: {e}")
+            continue
+        print(f"Submitted batch {batch.id} with {len(chunk)} requests")
+        batch_ids[batch.id] = custom_ids
+
+    for batch_id, custom_ids in batch_ids.items():
+        try:
+            batch, _ = call_with_retries(lambda: client.client.batches.retrieve(batch_id), client.provider)
+            while batch.status not in batch_terminal_statuses:
+                time.sleep(poll_interval)
+                batch, _ = call_with_retries(lambda: client.client.batches.retrieve(batch_id), client.provider)
+
+            if batch.status != "completed":
+                print(f"Batch {batch_id} finished with status '{batch.status}', keeping its partial output")
+
+            # Successful requests end up in the output file, failed ones in the error file
+            for file_id in [batch.output_file_id, batch.error_file_id]:
+                if not file_id:
+                    continue
+                content, _ = call_with_retries(lambda: client.client.files.content(file_id), client.provider)
+                for line in content.text.splitlines():
+                    if line.strip():
+                        item = json.loads(line)
+                        results[item["custom_id"]] = item
+            code, message = batch.status, f"No output in batch {batch_id}, which finished with status '{batch.status}'"
+        except Exception as e:
+            print(f"Retrieving the results of batch {batch_id} failed: {e}")
+            code, message = "retrieval_failed", f"The results of batch {batch_id} could not be retrieved: {e}"
+
+        for custom_id in custom_ids:
+            if custom_id not in results:
+                results[custom_id] = _get_batch_error_item(custom_id, code, message)
+    return results
+
+
+def parse_batch_result(item: Optional[dict], api_name: str) -> Completion:
+    """Turn an output line of a batch into a Completion, applying the same checks as the direct API calls."""
+    if item is None:
+        raise Exception(f"No response from {api_name}")
+    if item.get("error"):
+        raise Exception(f"Batch request failed: {item['error']}")
+    response = item["response"]
+    if response["status_code"] != 200:
+        raise Exception(f"Batch request failed with status code {response['status_code']}: {response['body']}")
+    return Completion.from_chat_completion(ChatCompletion.model_validate(response["body"]), api_name)
+
+
+def query_prompts_batch(
+    api_key: str,
+    wrapped_prompts: list[PromptWrapper],
+    model: LlmName = LlmName.GPT4O,
+    client: Optional[ProviderClient] = None,
+    poll_interval: float = 30,
+    completion_window: str = "24h",
+    max_requests_per_batch: int = MAX_REQUESTS_PER_BATCH,
+) -> list[Union[Response, Exception]]:
+    """
+    Query PromptWrappers through the (cheaper, but asynchronous) OpenAI Batch API.
+    The PromptWrapper _id is used as custom_id. As every turn depends on the answer to the previous one,
+    multi-turn prompts (first_unstructured_output) are sent as chained batches: one batch per turn.
+    Results are returned in the order of `wrapped_prompts`, failed prompts yield their exception.
+    Point `client` to another base URL to run against a local stand-in of the batch endpoint.
+    """
+    if client is None:
+        client = get_provider_client(model.provider, api_key)
+    api_name = api_names[client.provider]
+
+    ids = [wrapped_prompt._id for wrapped_prompt in wrapped_prompts]
+    if None in ids:
+        raise Exception("PromptWrapper ID is None")
+    if len(set(ids)) != len(ids):
+        raise Exception("PromptWrapper IDs must be unique to be used as custom_id")
+
+    messages = {wrapped_prompt._id: [] for wrapped_prompt in wrapped_prompts}
+    prompt_tokens = {wrapped_prompt._id: 0 for wrapped_prompt in wrapped_prompts}
+    completion_tokens = {wrapped_prompt._id: 0 for wrapped_prompt in wrapped_prompts}
+    cached_tokens = {wrapped_prompt._id: None for wrapped_prompt in wrapped_prompts}
+    errors: dict[str, Exception] = {}
+
+    pending = []
+    for wrapped_prompt in wrapped_prompts:
+        if len(wrapped_prompt.prompts) > MAX_PROMPTS:
+            errors[wrapped_prompt._id] = Exception("Too many prompts")
+        else:
+            pending.append(wrapped_prompt)
+
+    count = 1
+    while pending:
+        requests = []
+        # Requests with a common prefix next to each other benefit from prompt caching
+        for wrapped_prompt in sort_by_shared_prefix(pending):
+            conversation = messages[wrapped_prompt._id]
+            conversation.append({"role": "system", "content": wrapped_prompt.prompts[count - 1]})
+            requests.append(create_batch_request(wrapped_prompt._id, model, conversation, get_response_format(wrapped_prompt, count)))
+
+        print(f"Running turn {count} for {len(requests)} prompts")
+        results = run_batch_requests(client, requests, poll_interval, completion_window, max_requests_per_batch)
+
+        next_pending = []
+        for wrapped_prompt in pending:
+            try:
+                completion = parse_batch_result(results.get(wrapped_prompt._id), api_name)
+            except Exception as e:
+                errors[wrapped_prompt._id] = e
+                continue
+            messages[wrapped_prompt._id].append({"role": "assistant", "content": completion.content})
+            prompt_tokens[wrapped_prompt._id] += completion.prompt_tokens
+            completion_tokens[wrapped_prompt._id] += completion.completion_tokens
+            cached_tokens[wrapped_prompt._id] = add_tokens(cached_tokens[wrapped_prompt._id], completion.cached_tokens)
+            if count < len(wrapped_prompt.prompts):
+                next_pending.append(wrapped_prompt)
+
+        pending = next_pending
+        count += 1
+
+    responses = []
+    for wrapped_prompt in wrapped_prompts:
+        _id = wrapped_prompt._id
+        if _id in errors:
+            responses.append(errors[_id])
+            continue
+        try:
+            responses.append(create_response(wrapped_prompt, model, messages[_id], prompt_tokens[_id], completion_tokens[_id], cached_tokens[_id]))
+        except Exception as e:
+            responses.append(e)
+
+    failed = sum(1 for response in responses if isinstance(response, Exception))
+    print(f"Batch query finished: {len(responses) - failed} succeeded, {failed} failed")
+    return responses
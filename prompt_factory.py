@@ -1,10 +1,13 @@
 import itertools
 import copy
+import functools
 import json
+import math
+from typing import Callable, Iterable, Optional
 
 from .prompt_wrapper import DecisionOption, OutputComponentType, OutputStructure, PromptWrapper
 from .version import VERSION
-from .dilemma_wrapper import dilemmas, get_dilemma
+from .dilemma_wrapper import DilemmaWrapper, dilemmas, get_dilemma
 
 option_str = {
     DecisionOption.YES: DecisionOption.YES.value,
@@ -59,32 +62,84 @@ output_component_type_values = {
 }
 
 
+# (add_normative_ethical_theory_explanation, add_decision_reason, first_unstructured_output) in enumeration order
+output_structure_flag_combinations = list(itertools.product([True, False], repeat=3))
+# (prompt_has_output_structure_description, prompt_has_output_structure_json_schema) in enumeration order
+prompt_structure_flag_combinations = list(itertools.product([True, False], repeat=2))
+
+
+def get_unsorted_output_components(add_normative_ethical_theory_explanation: bool, add_decision_reason: bool) -> list[OutputComponentType]:
+    sorted_output_components = []
+    if add_normative_ethical_theory_explanation:
+        sorted_output_components.append(
+            OutputComponentType.NORMATIVE_ETHICAL_THEORY_EXPLANATION)
+    if add_decision_reason:
+        sorted_output_components.append(
+            OutputComponentType.DECISION_REASON)
+    sorted_output_components.append(
+        OutputComponentType.DECISION)
+    return sorted_output_components
+
+
+def get_output_structure_branch_size(add_normative_ethical_theory_explanation: bool, add_decision_reason: bool) -> int:
+    """Number of OutputStructures (decision option permutations x output component permutations) for one flag combination"""
+    output_components = get_unsorted_output_components(add_normative_ethical_theory_explanation, add_decision_reason)
+    return math.factorial(len(DecisionOption)) * math.factorial(len(output_components))
+
+
+def get_output_structure_count() -> int:
+    return sum(
+        get_output_structure_branch_size(add_normative_ethical_theory_explanation, add_decision_reason)
+        for add_normative_ethical_theory_explanation, add_decision_reason, _ in output_structure_flag_combinations
+    )
+
+
+def get_possible_prompt_count() -> int:
+    """Length of get_all_possible_prompts() without generating the prompts"""
+    prompts_per_combination = get_output_structure_count() * len(prompt_structure_flag_combinations)
+    return len(base_prompts) * len(dilemmas) * len(ethical_frameworks) * prompts_per_combination
+
+
+def _get_output_structures(add_normative_ethical_theory_explanation: bool, add_decision_reason: bool, first_unstructured_output: bool):
+    for permuted_decision_options in itertools.permutations([option for option in DecisionOption]):
+        sorted_output_components = get_unsorted_output_components(add_normative_ethical_theory_explanation, add_decision_reason)
+
+        for permuted_output_components in itertools.permutations(sorted_output_components):
+            yield OutputStructure(
+                sorted_output_components=list(
+                    permuted_output_components),
+                sorted_decision_options=permuted_decision_options,
+                first_unstructured_output=first_unstructured_output
+            )
+
+
 def get_all_output_structure_combinations():
-    for add_normative_ethical_theory_explanation in [True, False]:
-        for add_decision_reason in [True, False]:
-            for first_unstructured_output in [True, False]:
-                for permuted_decision_options in itertools.permutations([option for option in DecisionOption]):
-                    sorted_output_components = []
-                    if add_normative_ethical_theory_explanation:
-                        sorted_output_components.append(
-                            OutputComponentType.NORMATIVE_ETHICAL_THEORY_EXPLANATION)
-                    if add_decision_reason:
-                        sorted_output_components.append(
-                            OutputComponentType.DECISION_REASON)
-                    sorted_output_components.append(
-                        OutputComponentType.DECISION)
-
-                    for permuted_output_components in itertools.permutations(sorted_output_components):
-                        yield OutputStructure(
-                            sorted_output_components=list(
-                                permuted_output_components),
-                            sorted_decision_options=permuted_decision_options,
-                            first_unstructured_output=first_unstructured_output
-                        )
+    for _, output_structure in get_indexed_output_structures():
+        yield output_structure
+
+
+def get_indexed_output_structures(prompt_filters: Optional[list["PromptFilter"]] = None):
+    """
+    Yields (index, OutputStructure). The index is the position in get_all_output_structure_combinations().
+    With prompt_filters, flag combinations no filter accepts are skipped without creating their OutputStructures.
+    """
+    index = 0
+    for add_normative_ethical_theory_explanation, add_decision_reason, first_unstructured_output in output_structure_flag_combinations:
+        branch_size = get_output_structure_branch_size(add_normative_ethical_theory_explanation, add_decision_reason)
+        if prompt_filters is not None and not any(
+            prompt_filter.matches_output_structure_flags(add_normative_ethical_theory_explanation, add_decision_reason, first_unstructured_output)
+            for prompt_filter in prompt_filters
+        ):
+            index += branch_size
+            continue
+
+        for output_structure in _get_output_structures(add_normative_ethical_theory_explanation, add_decision_reason, first_unstructured_output):
+            yield index, output_structure
+            index += 1
 
 
 def get_output_structure_description(ordered_output: list[OutputComponentType]):
-    if ordered_output == [OutputComponentType.DECISION]:
+    if list(ordered_output) == [OutputComponentType.DECISION]:
         return "Do not reason in your response. Just provide your decision."
 
     res = "First provide the "
@@ -118,57 +173,237 @@ base_structure_prompt = """Make sure your output follows the following JSON sche
 Do not, under any circumstances, deviate from the schema!"""
 
 
-def construct_prompts(dilemma_identifier: str, ethical_framework_identifier: str, base_prompt_identifier: str):
+class PromptFilter:
+    """
+    Criteria on the factors of a PromptWrapper. None means the factor is not restricted.
+    Checked while the prompts are generated (see get_filtered_prompts), so filtered out branches are never rendered.
+    `predicate` can express anything else, it is called with the rendered PromptWrapper.
+    """
+
+    def __init__(
+        self,
+        dilemma_identifiers: Optional[Iterable[str]] = None,
+        context_identifiers: Optional[Iterable[str]] = None,
+        type_identifiers: Optional[Iterable[str]] = None,
+        ethical_framework_identifiers: Optional[Iterable[str]] = None,
+        base_prompt_identifiers: Optional[Iterable[str]] = None,
+        has_normative_ethical_theory_explanation: Optional[bool] = None,
+        has_decision_reason: Optional[bool] = None,
+        first_unstructured_output: Optional[bool] = None,
+        prompt_has_output_structure_description: Optional[bool] = None,
+        prompt_has_output_structure_json_schema: Optional[bool] = None,
+        predicate: Optional[Callable[[PromptWrapper], bool]] = None,
+    ):
+        self.dilemma_identifiers = None if dilemma_identifiers is None else set(dilemma_identifiers)
+        self.context_identifiers = None if context_identifiers is None else set(context_identifiers)
+        self.type_identifiers = None if type_identifiers is None else set(type_identifiers)
+        self.ethical_framework_identifiers = None if ethical_framework_identifiers is None else set(ethical_framework_identifiers)
+        self.base_prompt_identifiers = None if base_prompt_identifiers is None else set(base_prompt_identifiers)
+        self.has_normative_ethical_theory_explanation = has_normative_ethical_theory_explanation
+        self.has_decision_reason = has_decision_reason
+        self.first_unstructured_output = first_unstructured_output
+        self.prompt_has_output_structure_description = prompt_has_output_structure_description
+        self.prompt_has_output_structure_json_schema = prompt_has_output_structure_json_schema
+        self.predicate = predicate
+
+    def matches_prompt_factors(self, dilemma: DilemmaWrapper, ethical_framework_identifier: str, base_prompt_identifier: str) -> bool:
+        return (
+            (self.dilemma_identifiers is None or dilemma.identifier in self.dilemma_identifiers)
+            and (self.context_identifiers is None or dilemma.context_identifier in self.context_identifiers)
+            and (self.type_identifiers is None or dilemma.type_identifier in self.type_identifiers)
+            and (self.ethical_framework_identifiers is None or ethical_framework_identifier in self.ethical_framework_identifiers)
+            and (self.base_prompt_identifiers is None or base_prompt_identifier in self.base_prompt_identifiers)
+        )
+
+    def matches_output_structure_flags(
+        self,
+        add_normative_ethical_theory_explanation: bool,
+        add_decision_reason: bool,
+        first_unstructured_output: bool,
+    ) -> bool:
+        return (
+            (
+                self.has_normative_ethical_theory_explanation is None
+                or self.has_normative_ethical_theory_explanation == add_normative_ethical_theory_explanation
+            )
+            and (self.has_decision_reason is None or self.has_decision_reason == add_decision_reason)
+            and (self.first_unstructured_output is None or self.first_unstructured_output == first_unstructured_output)
+        )
+
+    def matches_output_structure(self, output_structure: OutputStructure) -> bool:
+        return self.matches_output_structure_flags(
+            output_structure.get_has_output_component(OutputComponentType.NORMATIVE_ETHICAL_THEORY_EXPLANATION),
+            output_structure.get_has_output_component(OutputComponentType.DECISION_REASON),
+            output_structure.first_unstructured_output,
+        )
+
+    def matches_prompt_structure_flags(self, prompt_has_output_structure_description: bool, prompt_has_output_structure_json_schema: bool) -> bool:
+        return (
+            (
+                self.prompt_has_output_structure_description is None
+                or self.prompt_has_output_structure_description == prompt_has_output_structure_description
+            )
+            and (
+                self.prompt_has_output_structure_json_schema is None
+                or self.prompt_has_output_structure_json_schema == prompt_has_output_structure_json_schema
+            )
+        )
+
+    def matches_prompt(self, wrapped_prompt: PromptWrapper) -> bool:
+        return self.predicate is None or self.predicate(wrapped_prompt)
+
+
+def create_structure_prompt(
+    output_structure: OutputStructure,
+    prompt_has_output_structure_description: bool,
+    prompt_has_output_structure_json_schema: bool,
+) -> str:
+    """The structure_prompt tells the LLM how the output should be structured"""
+    structure_prompt = base_structure_prompt
+
+    if prompt_has_output_structure_description:
+        output_structure_description = get_output_structure_description(
+            output_structure.sorted_output_components)
+        structure_prompt += f"\n{output_structure_description}"
+    if prompt_has_output_structure_json_schema:
+        # Make sure the ordering of the DECISION options is consistent
+        local_output_component_type_values = copy.deepcopy(output_component_type_values)
+        local_output_component_type_values[OutputComponentType.DECISION]['type'] = [
+            option_str[option] for option in output_structure.sorted_decision_options
+        ]
+
+        output_schema_json_schema = json.dumps({
+            local_output_component_type_values[output_component]['json_key']: local_output_component_type_values[output_component]['type']
+            for output_component in output_structure.sorted_output_components
+        }, indent=4)
+        structure_prompt += f"\n{output_schema_json_schema}"
+    return structure_prompt
+
+
+@functools.lru_cache(maxsize=None)
+def get_structure_prompt(
+    output_structure: OutputStructure,
+    prompt_has_output_structure_description: bool,
+    prompt_has_output_structure_json_schema: bool,
+) -> str:
+    """
+    Cached create_structure_prompt. The structure_prompt does not depend on the dilemma, framework or base prompt,
+    so there is one entry per output structure and flag combination, shared by all of them.
+    """
+    return create_structure_prompt(output_structure, prompt_has_output_structure_description, prompt_has_output_structure_json_schema)
+
+
+def render_prompts(
+    dilemma_identifier: str,
+    ethical_framework_identifier: str,
+    base_prompt_identifier: str,
+    output_structure: OutputStructure,
+    prompt_has_output_structure_description: bool,
+    prompt_has_output_structure_json_schema: bool,
+) -> list[str]:
+    """Render the prompts of a single combination of factors."""
     dilemma = get_dilemma(dilemma_identifier)
     normative_ethical_theory = ethical_frameworks[ethical_framework_identifier]
     base_prompt = base_prompts[base_prompt_identifier]
 
-    output_structures = get_all_output_structure_combinations()
-    for output_structure in output_structures:
-        for prompt_has_output_structure_description in [True, False]:
-            for prompt_has_output_structure_json_schema in [True, False]:
-                prompt = base_prompt.format(
-                    dilemma_description=dilemma.description,
-                    normative_ethical_theory_description=normative_ethical_theory['description'],
-                )
-                # region structure_prompt
-                # The structure_prompt tells the LLM how the output should be structured
-                structure_prompt = base_structure_prompt
-
-                if prompt_has_output_structure_description:
-                    output_structure_description = get_output_structure_description(
-                        output_structure.sorted_output_components)
-                    structure_prompt += f"\n{output_structure_description}"
-                if prompt_has_output_structure_json_schema:
-                    # Make sure the ordering of the DECISION options is consistent
-                    local_output_component_type_values = copy.deepcopy(output_component_type_values)
-                    local_output_component_type_values[OutputComponentType.DECISION]['type'] = [
-                        option_str[option] for option in output_structure.sorted_decision_options
-                    ]
-
-                    output_schema_json_schema = json.dumps({
-                        local_output_component_type_values[output_component]['json_key']: local_output_component_type_values[output_component]['type']
-                        for output_component in output_structure.sorted_output_components
-                    }, indent=4)
-                    structure_prompt += f"\n{output_schema_json_schema}"
-                # endregin
-
-                if not output_structure.first_unstructured_output:
-                    prompt += f"\n{structure_prompt}"
-                    prompts = [prompt]
-                else:
-                    prompts = [prompt, structure_prompt]
-
-                yield PromptWrapper(
-                    prompts=prompts,
-                    dilemma_identifier=dilemma_identifier,
-                    ethical_framework_identifier=ethical_framework_identifier,
-                    base_prompt_identifier=base_prompt_identifier,
-                    prompt_has_output_structure_description=prompt_has_output_structure_description,
-                    prompt_has_output_structure_json_schema=prompt_has_output_structure_json_schema,
-                    output_structure=output_structure,
-                    version=VERSION
-                )
+    prompt = base_prompt.format(
+        dilemma_description=dilemma.description,
+        normative_ethical_theory_description=normative_ethical_theory['description'],
+    )
+    structure_prompt = get_structure_prompt(output_structure, prompt_has_output_structure_description, prompt_has_output_structure_json_schema)
+
+    if not output_structure.first_unstructured_output:
+        prompt += f"\n{structure_prompt}"
+        prompts = [prompt]
+    else:
+        prompts = [prompt, structure_prompt]
+    return prompts
+
+
+@functools.lru_cache(maxsize=4096)
+def get_rendered_prompts(
+    dilemma_identifier: str,
+    ethical_framework_identifier: str,
+    base_prompt_identifier: str,
+    output_structure: OutputStructure,
+    prompt_has_output_structure_description: bool,
+    prompt_has_output_structure_json_schema: bool,
+) -> tuple[str, ...]:
+    """Cached render_prompts, used by PromptWrappers that only store their factors."""
+    return tuple(render_prompts(
+        dilemma_identifier,
+        ethical_framework_identifier,
+        base_prompt_identifier,
+        output_structure,
+        prompt_has_output_structure_description,
+        prompt_has_output_structure_json_schema,
+    ))
+
+
+def construct_prompt_wrapper(
+    dilemma_identifier: str,
+    ethical_framework_identifier: str,
+    base_prompt_identifier: str,
+    output_structure: OutputStructure,
+    prompt_has_output_structure_description: bool,
+    prompt_has_output_structure_json_schema: bool,
+) -> PromptWrapper:
+    """
+    Create the PromptWrapper of a single combination of factors (without an ID).
+    The prompts are not stored but rendered on access (see get_rendered_prompts).
+    """
+    return PromptWrapper(
+        prompts=None,
+        dilemma_identifier=dilemma_identifier,
+        ethical_framework_identifier=ethical_framework_identifier,
+        base_prompt_identifier=base_prompt_identifier,
+        prompt_has_output_structure_description=prompt_has_output_structure_description,
+        prompt_has_output_structure_json_schema=prompt_has_output_structure_json_schema,
+        output_structure=output_structure,
+        version=VERSION
+    )
+
+
+def construct_prompts(dilemma_identifier: str, ethical_framework_identifier: str, base_prompt_identifier: str):
+    for _, wrapped_prompt in construct_indexed_prompts(dilemma_identifier, ethical_framework_identifier, base_prompt_identifier):
+        yield wrapped_prompt
+
+
+def construct_indexed_prompts(
+    dilemma_identifier: str,
+    ethical_framework_identifier: str,
+    base_prompt_identifier: str,
+    prompt_filters: Optional[list[PromptFilter]] = None,
+):
+    """
+    Yields (index, PromptWrapper). The index is the position in construct_prompts().
+    With prompt_filters (combined with OR), branches no filter accepts are skipped before any prompt is rendered.
+    """
+    for output_structure_index, output_structure in get_indexed_output_structures(prompt_filters):
+        if prompt_filters is not None:
+            output_structure_filters = [prompt_filter for prompt_filter in prompt_filters if prompt_filter.matches_output_structure(output_structure)]
+
+        for flag_index, (prompt_has_output_structure_description, prompt_has_output_structure_json_schema) in enumerate(prompt_structure_flag_combinations):
+            if prompt_filters is not None:
+                matching_filters = [
+                    prompt_filter for prompt_filter in output_structure_filters
+                    if prompt_filter.matches_prompt_structure_flags(prompt_has_output_structure_description, prompt_has_output_structure_json_schema)
+                ]
+                if not matching_filters:
+                    continue
+
+            wrapped_prompt = construct_prompt_wrapper(
+                dilemma_identifier,
+                ethical_framework_identifier,
+                base_prompt_identifier,
+                output_structure,
+                prompt_has_output_structure_description,
+                prompt_has_output_structure_json_schema,
+            )
+            if prompt_filters is not None and not any(prompt_filter.matches_prompt(wrapped_prompt) for prompt_filter in matching_filters):
+                continue
+
+            yield output_structure_index * len(prompt_structure_flag_combinations) + flag_index, wrapped_prompt
 
 
 def add_id_to_prompts(prompts: list[PromptWrapper]):
@@ -191,6 +426,48 @@ def get_all_possible_prompts():
     return generated_prompts
 
 
+def get_filtered_prompts(*prompt_filters: PromptFilter) -> list[PromptWrapper]:
+    """
+    Same result as filtering get_all_possible_prompts() (including the IDs), but every branch of the generation
+    that no filter accepts is skipped before any prompt is rendered. Several filters are combined with OR.
+    Without filters the space is not restricted, i.e. all possible prompts are returned.
+    """
+    if not prompt_filters:
+        return get_all_possible_prompts()
+    prompts_per_combination = get_output_structure_count() * len(prompt_structure_flag_combinations)
+
+    generated_prompts = []
+    offset = 0
+    for base_prompt_identifier in base_prompts.keys():
+        for dilemma in dilemmas:
+            for ethical_framework_identifier in ethical_frameworks.keys():
+                matching_filters = [
+                    prompt_filter for prompt_filter in prompt_filters
+                    if prompt_filter.matches_prompt_factors(dilemma, ethical_framework_identifier, base_prompt_identifier)
+                ]
+                if matching_filters:
+                    for index, wrapped_prompt in construct_indexed_prompts(
+                        dilemma.identifier,
+                        ethical_framework_identifier,
+                        base_prompt_identifier,
+                        matching_filters,
+                    ):
+                        wrapped_prompt.add_id(f'{VERSION}_{offset + index}')
+                        generated_prompts.append(wrapped_prompt)
+                offset += prompts_per_combination
+    return generated_prompts
+
+
+def sort_by_shared_prefix(wrapped_prompts: Iterable[PromptWrapper]) -> list[PromptWrapper]:
+    """
+    Order the prompts so that prompts with a common prefix (same base prompt, then dilemma, then ethical framework, ...)
+    are sent right after each other. Providers with automatic prompt caching (OpenAI, DeepSeek) then serve the shared
+    prefix from their cache, which is cheaper and faster. Sorting the prompt texts lexicographically puts every group
+    of prompts with a common prefix next to each other.
+    """
+    return sorted(wrapped_prompts, key=lambda wrapped_prompt: wrapped_prompt.prompts)
+
+
 if __name__ == '__main__':
     prompts = get_all_possible_prompts()
     for wrapped_prompt in prompts:
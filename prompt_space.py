@@ -0,0 +1,402 @@
+import copy
+import math
+import random
+from typing import Iterator, Optional, Sequence
+
+from .prompt_wrapper import DecisionOption, OutputComponentType, OutputStructure, PromptWrapper
+from .dilemma_wrapper import dilemmas, get_dilemma
+from .prompt_factory import (
+    PromptFilter,
+    base_prompts,
+    construct_prompt_wrapper,
+    ethical_frameworks,
+    get_output_structure_branch_size,
+    get_output_structure_count,
+    get_unsorted_output_components,
+    output_structure_flag_combinations,
+    prompt_structure_flag_combinations,
+)
+from .version import VERSION
+
+
+def unrank_permutation(items: Sequence, rank: int) -> list:
+    """The rank-th permutation of items in the order of itertools.permutations(items)."""
+    remaining = list(items)
+    res = []
+    for position in range(len(remaining), 0, -1):
+        index, rank = divmod(rank, math.factorial(position - 1))
+        res.append(remaining.pop(index))
+    return res
+
+
+def rank_permutation(items: Sequence, permutation: Sequence) -> int:
+    """Inverse of unrank_permutation."""
+    remaining = list(items)
+    rank = 0
+    for position, item in zip(range(len(remaining), 0, -1), permutation):
+        index = remaining.index(item)
+        rank += index * math.factorial(position - 1)
+        remaining.pop(index)
+    return rank
+
+
+class OutputStructureBranch:
+    """
+    All OutputStructures of one (add_normative_ethical_theory_explanation, add_decision_reason, first_unstructured_output) combination,
+    optionally restricted to some of the permutations of the decision options and output components (by their rank, see rank_permutation).
+    """
+
+    def __init__(self, add_normative_ethical_theory_explanation: bool, add_decision_reason: bool, first_unstructured_output: bool, offset: int):
+        self.add_normative_ethical_theory_explanation = add_normative_ethical_theory_explanation
+        self.add_decision_reason = add_decision_reason
+        self.first_unstructured_output = first_unstructured_output
+        self.output_components = get_unsorted_output_components(add_normative_ethical_theory_explanation, add_decision_reason)
+        self.decision_options_ranks = list(range(math.factorial(len(DecisionOption))))
+        self.output_components_ranks = list(range(math.factorial(len(self.output_components))))
+        self.size = get_output_structure_branch_size(add_normative_ethical_theory_explanation, add_decision_reason)
+        # Index of the first OutputStructure of this branch in get_all_output_structure_combinations()
+        self.offset = offset
+
+    def restrict_ranks(self, decision_options_ranks: list[int], output_components_ranks: list[int]) -> "OutputStructureBranch":
+        res = copy.copy(self)
+        res.decision_options_ranks = decision_options_ranks
+        res.output_components_ranks = output_components_ranks
+        res.size = len(decision_options_ranks) * len(output_components_ranks)
+        return res
+
+    def _get_ranks(self, index: int) -> tuple[int, int]:
+        decision_options_index, output_components_index = divmod(index, len(self.output_components_ranks))
+        return self.decision_options_ranks[decision_options_index], self.output_components_ranks[output_components_index]
+
+    def get_output_structure(self, index: int) -> OutputStructure:
+        decision_options_rank, output_components_rank = self._get_ranks(index)
+        return OutputStructure(
+            sorted_output_components=unrank_permutation(self.output_components, output_components_rank),
+            sorted_decision_options=tuple(unrank_permutation(list(DecisionOption), decision_options_rank)),
+            first_unstructured_output=self.first_unstructured_output,
+        )
+
+    def get_global_index(self, index: int) -> int:
+        """Position of the index-th OutputStructure of this branch in get_all_output_structure_combinations()"""
+        decision_options_rank, output_components_rank = self._get_ranks(index)
+        return self.offset + decision_options_rank * math.factorial(len(self.output_components)) + output_components_rank
+
+    def get_index(self, output_structure: OutputStructure) -> int:
+        decision_options_rank = rank_permutation(list(DecisionOption), output_structure.sorted_decision_options)
+        output_components_rank = rank_permutation(self.output_components, output_structure.sorted_output_components)
+        return (
+            self.decision_options_ranks.index(decision_options_rank) * len(self.output_components_ranks)
+            + self.output_components_ranks.index(output_components_rank)
+        )
+
+    def matches(self, output_structure: OutputStructure) -> bool:
+        return (
+            output_structure.get_has_output_component(OutputComponentType.NORMATIVE_ETHICAL_THEORY_EXPLANATION)
+            == self.add_normative_ethical_theory_explanation
+            and output_structure.get_has_output_component(OutputComponentType.DECISION_REASON) == self.add_decision_reason
+            and output_structure.first_unstructured_output == self.first_unstructured_output
+            and rank_permutation(list(DecisionOption), output_structure.sorted_decision_options) in self.decision_options_ranks
+            and rank_permutation(self.output_components, output_structure.sorted_output_components) in self.output_components_ranks
+        )
+
+
+def _get_all_output_structure_branches() -> list[OutputStructureBranch]:
+    branches = []
+    offset = 0
+    for add_normative_ethical_theory_explanation, add_decision_reason, first_unstructured_output in output_structure_flag_combinations:
+        branch = OutputStructureBranch(add_normative_ethical_theory_explanation, add_decision_reason, first_unstructured_output, offset)
+        branches.append(branch)
+        offset += branch.size
+    return branches
+
+
+class PromptSpace:
+    """
+    Random access view of get_all_possible_prompts() (optionally restricted by a PromptFilter) that never enumerates it.
+    space[i] renders the i-th prompt of the space, space.index_of(wrapped_prompt) is the inverse.
+    The IDs of the rendered PromptWrappers are the same as in get_all_possible_prompts().
+
+    The space is the product of the factors
+    base prompt x dilemma x ethical framework x output structure (flag combination x decision option permutation
+    x output component permutation) x prompt structure flags, enumerated in the same order as get_all_possible_prompts().
+    The permutations are factors as well, their levels are the ranks of sorted_decision_options and sorted_output_components
+    in the order of itertools.permutations (see rank_permutation). The output components differ between the flag combinations,
+    so a rank of sorted_output_components_rank stands for a different order of components in each of them.
+    """
+
+    # Factors that can be used to restrict the space or to stratify samples
+    factors = [
+        "base_prompt_identifier",
+        "dilemma_identifier",
+        "context_identifier",
+        "type_identifier",
+        "ethical_framework_identifier",
+        "has_normative_ethical_theory_explanation",
+        "has_decision_reason",
+        "first_unstructured_output",
+        "prompt_has_output_structure_description",
+        "prompt_has_output_structure_json_schema",
+        "sorted_decision_options_rank",
+        "sorted_output_components_rank",
+    ]
+
+    def __init__(self, prompt_filter: Optional[PromptFilter] = None):
+        prompt_filter = prompt_filter or PromptFilter()
+        if prompt_filter.predicate is not None:
+            raise ValueError("A PromptSpace cannot be restricted by a predicate")
+
+        self.base_prompt_identifiers = [
+            identifier for identifier in base_prompts.keys()
+            if prompt_filter.base_prompt_identifiers is None or identifier in prompt_filter.base_prompt_identifiers
+        ]
+        self.dilemma_identifiers = [
+            dilemma.identifier for dilemma in dilemmas
+            if (prompt_filter.dilemma_identifiers is None or dilemma.identifier in prompt_filter.dilemma_identifiers)
+            and (prompt_filter.context_identifiers is None or dilemma.context_identifier in prompt_filter.context_identifiers)
+            and (prompt_filter.type_identifiers is None or dilemma.type_identifier in prompt_filter.type_identifiers)
+        ]
+        self.ethical_framework_identifiers = [
+            identifier for identifier in ethical_frameworks.keys()
+            if prompt_filter.ethical_framework_identifiers is None or identifier in prompt_filter.ethical_framework_identifiers
+        ]
+        self.output_structure_branches = [
+            branch for branch in _get_all_output_structure_branches()
+            if prompt_filter.matches_output_structure_flags(
+                branch.add_normative_ethical_theory_explanation, branch.add_decision_reason, branch.first_unstructured_output
+            )
+        ]
+        self.prompt_structure_flags = [
+            flags for flags in prompt_structure_flag_combinations
+            if prompt_filter.matches_prompt_structure_flags(*flags)
+        ]
+
+        # Positions in the unrestricted enumeration
+        self._base_prompt_positions = {identifier: i for i, identifier in enumerate(base_prompts.keys())}
+        self._dilemma_positions = {dilemma.identifier: i for i, dilemma in enumerate(dilemmas)}
+        self._ethical_framework_positions = {identifier: i for i, identifier in enumerate(ethical_frameworks.keys())}
+        self._prompt_structure_flag_positions = {flags: i for i, flags in enumerate(prompt_structure_flag_combinations)}
+        self._update_sizes()
+
+    def _update_sizes(self):
+        self._output_structure_count = sum(branch.size for branch in self.output_structure_branches)
+        self._prompts_per_combination = self._output_structure_count * len(self.prompt_structure_flags)
+        self._size = (
+            len(self.base_prompt_identifiers)
+            * len(self.dilemma_identifiers)
+            * len(self.ethical_framework_identifiers)
+            * self._prompts_per_combination
+        )
+
+    def __len__(self):
+        return self._size
+
+    def get_global_index(self, index: int) -> int:
+        """Position of the index-th prompt of this space in get_all_possible_prompts()"""
+        base_prompt_identifier, dilemma_identifier, ethical_framework_identifier, branch, output_structure_index, flags = self._unrank(index)
+        return self._get_global_index(
+            base_prompt_identifier,
+            dilemma_identifier,
+            ethical_framework_identifier,
+            branch.get_global_index(output_structure_index),
+            flags,
+        )
+
+    def _get_global_index(
+        self,
+        base_prompt_identifier: str,
+        dilemma_identifier: str,
+        ethical_framework_identifier: str,
+        global_output_structure_index: int,
+        flags: tuple,
+    ) -> int:
+        combination_index = (
+            self._base_prompt_positions[base_prompt_identifier] * len(dilemmas) + self._dilemma_positions[dilemma_identifier]
+        ) * len(ethical_frameworks) + self._ethical_framework_positions[ethical_framework_identifier]
+        prompts_per_combination = get_output_structure_count() * len(prompt_structure_flag_combinations)
+        return (
+            combination_index * prompts_per_combination
+            + global_output_structure_index * len(prompt_structure_flag_combinations)
+            + self._prompt_structure_flag_positions[flags]
+        )
+
+    def _unrank(self, index: int):
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("PromptSpace index out of range")
+
+        combination_index, index = divmod(index, self._prompts_per_combination)
+        base_prompt_index, combination_index = divmod(
+            combination_index, len(self.dilemma_identifiers) * len(self.ethical_framework_identifiers)
+        )
+        dilemma_index, ethical_framework_index = divmod(combination_index, len(self.ethical_framework_identifiers))
+        output_structure_index, flags_index = divmod(index, len(self.prompt_structure_flags))
+
+        for branch in self.output_structure_branches:
+            if output_structure_index < branch.size:
+                break
+            output_structure_index -= branch.size
+
+        return (
+            self.base_prompt_identifiers[base_prompt_index],
+            self.dilemma_identifiers[dilemma_index],
+            self.ethical_framework_identifiers[ethical_framework_index],
+            branch,
+            output_structure_index,
+            self.prompt_structure_flags[flags_index],
+        )
+
+    def __getitem__(self, index: int) -> PromptWrapper:
+        base_prompt_identifier, dilemma_identifier, ethical_framework_identifier, branch, output_structure_index, flags = self._unrank(index)
+        wrapped_prompt = construct_prompt_wrapper(
+            dilemma_identifier,
+            ethical_framework_identifier,
+            base_prompt_identifier,
+            branch.get_output_structure(output_structure_index),
+            *flags,
+        )
+        global_index = self._get_global_index(
+            base_prompt_identifier,
+            dilemma_identifier,
+            ethical_framework_identifier,
+            branch.get_global_index(output_structure_index),
+            flags,
+        )
+        wrapped_prompt.add_id(f'{VERSION}_{global_index}')
+        return wrapped_prompt
+
+    def __iter__(self) -> Iterator[PromptWrapper]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def index_of(self, wrapped_prompt: PromptWrapper) -> int:
+        """Index of a PromptWrapper (matched by its factors) in this space. Raises ValueError if it is not part of it."""
+        flags = (wrapped_prompt.prompt_has_output_structure_description, wrapped_prompt.prompt_has_output_structure_json_schema)
+        branch_index = next(
+            (i for i, branch in enumerate(self.output_structure_branches) if branch.matches(wrapped_prompt.output_structure)),
+            None,
+        )
+        if (
+            wrapped_prompt.base_prompt_identifier not in self.base_prompt_identifiers
+            or wrapped_prompt.dilemma_identifier not in self.dilemma_identifiers
+            or wrapped_prompt.ethical_framework_identifier not in self.ethical_framework_identifiers
+            or flags not in self.prompt_structure_flags
+            or branch_index is None
+        ):
+            raise ValueError("The PromptWrapper is not part of this PromptSpace")
+
+        output_structure_index = sum(branch.size for branch in self.output_structure_branches[:branch_index])
+        output_structure_index += self.output_structure_branches[branch_index].get_index(wrapped_prompt.output_structure)
+
+        combination_index = (
+            self.base_prompt_identifiers.index(wrapped_prompt.base_prompt_identifier) * len(self.dilemma_identifiers)
+            + self.dilemma_identifiers.index(wrapped_prompt.dilemma_identifier)
+        ) * len(self.ethical_framework_identifiers) + self.ethical_framework_identifiers.index(wrapped_prompt.ethical_framework_identifier)
+        return (
+            combination_index * self._prompts_per_combination
+            + output_structure_index * len(self.prompt_structure_flags)
+            + self.prompt_structure_flags.index(flags)
+        )
+
+    def __contains__(self, wrapped_prompt: PromptWrapper) -> bool:
+        try:
+            self.index_of(wrapped_prompt)
+        except ValueError:
+            return False
+        return True
+
+    def get_factor_levels(self, factor: str) -> list:
+        if factor == "base_prompt_identifier":
+            return list(self.base_prompt_identifiers)
+        if factor == "dilemma_identifier":
+            return list(self.dilemma_identifiers)
+        if factor == "context_identifier":
+            return list(dict.fromkeys(get_dilemma(identifier).context_identifier for identifier in self.dilemma_identifiers))
+        if factor == "type_identifier":
+            return list(dict.fromkeys(get_dilemma(identifier).type_identifier for identifier in self.dilemma_identifiers))
+        if factor == "ethical_framework_identifier":
+            return list(self.ethical_framework_identifiers)
+        if factor in ["has_normative_ethical_theory_explanation", "has_decision_reason", "first_unstructured_output"]:
+            return list(dict.fromkeys(getattr(branch, self._get_branch_attribute(factor)) for branch in self.output_structure_branches))
+        if factor == "prompt_has_output_structure_description":
+            return list(dict.fromkeys(description for description, _ in self.prompt_structure_flags))
+        if factor == "prompt_has_output_structure_json_schema":
+            return list(dict.fromkeys(json_schema for _, json_schema in self.prompt_structure_flags))
+        if factor == "sorted_decision_options_rank":
+            return sorted(set(rank for branch in self.output_structure_branches for rank in branch.decision_options_ranks))
+        if factor == "sorted_output_components_rank":
+            return sorted(set(rank for branch in self.output_structure_branches for rank in branch.output_components_ranks))
+        raise ValueError(f"Unknown factor: {factor}")
+
+    @staticmethod
+    def _get_branch_attribute(factor: str) -> str:
+        return {
+            "has_normative_ethical_theory_explanation": "add_normative_ethical_theory_explanation",
+            "has_decision_reason": "add_decision_reason",
+            "first_unstructured_output": "first_unstructured_output",
+        }[factor]
+
+    def restrict(self, factor: str, level) -> "PromptSpace":
+        """Sub-space of the prompts whose `factor` equals `level`."""
+        res = copy.copy(self)
+        if factor == "base_prompt_identifier":
+            res.base_prompt_identifiers = [x for x in self.base_prompt_identifiers if x == level]
+        elif factor == "dilemma_identifier":
+            res.dilemma_identifiers = [x for x in self.dilemma_identifiers if x == level]
+        elif factor == "context_identifier":
+            res.dilemma_identifiers = [x for x in self.dilemma_identifiers if get_dilemma(x).context_identifier == level]
+        elif factor == "type_identifier":
+            res.dilemma_identifiers = [x for x in self.dilemma_identifiers if get_dilemma(x).type_identifier == level]
+        elif factor == "ethical_framework_identifier":
+            res.ethical_framework_identifiers = [x for x in self.ethical_framework_identifiers if x == level]
+        elif factor in ["has_normative_ethical_theory_explanation", "has_decision_reason", "first_unstructured_output"]:
+            attribute = self._get_branch_attribute(factor)
+            res.output_structure_branches = [x for x in self.output_structure_branches if getattr(x, attribute) == level]
+        elif factor == "prompt_has_output_structure_description":
+            res.prompt_structure_flags = [x for x in self.prompt_structure_flags if x[0] == level]
+        elif factor == "prompt_has_output_structure_json_schema":
+            res.prompt_structure_flags = [x for x in self.prompt_structure_flags if x[1] == level]
+        elif factor == "sorted_decision_options_rank":
+            res.output_structure_branches = [
+                x.restrict_ranks([level], x.output_components_ranks)
+                for x in self.output_structure_branches if level in x.decision_options_ranks
+            ]
+        elif factor == "sorted_output_components_rank":
+            res.output_structure_branches = [
+                x.restrict_ranks(x.decision_options_ranks, [level])
+                for x in self.output_structure_branches if level in x.output_components_ranks
+            ]
+        else:
+            raise ValueError(f"Unknown factor: {factor}")
+        res._update_sizes()
+        return res
+
+    def sample(self, n: int, seed: Optional[int] = None) -> list[PromptWrapper]:
+        """Uniform sample of n different prompts (in enumeration order)."""
+        rng = random.Random(seed)
+        return [self[index] for index in sorted(rng.sample(range(len(self)), min(n, len(self))))]
+
+    def stratified_sample(self, n_per_stratum: int, stratify_by: list[str], seed: Optional[int] = None) -> list[PromptWrapper]:
+        """
+        Uniform sample of n_per_stratum prompts for every combination of the levels of the `stratify_by` factors.
+        Strata with less than n_per_stratum prompts are taken completely.
+        """
+        rng = random.Random(seed)
+        strata = [self]
+        for factor in stratify_by:
+            strata = [stratum.restrict(factor, level) for stratum in strata for level in stratum.get_factor_levels(factor)]
+
+        res = []
+        for stratum in strata:
+            if len(stratum) == 0:
+                continue
+            indices = sorted(rng.sample(range(len(stratum)), min(n_per_stratum, len(stratum))))
+            res += [stratum[index] for index in indices]
+        return res
+
+    def get_shard(self, shard_index: int, shard_count: int) -> Iterator[PromptWrapper]:
+        """The shard_index-th of shard_count contiguous, equally sized parts of the space."""
+        start = len(self) * shard_index // shard_count
+        stop = len(self) * (shard_index + 1) // shard_count
+        for index in range(start, stop):
+            yield self[index]
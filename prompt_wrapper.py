@@ -2,6 +2,7 @@ from enum import Enum
 from typing import Literal, Optional
 
 from .dilemma_wrapper import DilemmaWrapper, InvertableDilemmaWrapper, get_dilemma
+from .version import VERSION
 
 
 class DecisionOption(Enum):
@@ -17,14 +18,60 @@ class OutputComponentType(Enum):
 
 
 class OutputStructure:
-    sorted_output_components: list[OutputComponentType]
-    sorted_decision_options: list[DecisionOption]
+    """
+    Immutable and interned: there is a single instance per distinct structure, so OutputStructure(...) and from_dict
+    return the shared instance and the JSON schema and analysis fields are computed only once per structure.
+    """
+    __slots__ = ("sorted_output_components", "sorted_decision_options", "first_unstructured_output", "_key", "_hash", "_json_schema", "_analysis_dict")
+
+    sorted_output_components: tuple[OutputComponentType, ...]
+    sorted_decision_options: tuple[DecisionOption, ...]
     first_unstructured_output: bool
 
+    _instances: dict = {}
+
+    def __new__(cls, sorted_output_components: list[OutputComponentType], sorted_decision_options: list[DecisionOption], first_unstructured_output: bool):
+        key = (tuple(sorted_output_components), tuple(sorted_decision_options), bool(first_unstructured_output))
+        instance = cls._instances.get(key)
+        if instance is not None:
+            return instance
+
+        instance = super().__new__(cls)
+        object.__setattr__(instance, "sorted_output_components", key[0])
+        object.__setattr__(instance, "sorted_decision_options", key[1])
+        object.__setattr__(instance, "first_unstructured_output", key[2])
+        object.__setattr__(instance, "_key", key)
+        # Hashing the key hashes every enum member, structures are used as dict keys in hot loops
+        object.__setattr__(instance, "_hash", hash(key))
+        object.__setattr__(instance, "_json_schema", None)
+        object.__setattr__(instance, "_analysis_dict", None)
+        # setdefault keeps the first instance if another thread created the same structure concurrently
+        return cls._instances.setdefault(key, instance)
+
     def __init__(self, sorted_output_components: list[OutputComponentType], sorted_decision_options: list[DecisionOption], first_unstructured_output: bool):
-        self.sorted_output_components = sorted_output_components
-        self.sorted_decision_options = sorted_decision_options
-        self.first_unstructured_output = first_unstructured_output
+        # Everything is set up in __new__
+        pass
+
+    def __setattr__(self, name, value):
+        raise AttributeError("OutputStructure is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("OutputStructure is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, OutputStructure):
+            return NotImplemented
+        return self._key == other._key
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        # Copies and unpickled objects go through __new__ and thus resolve to the shared instance
+        return (OutputStructure, self._key)
+
+    def __repr__(self):
+        return f"OutputStructure({self.to_dict()})"
 
     @property
     def default_order_output_components(self) -> list[OutputComponentType]:
@@ -80,8 +127,13 @@ class OutputStructure:
     def get_json_schema(self) -> object:
         """
         Get the OpenAI structured output schema for the current OutputStructure object.
+        The schema is shared by every user of the structure, do not modify it.
         """
+        if self._json_schema is None:
+            object.__setattr__(self, "_json_schema", self._create_json_schema())
+        return self._json_schema
 
+    def _create_json_schema(self) -> dict:
         sorted_output_components_schema = {}
         for output_component in self.sorted_output_components:
             if output_component == OutputComponentType.DECISION:
@@ -115,6 +167,11 @@ class OutputStructure:
         }
 
     def to_analysis_dict(self):
+        if self._analysis_dict is None:
+            object.__setattr__(self, "_analysis_dict", self._create_analysis_dict())
+        return dict(self._analysis_dict)
+
+    def _create_analysis_dict(self) -> dict:
         res = self.to_dict()
         res.update({
             # New fields
@@ -146,8 +203,52 @@ class OutputStructure:
         )
 
 
+class TextTable:
+    """
+    The distinct prompt texts of a compact file. Compact PromptWrapper dictionaries reference their texts by id
+    ("prompt_text_ids") and every text is written once as {"text_id": ..., "text": ...} record before the first
+    dictionary referencing it (see prompts_json). Compact files thus store the texts that were actually sent
+    and can be read without the templates of the library version that wrote them.
+    """
+
+    def __init__(self):
+        self._ids: dict[str, int] = {}
+        self._texts: dict[int, str] = {}
+        self._new_records: list[dict] = []
+
+    @staticmethod
+    def is_record(item: dict) -> bool:
+        return "text_id" in item
+
+    def get_id(self, text: str) -> int:
+        text_id = self._ids.get(text)
+        if text_id is None:
+            text_id = len(self._texts)
+            self._ids[text] = text_id
+            self._texts[text_id] = text
+            self._new_records.append({"text_id": text_id, "text": text})
+        return text_id
+
+    def pop_new_records(self) -> list[dict]:
+        """The records of the texts added since the last call, they have to be written before the dictionaries referencing them."""
+        res = self._new_records
+        self._new_records = []
+        return res
+
+    def add_record(self, record: dict):
+        """Add a text record read from a file."""
+        self._ids[record["text"]] = record["text_id"]
+        self._texts[record["text_id"]] = record["text"]
+
+    def get_text(self, text_id: int) -> str:
+        return self._texts[text_id]
+
+
 class PromptWrapper:
-    prompts: list[str]
+    """
+    A prompt variant described by its factors. Unless explicit prompts are given (e.g. loaded from a file),
+    the prompt texts are not stored but rendered on access from the templates of prompt_factory (through a shared cache).
+    """
     dilemma_identifier: str
     ethical_framework_identifier: str
     base_prompt_identifier: str
@@ -161,7 +262,7 @@ class PromptWrapper:
 
     def __init__(
         self,
-        prompts: list[str],
+        prompts: Optional[list[str]],
         dilemma_identifier: str,
         ethical_framework_identifier: str,
         base_prompt_identifier: str,
@@ -171,7 +272,7 @@ class PromptWrapper:
         version: str,
     ):
         self._id = None
-        self.prompts = prompts
+        self._prompts = prompts
         self.dilemma_identifier = dilemma_identifier
         self.ethical_framework_identifier = ethical_framework_identifier
         self.base_prompt_identifier = base_prompt_identifier
@@ -179,10 +280,38 @@ class PromptWrapper:
         self.prompt_has_output_structure_json_schema = prompt_has_output_structure_json_schema
         self.output_structure = output_structure
         self.version = version
+        self._dilemma: Optional[DilemmaWrapper] = None
 
     @property
     def dilemma(self) -> DilemmaWrapper:
-        return get_dilemma(self.dilemma_identifier)
+        # Resolved once, the identifier check keeps the cache valid if dilemma_identifier is reassigned
+        if self._dilemma is None or self._dilemma.identifier != self.dilemma_identifier:
+            self._dilemma = get_dilemma(self.dilemma_identifier)
+        return self._dilemma
+
+    @property
+    def prompts(self) -> list[str]:
+        if self._prompts is not None:
+            return self._prompts
+        if self.version != VERSION:
+            raise Exception(f"The prompts of version {self.version} cannot be rendered by library version {VERSION}")
+        return list(self._render_prompts())
+
+    @prompts.setter
+    def prompts(self, prompts: Optional[list[str]]):
+        self._prompts = prompts
+
+    def _render_prompts(self) -> tuple[str, ...]:
+        # Imported here as prompt_factory depends on this module
+        from .prompt_factory import get_rendered_prompts
+        return get_rendered_prompts(
+            self.dilemma_identifier,
+            self.ethical_framework_identifier,
+            self.base_prompt_identifier,
+            self.output_structure,
+            self.prompt_has_output_structure_description,
+            self.prompt_has_output_structure_json_schema,
+        )
 
     def __str__(self):
         res = "--------PromptWrapper--------"
@@ -191,10 +320,11 @@ class PromptWrapper:
         res += "-----------------------------"
         return res
 
-    def to_dict(self):
+    def to_dict(self, text_table: Optional[TextTable] = None):
+        """With a text_table the prompt texts are referenced by their id in the table ("prompt_text_ids")."""
         if self._id is None:
             raise Exception("PromptWrapper ID is None")
-        return {
+        res = {
             "_id": self._id,
             "prompts": self.prompts,
             "dilemma_identifier": self.dilemma_identifier,
@@ -205,14 +335,22 @@ class PromptWrapper:
             "output_structure": self.output_structure.to_dict(),
             "version": self.version,
         }
+        if text_table is not None:
+            res["prompt_text_ids"] = [text_table.get_id(prompt) for prompt in res.pop("prompts")]
+        return res
 
     @classmethod
-    def from_dict(cls, data: dict):
+    def from_dict(cls, data: dict, text_table: Optional[TextTable] = None):
         """
         Create a PromptWrapper object from a dictionary.
+        The `text_table` of the file is required for compact dictionaries, which reference their prompt texts.
         """
+        prompts = data.get("prompts")
+        if prompts is None and "prompt_text_ids" in data:
+            prompts = [text_table.get_text(text_id) for text_id in data["prompt_text_ids"]]
         res = cls(
-            prompts=data["prompts"],
+            # Missing in the compact dictionaries of older versions, the prompts are rendered on access then
+            prompts=prompts,
             dilemma_identifier=data["dilemma_identifier"],
             ethical_framework_identifier=data.get("ethical_framework_identifier", data.get("framework_identifier")),
             base_prompt_identifier=data["base_prompt_identifier"],
@@ -242,11 +380,28 @@ class PromptWrapper:
         return res
 
 
+class LlmProvider(Enum):
+    OPENAI = "openai"
+    DEEPSEEK = "deepseek"
+    MISTRAL = "mistral"
+
+
 class LlmName(Enum):
     GPT4O = "gpt-4o"
     DEEPSEEK = "deepseek-chat"
     MISTRAL_SMALL = "mistral-small-latest"
 
+    @property
+    def provider(self) -> LlmProvider:
+        return llm_providers[self]
+
+
+llm_providers = {
+    LlmName.GPT4O: LlmProvider.OPENAI,
+    LlmName.DEEPSEEK: LlmProvider.DEEPSEEK,
+    LlmName.MISTRAL_SMALL: LlmProvider.MISTRAL,
+}
+
 
 class LlmMessageRole(Enum):
     SYSTEM = "system"
@@ -272,6 +427,60 @@ class LlmMessage:
         )
 
 
+class SharedFirstTurn:
+    """
+    Provenance of a first turn that was requested once and shared by all PromptWrappers with the same first prompt
+    (see shared_first_turn.query_prompts_shared_first_turn).
+    `key` identifies the first turn (model and message), `sample_index` which of its `sample_count` completions was used.
+    The token counts and retries are the ones of the shared first turn, they are not part of the ones of the Responses.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        sample_index: int,
+        sample_count: int,
+        shared_by: int,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_tokens: Optional[int] = None,
+        retries: Optional[int] = None,
+    ):
+        self.key = key
+        self.sample_index = sample_index
+        self.sample_count = sample_count
+        self.shared_by = shared_by
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_tokens = cached_tokens
+        self.retries = retries
+
+    def to_dict(self):
+        return {
+            "key": self.key,
+            "sample_index": self.sample_index,
+            "sample_count": self.sample_count,
+            "shared_by": self.shared_by,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "retries": self.retries,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            key=data["key"],
+            sample_index=data["sample_index"],
+            sample_count=data["sample_count"],
+            shared_by=data["shared_by"],
+            prompt_tokens=data["prompt_tokens"],
+            completion_tokens=data["completion_tokens"],
+            cached_tokens=data.get("cached_tokens"),
+            retries=data.get("retries"),
+        )
+
+
 class Response:
     wrapped_prompt: PromptWrapper
     decision: DecisionOption
@@ -287,40 +496,153 @@ class Response:
         wrapped_prompt: PromptWrapper,
         decision: DecisionOption,
         llm_identifier: LlmName,
-        unparsed_messages: list[LlmMessage],
+        unparsed_messages: Optional[list[LlmMessage]],
         parsed_response: dict,
         prompt_tokens: Optional[int],
-        completion_tokens: Optional[int]
+        completion_tokens: Optional[int],
+        cached_tokens: Optional[int] = None,
+        assistant_messages: Optional[list[str]] = None,
+        shared_first_turn: Optional[SharedFirstTurn] = None,
+        retries: Optional[int] = None,
     ):
+        """
+        Either the full `unparsed_messages` or only the `assistant_messages` have to be given.
+        In the latter case the conversation is rebuilt from the prompts of the wrapped_prompt on access.
+        `shared_first_turn` is set if the first turn was shared with other Responses, then the token counts only cover the other turns.
+        """
+        if unparsed_messages is None and assistant_messages is None:
+            raise ValueError("Either unparsed_messages or assistant_messages are required")
         self.wrapped_prompt = wrapped_prompt
         self.decision = decision
         self.llm_identifier = llm_identifier
-        self.unparsed_messages = unparsed_messages
+        self._unparsed_messages = unparsed_messages
+        self._assistant_messages = assistant_messages
         self.parsed_response = parsed_response
         self.prompt_tokens = prompt_tokens
         self.completion_tokens = completion_tokens
+        # Part of the prompt_tokens the provider served from its prompt prefix cache (None if not reported)
+        self.cached_tokens = cached_tokens
+        self.shared_first_turn = shared_first_turn
+        # Requests that failed with a transient error and were sent again (None if not recorded)
+        self.retries = retries
+        # Not serialized, only known for Responses of the current run: the chat completion requests sent to the provider
+        # (turns answered by the ResponseCache and retries are not counted) and their (prompt_tokens, completion_tokens, cached_tokens)
+        self.requests: Optional[int] = None
+        self.request_usage: Optional[tuple[int, int, Optional[int]]] = None
 
-    def to_dict(self):
-        return {
-            "wrapped_prompt": self.wrapped_prompt.to_dict(),
+    @property
+    def unparsed_messages(self) -> list[LlmMessage]:
+        if self._unparsed_messages is not None:
+            return self._unparsed_messages
+        return self._build_messages(self._assistant_messages)
+
+    @unparsed_messages.setter
+    def unparsed_messages(self, unparsed_messages: list[LlmMessage]):
+        self._unparsed_messages = unparsed_messages
+        self._assistant_messages = None
+
+    def _build_messages(self, assistant_messages: list[str]) -> list[LlmMessage]:
+        """Every prompt is sent as system message and followed by the answer of the assistant."""
+        messages = []
+        for i, prompt in enumerate(self.wrapped_prompt.prompts):
+            messages.append(LlmMessage(LlmMessageRole.SYSTEM, prompt))
+            if i < len(assistant_messages):
+                messages.append(LlmMessage(LlmMessageRole.ASSISSANT, assistant_messages[i]))
+        return messages
+
+    def _get_assistant_messages(self) -> list[str]:
+        if self._assistant_messages is not None:
+            return self._assistant_messages
+        return [message.content for message in self.get_messages_by_role(LlmMessageRole.ASSISSANT)]
+
+    def _messages_match_prompts(self) -> bool:
+        """True if the conversation consists of the prompts of the wrapped_prompt, each followed by an assistant message."""
+        if self._unparsed_messages is None:
+            return True
+        rebuilt_messages = self._build_messages(self._get_assistant_messages())
+        return [message.to_dict() for message in rebuilt_messages] == [message.to_dict() for message in self._unparsed_messages]
+
+    def to_dict(self, text_table: Optional[TextTable] = None):
+        """
+        With a text_table the prompt texts of the wrapped_prompt are referenced by their id in the table and the messages
+        are reduced to the assistant messages if the prompts make up the rest of the conversation.
+        """
+        res = {
+            "wrapped_prompt": self.wrapped_prompt.to_dict(text_table),
             "decision": self.decision.value,
             "llm_identifier": self.llm_identifier.value,
-            "unparsed_messages": [message.to_dict() for message in self.unparsed_messages],
+            "unparsed_messages": None,
             "parsed_response": self.parsed_response,
             "prompt_tokens": self.prompt_tokens,
             "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "shared_first_turn": self.shared_first_turn.to_dict() if self.shared_first_turn else None,
+            "retries": self.retries,
         }
+        if text_table is not None and self._messages_match_prompts():
+            del res["unparsed_messages"]
+            res["assistant_messages"] = self._get_assistant_messages()
+        else:
+            res["unparsed_messages"] = [message.to_dict() for message in self.unparsed_messages]
+        return res
 
     @classmethod
-    def from_dict(cls, data: dict):
+    def from_dict(cls, data: dict, text_table: Optional[TextTable] = None):
+        unparsed_messages = data.get("unparsed_messages")
+        return cls(
+            wrapped_prompt=PromptWrapper.from_dict(data["wrapped_prompt"], text_table),
+            decision=DecisionOption(data["decision"]),
+            llm_identifier=LlmName(data["llm_identifier"]),
+            unparsed_messages=None if unparsed_messages is None else [LlmMessage.from_dict(item) for item in unparsed_messages],
+            parsed_response=data.get("parsed_response"),
+            prompt_tokens=data.get("prompt_tokens"),
+            completion_tokens=data.get("completion_tokens"),
+            cached_tokens=data.get("cached_tokens"),
+            assistant_messages=data.get("assistant_messages"),
+            shared_first_turn=SharedFirstTurn.from_dict(data["shared_first_turn"]) if data.get("shared_first_turn") else None,
+            retries=data.get("retries"),
+        )
+
+    def to_normalized_dict(self):
+        """
+        Like to_dict, but the wrapped_prompt is only referenced by its _id (see prompts_json.NormalizedResponseWriter)
+        and the messages are reduced to the assistant messages if the prompts of the wrapped_prompt make up the rest.
+        """
+        if self.wrapped_prompt._id is None:
+            raise ValueError("A Response can only reference a PromptWrapper with an _id")
+        res = {
+            "prompt_id": self.wrapped_prompt._id,
+            "decision": self.decision.value,
+            "llm_identifier": self.llm_identifier.value,
+            "parsed_response": self.parsed_response,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "shared_first_turn": self.shared_first_turn.to_dict() if self.shared_first_turn else None,
+            "retries": self.retries,
+        }
+        if self._messages_match_prompts():
+            res["assistant_messages"] = self._get_assistant_messages()
+        else:
+            res["unparsed_messages"] = [message.to_dict() for message in self.unparsed_messages]
+        return res
+
+    @classmethod
+    def from_normalized_dict(cls, data: dict, wrapped_prompt: PromptWrapper):
+        """Inverse of to_normalized_dict, `wrapped_prompt` is the PromptWrapper with the referenced _id."""
+        unparsed_messages = data.get("unparsed_messages")
         return cls(
-            wrapped_prompt=PromptWrapper.from_dict(data["wrapped_prompt"]),
+            wrapped_prompt=wrapped_prompt,
             decision=DecisionOption(data["decision"]),
             llm_identifier=LlmName(data["llm_identifier"]),
-            unparsed_messages=[LlmMessage.from_dict(item) for item in data["unparsed_messages"]],
+            unparsed_messages=None if unparsed_messages is None else [LlmMessage.from_dict(item) for item in unparsed_messages],
             parsed_response=data.get("parsed_response"),
             prompt_tokens=data.get("prompt_tokens"),
             completion_tokens=data.get("completion_tokens"),
+            cached_tokens=data.get("cached_tokens"),
+            assistant_messages=data.get("assistant_messages"),
+            shared_first_turn=SharedFirstTurn.from_dict(data["shared_first_turn"]) if data.get("shared_first_turn") else None,
+            retries=data.get("retries"),
         )
 
     def to_analysis_dict(self):
@@ -343,7 +665,8 @@ class Response:
     def normalized_decision(self) -> DecisionOption:
         """InvertableDilemmaWrapper allows for the decision to be inverted. This property returns the normalized decision."""
 
-        if not isinstance(self.wrapped_prompt.dilemma, InvertableDilemmaWrapper):
+        dilemma = self.wrapped_prompt.dilemma
+        if not isinstance(dilemma, InvertableDilemmaWrapper):
             return self.decision
 
         assert self.decision in [
@@ -352,7 +675,7 @@ class Response:
         if self.decision == DecisionOption.UNDECIDED:
             return DecisionOption.UNDECIDED
 
-        if self.wrapped_prompt.dilemma.action_is_inverted:
+        if dilemma.action_is_inverted:
             if self.decision == DecisionOption.YES:
                 return DecisionOption.NO
             elif self.decision == DecisionOption.NO:
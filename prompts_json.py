@@ -1,34 +1,68 @@
 import json
+import os
+from typing import Iterable, Iterator, Optional, Union
 
-from .prompt_wrapper import PromptWrapper, Response
+from .decoding import PromptDecoder, ResponseDecoder, get_json_loads, paused_gc
+from .prompt_wrapper import PromptWrapper, Response, TextTable
 from .version import VERSION
 
 
-def generate_prompt_json(prompts: list[PromptWrapper], path: str):
-    prompt_dicts = [prompt.to_dict() for prompt in prompts]
+# Size of the chunks the streaming readers read at once
+READ_CHUNK_SIZE = 1024 ** 2
+
+# Header record of the normalized response format (see NormalizedResponseWriter)
+NORMALIZED_RESPONSES_FORMAT = "normalized_responses"
+
+
+def iter_records(items: Iterable[Union[PromptWrapper, Response]], text_table: Optional[TextTable] = None) -> Iterator[dict]:
+    """
+    The dictionaries of the PromptWrappers or Responses. With a text_table (compact files) the prompt texts are
+    referenced by id and the records of new texts are yielded before the first dictionary referencing them.
+    """
+    for item in items:
+        item_dict = item.to_dict(text_table)
+        if text_table is not None:
+            yield from text_table.pop_new_records()
+        yield item_dict
+
+
+def read_text_table(path: str) -> TextTable:
+    """The TextTable of an existing compact file, to append to it"""
+    text_table = TextTable()
+    if os.path.exists(path):
+        for item in iter_json_items(path):
+            if TextTable.is_record(item):
+                text_table.add_record(item)
+    return text_table
+
+
+def generate_prompt_json(prompts: list[PromptWrapper], path: str, compact: bool = False, logging: bool = True):
+    """With compact=True every distinct prompt text is stored once (see prompt_wrapper.TextTable)."""
+    prompt_dicts = list(iter_records(prompts, TextTable() if compact else None))
     with open(path, 'w') as f:
         json.dump(prompt_dicts, f, indent=4)
 
-    print(f"{len(prompts)} rompts successfully written to {path}")
+    if logging:
+        print(f"{len(prompts)} prompts successfully written to {path}")
 
 
 def load_prompts_from_json(path: str):
     """
-    Load a list of PromptWrapper objects from a JSON file.
+    Load a list of PromptWrapper objects from a JSON (array) or JSONL file.
     """
-    with open(path, 'r') as f:
-        data = json.load(f)
+    with paused_gc():
+        return list(iter_prompts(path))
 
-    res = [PromptWrapper.from_dict(item) for item in data]
-    if not res[0].version == VERSION:
-        print("Warning: The version of the loaded prompts does not match the current library version.")
 
-    # Convert each dictionary back into a PromptWrapper object
-    return res
-
-
-def generate_response_json(responses: list[Response], path: str, logging: bool = True):
-    response_dicts = [response.to_dict() for response in responses]
+def generate_response_json(responses: list[Response], path: str, logging: bool = True, compact: bool = False, normalized: bool = False):
+    """
+    With compact=True every distinct prompt text is stored once (see prompt_wrapper.TextTable),
+    with normalized=True the array holds the records of the normalized format (see NormalizedResponseWriter).
+    """
+    if normalized:
+        response_dicts = list(iter_normalized_records(responses))
+    else:
+        response_dicts = list(iter_records(responses, TextTable() if compact else None))
     with open(path, 'w') as f:
         json.dump(response_dicts, f, indent=4)
 
@@ -37,12 +71,334 @@ def generate_response_json(responses: list[Response], path: str, logging: bool =
 
 
 def load_responses_from_json(path: str):
-    with open(path, 'r') as f:
-        data = json.load(f)
+    """
+    Load a list of Response objects from a JSON (array) or JSONL file.
+    """
+    with paused_gc():
+        return list(iter_responses(path))
+
+
+def _get_item_indent(f, buffer: str) -> tuple[Optional[int], str]:
+    """
+    The indentation of the items of a JSON array of objects written with json.dump(..., indent=n), None for other layouts.
+    Also returns the buffer, which is extended if it ends before the first item.
+    """
+    while True:
+        start = buffer.index("[") + 1
+        rest = buffer[start:].lstrip(" \t\r\n")
+        if rest:
+            break
+        chunk = f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return None, buffer
+        buffer += chunk
+    if not rest.startswith("{"):
+        return None, buffer
+    whitespace = buffer[start:len(buffer) - len(rest)]
+    if "\n" not in whitespace:
+        return None, buffer
+    indent = whitespace[whitespace.rindex("\n") + 1:]
+    if indent.strip(" "):
+        return None, buffer
+    return len(indent), buffer
 
-    # Convert each dictionary back into a Response object
-    res = [Response.from_dict(item) for item in data]
 
-    if not res[0].wrapped_prompt.version == VERSION:
-        print("Warning: The version of the loaded responses does not match the current library version.")
-    return res
+def _iter_indented_json_array_items(f, buffer: str, indent: int) -> Iterator[dict]:
+    """
+    Decode the items of a JSON array written with json.dump(..., indent=`indent`) one by one.
+    The closing brace of every item is the only "}" on a new line after exactly `indent` spaces (nested objects are
+    indented further and strings cannot contain raw newlines), so the items are found with str.find and decoded
+    with the fast loads of get_json_loads.
+    """
+    loads = get_json_loads()
+    end_marker = "\n" + " " * indent + "}"
+    position = buffer.index("[") + 1
+    search_from = position
+    while True:
+        # Skip whitespace and the separating commas
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position == len(buffer):
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("Unexpected end of file: JSON array is not closed")
+            buffer, position, search_from = chunk, 0, 0
+            continue
+        if buffer[position] == "]":
+            return
+
+        end = buffer.find(end_marker, max(position, search_from))
+        if end == -1:
+            # The item is cut off at the end of the buffer, read more
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("Unexpected end of file: JSON array item is not closed")
+            buffer = buffer[position:] + chunk
+            search_from = max(0, len(buffer) - len(chunk) - len(end_marker))
+            position = 0
+            continue
+        end += len(end_marker)
+        yield loads(buffer[position:end])
+        position = search_from = end
+
+
+def _iter_json_array_items(f, buffer: str) -> Iterator[dict]:
+    """Decode the items of a JSON array one by one, keeping only the current chunk in memory."""
+    indent, buffer = _get_item_indent(f, buffer)
+    if indent is not None:
+        yield from _iter_indented_json_array_items(f, buffer, indent)
+        return
+
+    decoder = json.JSONDecoder()
+    position = buffer.index("[") + 1
+    while True:
+        # Skip whitespace and the separating commas
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer):
+                break
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("Unexpected end of file: JSON array is not closed")
+            buffer, position = chunk, 0
+
+        if buffer[position] == "]":
+            return
+
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The item is cut off at the end of the buffer, read more
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                raise
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield item
+
+
+def iter_json_items(path: str) -> Iterator[dict]:
+    """
+    Lazily iterate over the dictionaries stored in a JSON array file (as written by generate_*_json)
+    or a JSONL file (one object per line, as written by generate_*_jsonl or a ResultsLog).
+    The lines of JSONL files are parsed with orjson if it is installed (see decoding.get_json_loads).
+    """
+    loads = get_json_loads()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = f.read(READ_CHUNK_SIZE)
+        while buffer and not buffer.strip():
+            buffer = f.read(READ_CHUNK_SIZE)
+        if not buffer:
+            return
+
+        if buffer.lstrip().startswith("["):
+            yield from _iter_json_array_items(f, buffer)
+            return
+
+        # JSONL: continue line by line after the first chunk
+        lines = buffer.split("\n")
+        rest = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield loads(line)
+        for line in f:
+            if rest:
+                line = rest + line
+                rest = ""
+            if line.strip():
+                yield loads(line)
+        if rest.strip():
+            yield loads(rest)
+
+
+def iter_prompts(path: str) -> Iterator[PromptWrapper]:
+    check_version = True
+    decoder = PromptDecoder()
+    for item in iter_json_items(path):
+        if TextTable.is_record(item):
+            decoder.text_table.add_record(item)
+            continue
+        prompt = decoder.decode(item)
+        if check_version:
+            check_version = False
+            if not prompt.version == VERSION:
+                print("Warning: The version of the loaded prompts does not match the current library version.")
+        yield prompt
+
+
+def iter_responses(path: str) -> Iterator[Response]:
+    """
+    Lazily load the Responses of a file in the embedded (every Response with its wrapped_prompt) or the normalized format.
+    Responses of the normalized format share the PromptWrapper instance of their prompt record.
+    """
+    check_version = True
+    decoder = ResponseDecoder()
+    prompts_by_id: dict[str, PromptWrapper] = {}
+    for item in iter_json_items(path):
+        if TextTable.is_record(item):
+            decoder.prompt_decoder.text_table.add_record(item)
+            continue
+        if "prompt" in item:
+            wrapped_prompt = decoder.prompt_decoder.decode(item["prompt"])
+            prompts_by_id[wrapped_prompt._id] = wrapped_prompt
+            continue
+        if "format" in item:
+            _check_format(item)
+            continue
+        if "prompt_id" in item:
+            response = decoder.decode_normalized(item, prompts_by_id[item["prompt_id"]])
+        else:
+            response = decoder.decode(item)
+        if check_version:
+            check_version = False
+            if not response.wrapped_prompt.version == VERSION:
+                print("Warning: The version of the loaded responses does not match the current library version.")
+        yield response
+
+
+def iter_response_dicts(path: str) -> Iterator[dict]:
+    """
+    Lazily iterate over the Response.to_dict() dictionaries of a file in the embedded or the normalized format,
+    without creating Response objects. The records of the normalized format get the (shared) dictionary of their prompt.
+    """
+    prompt_dicts_by_id: dict[str, dict] = {}
+    text_table = TextTable()
+    for item in iter_json_items(path):
+        if TextTable.is_record(item):
+            text_table.add_record(item)
+        elif "prompt" in item:
+            prompt_dicts_by_id[item["prompt"]["_id"]] = item["prompt"]
+        elif "format" in item:
+            _check_format(item)
+        elif "prompt_id" in item:
+            item["wrapped_prompt"] = prompt_dicts_by_id[item.pop("prompt_id")]
+            yield item
+        else:
+            wrapped_prompt = item["wrapped_prompt"]
+            if "prompt_text_ids" in wrapped_prompt:
+                wrapped_prompt["prompts"] = [text_table.get_text(text_id) for text_id in wrapped_prompt.pop("prompt_text_ids")]
+            yield item
+
+
+def _check_format(header: dict):
+    if header["format"] != NORMALIZED_RESPONSES_FORMAT:
+        raise ValueError(f"Unknown response file format: {header['format']}")
+
+
+def iter_normalized_records(responses: Iterable[Response], written_prompt_ids: Optional[set[str]] = None) -> Iterator[dict]:
+    """
+    The records of the normalized format: the header (unless `written_prompt_ids` is given), every PromptWrapper once
+    with its full prompt texts (before the first Response referencing it) and the Responses referencing their PromptWrapper by _id.
+    Raises a ValueError for Responses to PromptWrappers without _id, these cannot be referenced.
+    """
+    if written_prompt_ids is None:
+        written_prompt_ids = set()
+        yield {"format": NORMALIZED_RESPONSES_FORMAT}
+    for response in responses:
+        wrapped_prompt = response.wrapped_prompt
+        if wrapped_prompt._id is None:
+            raise ValueError("Responses to a PromptWrapper without _id cannot be written in the normalized format")
+        if wrapped_prompt._id not in written_prompt_ids:
+            written_prompt_ids.add(wrapped_prompt._id)
+            yield {"prompt": wrapped_prompt.to_dict()}
+        yield response.to_normalized_dict()
+
+
+class NormalizedResponseWriter:
+    """
+    Incrementally writes Responses in the normalized JSONL format. Instead of embedding the wrapped_prompt in every Response,
+    it has a header record, one {"prompt": ...} record per PromptWrapper (with the full prompt texts, so the file does not
+    depend on the templates of the library version reading it) and the Responses reference their PromptWrapper by "prompt_id"
+    (see Response.to_normalized_dict).
+    iter_responses / load_responses_from_json read both formats.
+    """
+
+    def __init__(self, path: str, append: bool = False):
+        self.path = path
+        self.count = 0
+        self._written_prompt_ids: set[str] = set()
+        write_header = True
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            write_header = False
+            for item in iter_json_items(path):
+                if "prompt" in item:
+                    self._written_prompt_ids.add(item["prompt"]["_id"])
+        self._file = open(path, 'a' if append else 'w', encoding='utf-8')
+        if write_header:
+            self._write_record({"format": NORMALIZED_RESPONSES_FORMAT})
+
+    def _write_record(self, record: dict):
+        self._file.write(json.dumps(record))
+        self._file.write("\n")
+
+    def write(self, response: Response):
+        for record in iter_normalized_records([response], self._written_prompt_ids):
+            self._write_record(record)
+        self.count += 1
+
+    def write_all(self, responses: Iterable[Response]):
+        for response in responses:
+            self.write(response)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class JsonlWriter:
+    """
+    Incrementally writes PromptWrappers or Responses as one JSON object per line.
+    With compact=True every distinct prompt text is written once (see prompt_wrapper.TextTable).
+    """
+
+    def __init__(self, path: str, append: bool = False, compact: bool = False):
+        self.path = path
+        self.compact = compact
+        self.count = 0
+        self.text_table = None
+        if compact:
+            self.text_table = read_text_table(path) if append else TextTable()
+        self._file = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    def write(self, item: Union[PromptWrapper, Response]):
+        for record in iter_records([item], self.text_table):
+            self._file.write(json.dumps(record))
+            self._file.write("\n")
+        self.count += 1
+
+    def write_all(self, items: Iterable[Union[PromptWrapper, Response]]):
+        for item in items:
+            self.write(item)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def generate_prompt_jsonl(prompts: Iterable[PromptWrapper], path: str, compact: bool = False, logging: bool = True):
+    """Like generate_prompt_json, but streams the prompts (e.g. from a generator) into a JSONL file."""
+    with JsonlWriter(path, compact=compact) as writer:
+        writer.write_all(prompts)
+
+    if logging:
+        print(f"{writer.count} prompts successfully written to {path}")
+
+
+def generate_response_jsonl(responses: Iterable[Response], path: str, logging: bool = True, compact: bool = False, normalized: bool = False):
+    """Like generate_response_json, but streams the responses into a JSONL file."""
+    with (NormalizedResponseWriter(path) if normalized else JsonlWriter(path, compact=compact)) as writer:
+        writer.write_all(responses)
+
+    if logging:
+        print(f"{writer.count} responses successfully written to {path}")
@@ -0,0 +1,90 @@
+import threading
+from typing import Optional
+
+import httpx
+import openai
+
+from .prompt_wrapper import LlmProvider
+
+
+DEEPSEEK_BASE_URL = "https://api.deepseek.com/v1"
+MISTRAL_BASE_URL = "https://api.mistral.ai/v1"
+
+provider_base_urls = {
+    # None falls back to the openai default (or the OPENAI_BASE_URL environment variable)
+    LlmProvider.OPENAI: None,
+    # DeepSeek and Mistral provide an OpenAI compatible API. We only need to change the base URL.
+    LlmProvider.DEEPSEEK: DEEPSEEK_BASE_URL,
+    LlmProvider.MISTRAL: MISTRAL_BASE_URL,
+}
+
+
+class ProviderClient:
+    """
+    OpenAI compatible client of a single provider.
+    It holds its own API key, base URL and keep-alive connection pool instead of configuring the global `openai` module,
+    so clients of different providers can be used side by side. A ProviderClient can be shared between threads.
+    Failed requests are not retried by the openai client itself (`max_retries`), the query functions retry according to a retry.RetryPolicy.
+    """
+
+    def __init__(
+        self,
+        provider: LlmProvider,
+        api_key: str,
+        base_url: Optional[str] = None,
+        max_connections: int = 64,
+        timeout: float = 600,
+        max_retries: int = 0,
+    ):
+        self.provider = provider
+        self.api_key = api_key
+        self.base_url = base_url or provider_base_urls[provider]
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.client = openai.OpenAI(
+            api_key=api_key,
+            base_url=self.base_url,
+            http_client=httpx.Client(limits=self._get_limits(max_connections), timeout=timeout),
+            max_retries=max_retries,
+        )
+
+    @staticmethod
+    def _get_limits(max_connections: int) -> httpx.Limits:
+        return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+
+    def create_async_client(self, max_connections: Optional[int] = None) -> openai.AsyncOpenAI:
+        """
+        Create an AsyncOpenAI client with the same settings.
+        Async connection pools are bound to an event loop, so the caller owns (and closes) the returned client.
+        """
+        return openai.AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            http_client=httpx.AsyncClient(limits=self._get_limits(max_connections or self.max_connections), timeout=self.timeout),
+            max_retries=self.max_retries,
+        )
+
+    def close(self):
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_provider_clients: dict[tuple, ProviderClient] = {}
+_provider_clients_lock = threading.Lock()
+
+
+def get_provider_client(provider: LlmProvider, api_key: str, base_url: Optional[str] = None) -> ProviderClient:
+    """Get the process wide ProviderClient for the given settings, creating it on first use."""
+    key = (provider, api_key, base_url)
+    with _provider_clients_lock:
+        client = _provider_clients.get(key)
+        if client is None:
+            client = ProviderClient(provider, api_key, base_url)
+            _provider_clients[key] = client
+        return client
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of chat completions.
+    Entries are keyed by a hash of the model, the messages and the response_format (including its JSON schema).
+    Once the cache grows beyond `max_size_bytes` (or `max_entries`) the least recently used entries are evicted.
+
+    Only use it when re-running identical prompts should not produce new samples:
+    a cache hit returns exactly the answer of the earlier run.
+    """
+
+    def __init__(self, directory: str, max_size_bytes: int = 1024 ** 3, max_entries: Optional[int] = None):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # key -> size in bytes, ordered from least to most recently used
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        files = []
+        for root, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if not file_name.endswith(".json"):
+                    continue
+                stat = os.stat(os.path.join(root, file_name))
+                files.append((stat.st_mtime, file_name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._size_bytes += size
+        self._evict()
+
+    @staticmethod
+    def get_key(model: str, messages: list[dict], response_format: Optional[dict], sample: int = 0) -> str:
+        data = {"model": model, "messages": messages, "response_format": response_format}
+        if sample:
+            # Further independent samples of the same request, the first one keeps the plain key
+            data["sample"] = sample
+        content = json.dumps(data, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            path = self._get_path(key)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+                # The modification time persists the LRU order for the next process
+                os.utime(path)
+            except FileNotFoundError:
+                # Removed by another process sharing the directory
+                self._size_bytes -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: dict):
+        data = json.dumps(entry).encode("utf-8")
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so readers never see a partially written entry
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(file_descriptor, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._size_bytes -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._size_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._entries and (
+            self._size_bytes > self.max_size_bytes
+            or (self.max_entries is not None and len(self._entries) > self.max_entries)
+        ):
+            key, size = self._entries.popitem(last=False)
+            self._size_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._get_path(key))
+            except FileNotFoundError:
+                pass
+
+    @property
+    def hit_ratio(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def get_stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hit_ratio,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "size_bytes": self._size_bytes,
+        }
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                try:
+                    os.remove(self._get_path(key))
+                except FileNotFoundError:
+                    pass
+            self._entries.clear()
+            self._size_bytes = 0
@@ -0,0 +1,339 @@
+from typing import Callable, Hashable, Iterable, Optional
+
+from .prompt_wrapper import *
+from .dilemma_wrapper import InvertableDilemmaWrapper, get_dilemma
+from .prompts_json import iter_response_dicts
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError("numpy is required for ResponseTable, install it with `pip install numpy`") from e
+    return numpy
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError("pyarrow is required to export a ResponseTable to Arrow or Parquet, install it with `pip install pyarrow`") from e
+    return pyarrow
+
+
+decision_values = [option.value for option in DecisionOption]
+decision_codes = {value: code for code, value in enumerate(decision_values)}
+
+
+class _CategoryEncoder:
+    """Assigns consecutive integer codes to values in the order they are first seen."""
+
+    def __init__(self):
+        self.codes: dict[Hashable, int] = {}
+        self.values: list = []
+
+    def encode(self, value: Hashable) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+def _encode_column(values: tuple) -> tuple[list, list]:
+    """Dictionary encode a column, returns (codes, distinct values in order of appearance)"""
+    categories = list(dict.fromkeys(values))
+    codes = {value: code for code, value in enumerate(categories)}
+    return list(map(codes.__getitem__, values)), categories
+
+
+def _to_category_value(value) -> Optional[str]:
+    """Lists (e.g. sorted_output_components) become a single comma separated category"""
+    if isinstance(value, list):
+        return ",".join(value)
+    return value
+
+
+class ResponseTable:
+    """
+    Columnar (struct of arrays) form of Response.to_analysis_dict() for many Responses.
+    Column names match the ones of pandas.json_normalize on the analysis dicts, e.g. "wrapped_prompt.output_structure.has_decision",
+    only the texts (prompts, messages and parsed_response) are left out.
+
+    - `columns`: one NumPy array per column
+    - `categories`: dictionary encoded columns store codes in `columns`, the values of the codes are listed here
+    - `null_masks`: True where the value of a column is None
+
+    Fields derived from the output structure and the dilemma are computed once per distinct structure or dilemma
+    and then broadcast to all rows, normalized_decision is computed vectorized from action_is_inverted.
+    Requires numpy, to_arrow / write_* additionally require pyarrow and to_pandas requires pandas.
+    """
+
+    def __init__(self, columns: dict, categories: dict[str, list], null_masks: dict):
+        self.columns = columns
+        self.categories = categories
+        self.null_masks = null_masks
+
+    def __len__(self):
+        return len(self.columns["wrapped_prompt._id"])
+
+    @classmethod
+    def from_responses(cls, responses: Iterable[Response]) -> "ResponseTable":
+        rows = [
+            (
+                wrapped_prompt._id,
+                response.decision,
+                response.llm_identifier,
+                response.prompt_tokens,
+                response.completion_tokens,
+                response.cached_tokens,
+                response.retries,
+                wrapped_prompt.dilemma_identifier,
+                wrapped_prompt.ethical_framework_identifier,
+                wrapped_prompt.base_prompt_identifier,
+                wrapped_prompt.version,
+                wrapped_prompt.prompt_has_output_structure_description,
+                wrapped_prompt.prompt_has_output_structure_json_schema,
+                wrapped_prompt.output_structure,
+                response.shared_first_turn.key if response.shared_first_turn else None,
+            )
+            for response in responses
+            for wrapped_prompt in [response.wrapped_prompt]
+        ]
+        return _build_table(
+            rows,
+            get_decision_value=lambda decision: decision.value,
+            get_llm_identifier_value=lambda llm_identifier: llm_identifier.value,
+            get_output_structure=lambda output_structure: output_structure,
+        )
+
+    @classmethod
+    def from_dicts(cls, items: Iterable[dict]) -> "ResponseTable":
+        """
+        Build the table from Response.to_dict() dictionaries, without creating Response objects.
+        The keys renamed or added since version 1.5 are resolved like in PromptWrapper.from_dict.
+        """
+        rows = [
+            (
+                wrapped_prompt.get("_id") or wrapped_prompt.get("id"),
+                item["decision"],
+                item["llm_identifier"],
+                item.get("prompt_tokens"),
+                item.get("completion_tokens"),
+                item.get("cached_tokens"),
+                item.get("retries"),
+                wrapped_prompt["dilemma_identifier"],
+                wrapped_prompt.get("ethical_framework_identifier", wrapped_prompt.get("framework_identifier")),
+                wrapped_prompt["base_prompt_identifier"],
+                wrapped_prompt["version"],
+                wrapped_prompt.get("prompt_has_output_structure_description", True),
+                wrapped_prompt.get("prompt_has_output_structure_json_schema", True),
+                (
+                    tuple(output_structure["sorted_output_components"]),
+                    tuple(output_structure["sorted_decision_options"]),
+                    output_structure["first_unstructured_output"],
+                ),
+                (item.get("shared_first_turn") or {}).get("key"),
+            )
+            for item in items
+            for wrapped_prompt in [item["wrapped_prompt"]]
+            for output_structure in [wrapped_prompt["output_structure"]]
+        ]
+        return _build_table(
+            rows,
+            get_decision_value=lambda decision: decision,
+            get_llm_identifier_value=lambda llm_identifier: llm_identifier,
+            get_output_structure=lambda key: OutputStructure.from_dict({
+                "sorted_output_components": key[0],
+                "sorted_decision_options": key[1],
+                "first_unstructured_output": key[2],
+            }),
+        )
+
+    @classmethod
+    def from_json(cls, path: str) -> "ResponseTable":
+        """Build the table from a response JSON or JSONL file (see prompts_json), embedded or normalized."""
+        return cls.from_dicts(iter_response_dicts(path))
+
+    def get_values(self, name: str):
+        """The values of a column, dictionary encoded columns are decoded (None where null)."""
+        numpy = _import_numpy()
+        if name in self.categories:
+            values = numpy.array(self.categories[name] + [None], dtype=object)
+            codes = self.columns[name]
+            return values[numpy.where(codes < 0, len(values) - 1, codes)]
+        if name in self.null_masks:
+            values = self.columns[name].astype(object)
+            values[self.null_masks[name]] = None
+            return values
+        return self.columns[name]
+
+    def to_arrow(self):
+        """pyarrow.Table with dictionary encoded categorical columns"""
+        pyarrow = _import_pyarrow()
+        arrays = {}
+        for name, values in self.columns.items():
+            mask = self.null_masks.get(name)
+            if name in self.categories:
+                arrays[name] = pyarrow.DictionaryArray.from_arrays(
+                    pyarrow.array(values, mask=mask),
+                    pyarrow.array(self.categories[name]),
+                )
+            else:
+                arrays[name] = pyarrow.array(values, mask=mask)
+        return pyarrow.table(arrays)
+
+    def write_parquet(self, path: str):
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(self.to_arrow(), path)
+
+    def write_arrow(self, path: str):
+        """Write an Arrow IPC (Feather v2) file"""
+        import pyarrow.feather
+        pyarrow.feather.write_feather(self.to_arrow(), path)
+
+    def to_pandas(self):
+        """pandas.DataFrame with pandas.Categorical columns for the dictionary encoded ones"""
+        import pandas
+        data = {}
+        for name, values in self.columns.items():
+            if name in self.categories:
+                data[name] = pandas.Categorical.from_codes(values, categories=self.categories[name])
+            elif name in self.null_masks:
+                data[name] = pandas.array(values, dtype=f"{'boolean' if values.dtype == bool else 'Int64'}")
+                data[name][self.null_masks[name]] = pandas.NA
+            else:
+                data[name] = values
+        return pandas.DataFrame(data)
+
+
+def _build_table(
+    rows: list[tuple],
+    get_decision_value: Callable[[Hashable], str],
+    get_llm_identifier_value: Callable[[Hashable], str],
+    get_output_structure: Callable[[Hashable], OutputStructure],
+) -> ResponseTable:
+    """
+    Turn the rows (as created by ResponseTable.from_responses / from_dicts) into columns.
+    Every column is dictionary encoded in one pass, derived fields are computed per distinct value only.
+    """
+    numpy = _import_numpy()
+    (
+        ids,
+        decisions,
+        llm_identifiers,
+        prompt_tokens,
+        completion_tokens,
+        cached_tokens,
+        retries,
+        dilemma_identifiers,
+        ethical_framework_identifiers,
+        base_prompt_identifiers,
+        versions,
+        prompt_has_output_structure_descriptions,
+        prompt_has_output_structure_json_schemas,
+        output_structure_keys,
+        shared_first_turn_keys,
+    ) = zip(*rows) if rows else [()] * 15
+
+    columns = {}
+    categories = {}
+    null_masks = {}
+
+    def add_categorical(name: str, codes, values: list):
+        columns[name] = numpy.asarray(codes, dtype=numpy.int32)
+        categories[name] = values
+
+    def add_optional_int(name: str, values: list[Optional[int]]):
+        mask = numpy.fromiter((value is None for value in values), dtype=bool, count=len(values))
+        columns[name] = numpy.fromiter((0 if value is None else value for value in values), dtype=numpy.int64, count=len(values))
+        if mask.any():
+            null_masks[name] = mask
+
+    def add_broadcast(name: str, per_level_values: list, level_codes):
+        """Column of a value that only depends on a factor level (e.g. the output structure) of every row"""
+        if all(value is None or isinstance(value, int) for value in per_level_values):
+            dtype = bool if all(value is None or isinstance(value, bool) for value in per_level_values) else numpy.int64
+            mask = numpy.asarray([value is None for value in per_level_values], dtype=bool)
+            columns[name] = numpy.asarray([0 if value is None else value for value in per_level_values], dtype=dtype)[level_codes]
+            if mask.any():
+                null_masks[name] = mask[level_codes]
+        else:
+            encoder = _CategoryEncoder()
+            value_codes = numpy.asarray([
+                -1 if value is None else encoder.encode(_to_category_value(value)) for value in per_level_values
+            ], dtype=numpy.int32)
+            add_categorical(name, value_codes[level_codes], encoder.values)
+            mask = value_codes[level_codes] < 0
+            if mask.any():
+                null_masks[name] = mask
+
+    columns["wrapped_prompt._id"] = numpy.asarray(ids, dtype=object)
+
+    # The decision categories always follow the order of DecisionOption
+    decision_level_codes, decision_levels = _encode_column(decisions)
+    decision = numpy.asarray(
+        [decision_codes[get_decision_value(level)] for level in decision_levels], dtype=numpy.int32
+    )[numpy.asarray(decision_level_codes, dtype=numpy.int32)]
+    add_categorical("decision", decision, list(decision_values))
+    llm_identifier_codes, llm_identifier_levels = _encode_column(llm_identifiers)
+    add_categorical("llm_identifier", llm_identifier_codes, [get_llm_identifier_value(level) for level in llm_identifier_levels])
+    add_optional_int("prompt_tokens", prompt_tokens)
+    add_optional_int("completion_tokens", completion_tokens)
+    add_optional_int("cached_tokens", cached_tokens)
+    add_optional_int("retries", retries)
+
+    # normalized_decision: YES and NO are swapped for dilemmas with an inverted action
+    dilemma_codes, dilemma_levels = _encode_column(dilemma_identifiers)
+    dilemma_level_codes = numpy.asarray(dilemma_codes, dtype=numpy.int32)
+    dilemmas = [get_dilemma(identifier) for identifier in dilemma_levels]
+    action_is_inverted = numpy.asarray([
+        isinstance(dilemma, InvertableDilemmaWrapper) and dilemma.action_is_inverted for dilemma in dilemmas
+    ], dtype=bool)
+    inverted_decision_codes = numpy.arange(len(decision_values), dtype=numpy.int32)
+    inverted_decision_codes[decision_codes[DecisionOption.YES.value]] = decision_codes[DecisionOption.NO.value]
+    inverted_decision_codes[decision_codes[DecisionOption.NO.value]] = decision_codes[DecisionOption.YES.value]
+    add_categorical(
+        "normalized_decision",
+        numpy.where(action_is_inverted[dilemma_level_codes], inverted_decision_codes[decision], decision),
+        list(decision_values),
+    )
+
+    add_categorical("wrapped_prompt.dilemma_identifier", dilemma_level_codes, dilemma_levels)
+    add_categorical("wrapped_prompt.ethical_framework_identifier", *_encode_column(ethical_framework_identifiers))
+    add_categorical("wrapped_prompt.base_prompt_identifier", *_encode_column(base_prompt_identifiers))
+    columns["wrapped_prompt.prompt_has_output_structure_description"] = numpy.asarray(prompt_has_output_structure_descriptions, dtype=bool)
+    columns["wrapped_prompt.prompt_has_output_structure_json_schema"] = numpy.asarray(prompt_has_output_structure_json_schemas, dtype=bool)
+    add_categorical("wrapped_prompt.version", *_encode_column(versions))
+
+    output_structure_codes, output_structure_levels = _encode_column(output_structure_keys)
+    output_structure_level_codes = numpy.asarray(output_structure_codes, dtype=numpy.int32)
+    output_structure_dicts = [get_output_structure(key).to_analysis_dict() for key in output_structure_levels]
+    # Any structure has the same analysis fields, the example only provides the column names of an empty table
+    example_output_structure = OutputStructure([OutputComponentType.DECISION], list(DecisionOption), False)
+    for key in example_output_structure.to_analysis_dict():
+        add_broadcast(
+            f"wrapped_prompt.output_structure.{key}",
+            [output_structure_dict[key] for output_structure_dict in output_structure_dicts],
+            output_structure_level_codes,
+        )
+
+    dilemma_dicts = [dilemma.to_dict() for dilemma in dilemmas]
+    for key in ["identifier", "description", "context_identifier", "type_identifier", "action_is_inverted"]:
+        add_broadcast(
+            f"wrapped_prompt.dilemma.{key}",
+            [dilemma_dict.get(key) for dilemma_dict in dilemma_dicts],
+            dilemma_level_codes,
+        )
+
+    # Responses sharing a first turn (see shared_first_turn) are not independent samples
+    shared_first_turn_codes, shared_first_turn_levels = _encode_column(shared_first_turn_keys)
+    shared_first_turn_keys = [level for level in shared_first_turn_levels if level is not None]
+    key_codes = {key: code for code, key in enumerate(shared_first_turn_keys)}
+    level_codes = numpy.asarray([key_codes.get(level, -1) for level in shared_first_turn_levels], dtype=numpy.int32)
+    codes = level_codes[numpy.asarray(shared_first_turn_codes, dtype=numpy.int32)]
+    add_categorical("shared_first_turn.key", codes, shared_first_turn_keys)
+    if codes.min(initial=0) < 0:
+        null_masks["shared_first_turn.key"] = codes < 0
+
+    return ResponseTable(columns, categories, null_masks)
@@ -0,0 +1,266 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import openai
+
+from .prompt_wrapper import *
+from .metrics import ErrorCategory, get_error_category
+
+
+T = TypeVar("T")
+
+# Errors that can succeed when the same request is sent again
+retryable_error_categories = {
+    ErrorCategory.RATE_LIMIT,
+    ErrorCategory.TIMEOUT,
+    ErrorCategory.CONNECTION,
+    ErrorCategory.SERVER_ERROR,
+    ErrorCategory.EMPTY_RESPONSE,
+    ErrorCategory.INVALID_RESPONSE,
+    ErrorCategory.FINISH_REASON,
+}
+
+# Errors that indicate an overloaded or unreachable endpoint, these open the circuit breaker
+endpoint_error_categories = {
+    ErrorCategory.RATE_LIMIT,
+    ErrorCategory.TIMEOUT,
+    ErrorCategory.CONNECTION,
+    ErrorCategory.SERVER_ERROR,
+}
+
+# Request timeout and conflict, retried by the openai client as well
+RETRYABLE_STATUS_CODES = {408, 409}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, provider: LlmProvider, retry_after: float):
+        super().__init__(f"Circuit breaker of {provider.value} is open, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a provider after `failure_threshold` consecutive endpoint errors (rate limits, timeouts,
+    connection and server errors). After `reset_timeout` seconds a single probe request is let through,
+    if it succeeds the circuit closes again, otherwise it stays open for another `reset_timeout`.
+    """
+
+    def __init__(self, provider: LlmProvider, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.times_opened = 0
+        self._opened_at: Optional[float] = None
+        self._probe_started: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_call(self):
+        """Raise CircuitOpenError if no request may be sent right now."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            now = time.monotonic()
+            remaining = self._opened_at + self.reset_timeout - now
+            if remaining > 0:
+                raise CircuitOpenError(self.provider, remaining)
+            # Half-open: one probe at a time, a probe that never reported back is replaced after reset_timeout
+            if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                raise CircuitOpenError(self.provider, min(1.0, self.reset_timeout))
+            self._probe_started = now
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._opened_at = None
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self._probe_started is not None or (self._opened_at is None and self.consecutive_failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    self.times_opened += 1
+                self._opened_at = time.monotonic()
+                self._probe_started = None
+
+    def to_dict(self):
+        return {
+            "provider": self.provider.value,
+            "is_open": self.is_open,
+            "consecutive_failures": self.consecutive_failures,
+            "times_opened": self.times_opened,
+        }
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Seconds to wait as requested by the provider (retry-after-ms or retry-after header), None if not given."""
+    if isinstance(error, CircuitOpenError):
+        return error.retry_after
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        retry_after = headers.get("retry-after")
+        if not retry_after:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            # HTTP date
+            return parsedate_to_datetime(retry_after).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Retries a chat completion request on transient errors (see retryable_error_categories) up to `max_retries` times.
+    The delay grows exponentially from `initial_delay` up to `max_delay` with full jitter, so concurrent workers that
+    failed together do not retry together. A Retry-After header of the provider takes precedence.
+    No retry is started after `max_elapsed_seconds`.
+
+    With `circuit_breaker=True` requests of a provider share a CircuitBreaker (see get_circuit_breaker). While it is open,
+    requests wait for it instead of failing, these waits do not count as retries.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 5,
+        initial_delay: float = 1.0,
+        max_delay: float = 60.0,
+        multiplier: float = 2.0,
+        max_elapsed_seconds: float = 600.0,
+        retryable_categories: Optional[set[ErrorCategory]] = None,
+        circuit_breaker: bool = True,
+        seed: Optional[int] = None,
+    ):
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.max_elapsed_seconds = max_elapsed_seconds
+        self.retryable_categories = retryable_error_categories if retryable_categories is None else retryable_categories
+        self.circuit_breaker = circuit_breaker
+        self._random = random.Random(seed)
+
+    def is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, CircuitOpenError):
+            return True
+        if isinstance(error, openai.APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES:
+            return True
+        return get_error_category(error) in self.retryable_categories
+
+    def get_backoff(self, retries: int) -> float:
+        return self._random.uniform(0, min(self.max_delay, self.initial_delay * self.multiplier ** retries))
+
+    def get_delay(self, error: Exception, retries: int, elapsed_seconds: float) -> Optional[float]:
+        """Seconds to wait before the next attempt, None if `error` is fatal or no retries are left."""
+        if not self.is_retryable(error):
+            return None
+        if retries >= self.max_retries and not isinstance(error, CircuitOpenError):
+            return None
+        delay = get_retry_after(error)
+        if delay is None or delay < 0:
+            delay = self.get_backoff(retries)
+        if elapsed_seconds + delay > self.max_elapsed_seconds:
+            return None
+        return delay
+
+    def get_circuit_breaker(self, provider: LlmProvider) -> Optional[CircuitBreaker]:
+        return get_circuit_breaker(provider) if self.circuit_breaker else None
+
+
+default_retry_policy = RetryPolicy()
+# Never retries, but still uses the circuit breakers
+no_retry_policy = RetryPolicy(max_retries=0)
+
+_circuit_breakers: dict[LlmProvider, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(provider: LlmProvider) -> CircuitBreaker:
+    """The CircuitBreaker shared by all queries of `provider`."""
+    with _circuit_breakers_lock:
+        if provider not in _circuit_breakers:
+            _circuit_breakers[provider] = CircuitBreaker(provider)
+        return _circuit_breakers[provider]
+
+
+def set_circuit_breaker(circuit_breaker: CircuitBreaker):
+    """Replace the CircuitBreaker of a provider, e.g. to change its threshold or timeout."""
+    with _circuit_breakers_lock:
+        _circuit_breakers[circuit_breaker.provider] = circuit_breaker
+
+
+def _record_result(circuit_breaker: Optional[CircuitBreaker], error: Optional[Exception]):
+    if circuit_breaker is None or isinstance(error, CircuitOpenError):
+        return
+    if error is not None and get_error_category(error) in endpoint_error_categories:
+        circuit_breaker.record_failure()
+    else:
+        # The endpoint answered
+        circuit_breaker.record_success()
+
+
+def call_with_retries(function: Callable[[], T], provider: LlmProvider, retry_policy: Optional[RetryPolicy] = None) -> tuple[T, int]:
+    """Call `function` (one request) according to `retry_policy` (default: default_retry_policy), returns its result and the number of retries."""
+    retry_policy = retry_policy or default_retry_policy
+    circuit_breaker = retry_policy.get_circuit_breaker(provider)
+    started = time.monotonic()
+    retries = 0
+    while True:
+        try:
+            if circuit_breaker:
+                circuit_breaker.before_call()
+            result = function()
+        except Exception as e:
+            _record_result(circuit_breaker, e)
+            delay = retry_policy.get_delay(e, retries, time.monotonic() - started)
+            if delay is None:
+                raise e
+            if not isinstance(e, CircuitOpenError):
+                retries += 1
+            time.sleep(delay)
+            continue
+        _record_result(circuit_breaker, None)
+        return result, retries
+
+
+async def call_with_retries_async(
+    function: Callable[[], Awaitable[T]],
+    provider: LlmProvider,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> tuple[T, int]:
+    """Async version of call_with_retries."""
+    retry_policy = retry_policy or default_retry_policy
+    circuit_breaker = retry_policy.get_circuit_breaker(provider)
+    started = time.monotonic()
+    retries = 0
+    while True:
+        try:
+            if circuit_breaker:
+                circuit_breaker.before_call()
+            result = await function()
+        except Exception as e:
+            _record_result(circuit_breaker, e)
+            delay = retry_policy.get_delay(e, retries, time.monotonic() - started)
+            if delay is None:
+                raise e
+            if not isinstance(e, CircuitOpenError):
+                retries += 1
+            await asyncio.sleep(delay)
+            continue
+        _record_result(circuit_breaker, None)
+        return result, retries
@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
+
+from .prompt_wrapper import *
+from .llm_query import Completion, complete_turn, create_response_from_turns, get_response_format, query_api, run_conversation
+from .provider_client import ProviderClient, get_provider_client
+from .response_cache import ResponseCache
+from .retry import RetryPolicy
+
+
+def get_first_turn_key(model: LlmName, wrapped_prompt: PromptWrapper) -> str:
+    return ResponseCache.get_key(model.value, [{"role": "system", "content": wrapped_prompt.prompts[0]}], None)
+
+
+def query_prompts_shared_first_turn(
+    api_key: str,
+    wrapped_prompts: list[PromptWrapper],
+    model: LlmName = LlmName.GPT4O,
+    samples_per_first_turn: int = 1,
+    client: Optional[ProviderClient] = None,
+    cache: Optional[ResponseCache] = None,
+    max_workers: int = 1,
+    retry_policy: Optional[RetryPolicy] = None,
+) -> list[Union[Response, Exception]]:
+    """
+    Opt-in execution mode for prompts with first_unstructured_output: their first prompt does not depend on the output structure
+    (nor the prompt structure flags), so all PromptWrappers with the same dilemma, ethical framework and base prompt send the same first message.
+    Every distinct first message is requested `samples_per_first_turn` times, the PromptWrappers sharing it are assigned to these
+    samples in turn and only their structuring turns are requested separately.
+    The shared first turn is recorded in Response.shared_first_turn, its tokens are not included in the tokens of the Responses.
+
+    Note that the Responses sharing a sample are not independent: the decision is usually already made in the first turn.
+    Other prompts are queried as usual. Results are returned in the order of `wrapped_prompts`, failed prompts yield their exception.
+    """
+    if samples_per_first_turn < 1:
+        raise ValueError("samples_per_first_turn has to be at least 1")
+    if client is None:
+        client = get_provider_client(model.provider, api_key)
+
+    # First message key -> indices of the PromptWrappers sharing it
+    groups: dict[str, list[int]] = {}
+    for index, wrapped_prompt in enumerate(wrapped_prompts):
+        if wrapped_prompt.output_structure.first_unstructured_output and len(wrapped_prompt.prompts) > 1:
+            groups.setdefault(get_first_turn_key(model, wrapped_prompt), []).append(index)
+
+    def request_first_turn(job: tuple[str, int]) -> Union[Completion, Exception]:
+        key, sample = job
+        wrapped_prompt = wrapped_prompts[groups[key][0]]
+        messages = [{"role": "system", "content": wrapped_prompt.prompts[0]}]
+        try:
+            return complete_turn(client, model, messages, get_response_format(wrapped_prompt, 1), cache, sample, retry_policy)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return e
+
+    # index -> (key, sample)
+    assignments: dict[int, tuple[str, int]] = {}
+    for key, indices in groups.items():
+        for position, index in enumerate(indices):
+            assignments[index] = (key, position % samples_per_first_turn)
+
+    def run(index: int) -> Union[Response, Exception]:
+        wrapped_prompt = wrapped_prompts[index]
+        if index not in assignments:
+            try:
+                return query_api(client, wrapped_prompt, model, cache, retry_policy)
+            except Exception as e:
+                return e
+
+        key, sample = assignments[index]
+        first_turn = first_turns[(key, sample)]
+        if isinstance(first_turn, Exception):
+            return first_turn
+        messages = [
+            {"role": "system", "content": wrapped_prompt.prompts[0]},
+            {"role": "assistant", "content": first_turn.content},
+        ]
+        try:
+            completions = run_conversation(client, wrapped_prompt, model, messages, cache, retry_policy)
+            shared_first_turn = SharedFirstTurn(
+                key=key,
+                sample_index=sample,
+                sample_count=samples_per_first_turn,
+                shared_by=len(groups[key]),
+                prompt_tokens=first_turn.prompt_tokens,
+                completion_tokens=first_turn.completion_tokens,
+                cached_tokens=first_turn.cached_tokens,
+                retries=first_turn.retries,
+            )
+            return create_response_from_turns(wrapped_prompt, model, messages, completions, shared_first_turn)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return e
+
+    first_turn_jobs = [
+        (key, sample)
+        for key, indices in groups.items()
+        # A group smaller than samples_per_first_turn does not need more samples than members
+        for sample in range(min(samples_per_first_turn, len(indices)))
+    ]
+    executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+    try:
+        first_turns = dict(zip(first_turn_jobs, executor.map(request_first_turn, first_turn_jobs) if executor else map(request_first_turn, first_turn_jobs)))
+        indices = range(len(wrapped_prompts))
+        results = list(executor.map(run, indices) if executor else map(run, indices))
+    finally:
+        if executor:
+            executor.shutdown()
+
+    shared = sum(len(indices) for indices in groups.values())
+    failed = sum(1 for result in results if isinstance(result, Exception))
+    print(
+        f"Shared first turn query finished: {len(results) - failed} succeeded, {failed} failed, "
+        f"{len(first_turn_jobs)} first turns requested for {shared} prompts with first_unstructured_output"
+    )
+    return results